@@ -0,0 +1,426 @@
+"""benchmark.py
+
+Measure the runtime of each stage of the process with synthetic
+monitoring data. For every scenario a monitoring result file and
+a Get_Capabilities document are generated, a local stub server
+is started for validation, and the stages are run and timed
+separately. Results are written as JSON, and they can be compared
+against an earlier result file to see regressions.
+
+How to run:
+
+        $ cd benchmarks
+        $ python3 Benchmark.py --requests 10000 100000 --output results.json
+        $ python3 Benchmark.py --engine diff mask --baseline results.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import platform
+import argparse
+import tempfile
+import itertools
+import statistics
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import Capabilities
+from Capabilities import get_layer_bbox
+from InputData import get_resolution, get_request_table, get_bboxes_as_geojson
+from Algorithm import DENSITY_DTYPES, compute_density_rasters, solve
+from ResultData import get_raster_grid, convert_to_vector_format
+from Projection import CRS, solve_first_axis_direction
+from Synthetic import DEFAULT_EXTENTS, FOOTPRINTS, BBOX_SIZES, scale_extent, make_footprint, \
+    generate_responses, generate_capabilities, footprint_area_share
+from StubServer import StubServer
+
+# Validation needs GDAL, the other stages can be measured without it.
+try:
+    from Validate import ValidationOptions, validate
+    VALIDATE_IMPORT_ERROR = None
+except ImportError as e:
+    ValidationOptions = None
+    validate = None
+    VALIDATE_IMPORT_ERROR = str(e)
+
+logging.basicConfig(filename="../../output_data/logs/" \
+                    + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
+                    + '.log', level=logging.INFO)
+
+# Stages in the order they are run
+STAGES = ('capabilities', 'parse', 'request_table', 'get_bboxes_as_geojson', 'raster_grid',
+          'compute_density_rasters', 'solve', 'convert_to_vector_format', 'validate')
+
+SERVICE_VERSIONS = {'WMS': '1.3.0', 'WFS': '2.0.0'}
+LAYER_NAME = 'bench:layer'
+
+
+def get_scenarios(args):
+    """List all combinations of the parameters given in the command line
+
+    :param Namespace args: Parsed command line arguments
+
+    :return list: Scenarios as dictionaries
+    """
+    scenarios = []
+    for service_type, crs_code, extent_scale, request_count, bbox_sizes, footprint, engine, \
+            dtype, tile_size, workers, wms_tiles, wfs_partitions in itertools.product(
+                args.service, args.crs, args.extent_scale, args.requests, args.bbox_sizes,
+                args.footprint, args.engine, args.dtype, args.tile_size, args.density_workers,
+                args.wms_tiles, args.wfs_partitions):
+        scenario = {
+            'service_type': service_type,
+            'crs': crs_code,
+            'extent_scale': extent_scale,
+            'extent': scale_extent(DEFAULT_EXTENTS[crs_code], crs_code, extent_scale),
+            'requests': request_count,
+            'bbox_sizes': bbox_sizes,
+            'bbox_size': args.bbox_size,
+            'footprint': footprint,
+            'engine': engine,
+            'dtype': dtype,
+            'tile_size': tile_size or None,
+            'density_workers': workers,
+            'wms_tiles': wms_tiles,
+            'wfs_partitions': wfs_partitions,
+            'resolution': args.resolution,
+            'max_raster_size': args.max_raster_size,
+            'seed': args.seed,
+        }
+        scenario['name'] = "{}_{}_{}_{}_{}_{}_{}".format(service_type, crs_code.replace(':', ''),
+                                                       request_count, bbox_sizes, footprint,
+                                                       engine, dtype)
+        if extent_scale != 1:
+            scenario['name'] += "_extent{:g}".format(extent_scale)
+        if tile_size:
+            scenario['name'] += "_tile{}".format(tile_size)
+        if workers > 1:
+            scenario['name'] += "_workers{}".format(workers)
+        if wms_tiles:
+            scenario['name'] += "_wmstiles{}".format(wms_tiles)
+        if wfs_partitions:
+            scenario['name'] += "_wfsparts{}".format(wfs_partitions)
+        scenarios.append(scenario)
+    return scenarios
+
+
+def summarize(times):
+    """Summarize repeated timings of a stage
+
+    :param list times: Durations in seconds
+
+    :return dict: Timings and their minimum, median and mean
+    """
+    return {
+        'runs': [round(t, 6) for t in times],
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+        'mean': round(statistics.mean(times), 6),
+    }
+
+
+def run_once(scenario, paths, server, stage_times):
+    """Run all stages once and record their durations
+
+    :param dict scenario: Parameters of the scenario
+    :param dict paths: Paths of the input files and output directory
+    :param StubServer server: Server used in validation, or None
+    :param dict stage_times: Lists of durations by stage, appended in place
+
+    :return dict: Information about the result
+    """
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        stage_times.setdefault(stage, []).append(time.perf_counter() - start)
+        return value
+
+    service_type = scenario['service_type']
+    service_version = SERVICE_VERSIONS[service_type]
+    axis_dir = solve_first_axis_direction(service_type, service_version, scenario['crs'])
+    crs = CRS(scenario['crs'], axis_dir)
+    output_crs = CRS('EPSG:4326', 'east')
+
+    # Parsed documents are cached within the process, start from scratch every time.
+    Capabilities._load_index.cache_clear()
+    layer_bbox = timed('capabilities', get_layer_bbox, paths['capabilities'], LAYER_NAME,
+                       crs, service_type)
+
+    def parse():
+        with open(paths['responses']) as source:
+            return json.load(source)['results']
+    responses = timed('parse', parse)
+
+    requests, flip_features = timed('request_table', get_request_table, layer_bbox,
+                                    responses, crs)
+    timed('get_bboxes_as_geojson', get_bboxes_as_geojson, layer_bbox, responses, crs,
+          flip_features=flip_features)
+
+    resolution = get_resolution(crs, scenario['resolution'])
+    grid, resolution = timed('raster_grid', get_raster_grid, crs, layer_bbox, resolution,
+                             max_raster_size=scenario['max_raster_size'])
+
+    timed('compute_density_rasters', compute_density_rasters, requests, grid,
+          scenario['engine'], scenario['dtype'], scenario['density_workers'])
+    binary_raster = timed('solve', solve, requests, grid, None, scenario['engine'],
+                          scenario['dtype'], scenario['tile_size'],
+                          scenario['density_workers'])
+
+    url = server.url if server else 'http://localhost/ows'
+    output_name = "bin_" + scenario['name']
+    data_bounds = timed('convert_to_vector_format', convert_to_vector_format, crs,
+                        paths['output_dir'], resolution, binary_raster, grid, output_name,
+                        output_crs, url, LAYER_NAME)
+
+    info = {
+        'requests_used': len(requests),
+        'flip_features': bool(flip_features),
+        'grid': [grid.height, grid.width],
+        'resolution': resolution,
+        'data_pixels': int(np.count_nonzero(binary_raster)),
+    }
+
+    if validate is None:
+        info['validation'] = "skipped: {}".format(VALIDATE_IMPORT_ERROR)
+    elif server is None:
+        info['validation'] = "skipped"
+    else:
+        val_path = paths['output_dir'] + "val_" + scenario['name'] + ".tif"
+        try:
+            status = timed('validate', validate, server.url, LAYER_NAME, crs.crs_code,
+                           layer_bbox, binary_raster, grid, val_path, service_type,
+                           service_version, None, flip_features, data_bounds, 'bench',
+                           ValidationOptions(wms_tiles=scenario['wms_tiles'],
+                                             wfs_partitions=scenario['wfs_partitions']))
+            info['validation'] = "ok" if status == 0 else "failed"
+        except Exception as e:
+            logging.exception("Validation of {} failed".format(scenario['name']))
+            info['validation'] = "error: {}".format(e)
+
+    return info
+
+
+def run_scenario(scenario, work_dir, repeat, validation=True, latency=0):
+    """Generate the input files of a scenario and time its stages
+
+    :param dict scenario: Parameters of the scenario
+    :param str work_dir: Directory for the generated and output files
+    :param int repeat: How many times the stages are run
+    :param boolean validation: Run validation against a stub server
+    :param float latency: Extra delay of each stub server response; in seconds
+
+    :return dict: Scenario with timings of the stages
+    """
+    scenario_dir = os.path.join(work_dir, scenario['name']) + "/"
+    os.makedirs(scenario_dir, exist_ok=True)
+    paths = {
+        'responses': scenario_dir + "1_responses.json",
+        'capabilities': scenario_dir + "1.xml",
+        'output_dir': scenario_dir,
+    }
+
+    extent = scenario['extent']
+    footprint = make_footprint(scenario['footprint'], extent, scenario['seed'])
+    service_type = scenario['service_type']
+
+    server = None
+    if validation and validate is not None:
+        server = StubServer(footprint, service_type, LAYER_NAME, scenario['crs'], extent,
+                            latency=latency).start()
+    url = server.url if server else 'http://localhost/ows'
+
+    start = time.perf_counter()
+    generate_capabilities(paths['capabilities'], service_type, LAYER_NAME, scenario['crs'],
+                          extent, SERVICE_VERSIONS[service_type], url)
+    data_requests = generate_responses(paths['responses'], scenario['requests'],
+                                       scenario['crs'], extent, footprint,
+                                       scenario['bbox_sizes'], scenario['bbox_size'],
+                                       service_type, SERVICE_VERSIONS[service_type],
+                                       LAYER_NAME, url, seed=scenario['seed'])
+    generation_seconds = time.perf_counter() - start
+
+    stage_times = {}
+    try:
+        for _ in range(repeat):
+            info = run_once(scenario, paths, server, stage_times)
+        if server is not None:
+            info['server_requests'] = server.request_count
+    finally:
+        if server is not None:
+            server.stop()
+
+    info['requests_with_data'] = data_requests
+    info['footprint_share'] = round(footprint_area_share(footprint, extent), 4)
+    info['generation_seconds'] = round(generation_seconds, 3)
+
+    result = dict(scenario)
+    result['stages'] = {stage: summarize(stage_times[stage])
+                        for stage in STAGES if stage in stage_times}
+    result['total'] = round(sum(timing['median'] for timing in result['stages'].values()), 6)
+    result['info'] = info
+    return result
+
+
+def get_environment():
+    """Describe the environment where the benchmark was run
+
+    :return dict: Versions and the commit of the code
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare median stage timings against an earlier result
+
+    Scenarios are matched by name.
+
+    :param list results: Scenario results of this run
+    :param list baseline: Scenario results of the earlier run
+    :param float tolerance: Relative change which is reported as slower or faster
+
+    :return list: Stage comparisons as dictionaries
+    """
+    earlier = {scenario['name']: scenario for scenario in baseline}
+    comparison = []
+    for scenario in results:
+        if scenario['name'] not in earlier:
+            continue
+        old_stages = earlier[scenario['name']]['stages']
+        for stage, timing in scenario['stages'].items():
+            if stage not in old_stages or old_stages[stage]['median'] == 0:
+                continue
+            ratio = timing['median']/old_stages[stage]['median']
+            if ratio > 1 + tolerance:
+                change = 'slower'
+            elif ratio < 1 - tolerance:
+                change = 'faster'
+            else:
+                change = 'same'
+            comparison.append({
+                'scenario': scenario['name'],
+                'stage': stage,
+                'baseline': old_stages[stage]['median'],
+                'median': timing['median'],
+                'ratio': round(ratio, 3),
+                'change': change,
+            })
+    return comparison
+
+
+def print_results(results, comparison):
+    """Print median timings of the stages as a table
+
+    :param list results: Scenario results
+    :param list comparison: Stage comparisons, may be empty
+    """
+    changes = {(item['scenario'], item['stage']): item for item in comparison}
+    for scenario in results:
+        print(scenario['name'])
+        for stage, timing in scenario['stages'].items():
+            line = "  {:<26}{:>10.4f} s".format(stage, timing['median'])
+            item = changes.get((scenario['name'], stage))
+            if item:
+                line += "  x{:<7.2f}{}".format(item['ratio'],
+                                                "" if item['change'] == 'same' else item['change'])
+            print(line)
+        print("  {:<26}{:>10.4f} s   validation: {}".format('total', scenario['total'],
+                                                            scenario['info']['validation']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, nargs='+', default=[10000],
+                        help="Numbers of requests in the monitoring files")
+    parser.add_argument("--crs", nargs='+', default=['EPSG:3067'],
+                        choices=sorted(DEFAULT_EXTENTS))
+    parser.add_argument("--extent-scale", type=float, nargs='+', default=[1.0],
+                        help="Factors of the side lengths of the default layer extent "
+                             "of the coordinate system")
+    parser.add_argument("--service", nargs='+', default=['WMS'], choices=['WMS', 'WFS'])
+    parser.add_argument("--bbox-sizes", nargs='+', default=['lognormal'], choices=BBOX_SIZES,
+                        help="Distributions of the request bbox sizes")
+    parser.add_argument("--bbox-size", type=float, default=0.02,
+                        help="Typical request bbox side as a fraction of the layer width")
+    parser.add_argument("--footprint", nargs='+', default=['circle'], choices=FOOTPRINTS,
+                        help="Shapes of the area with data")
+    parser.add_argument("--engine", nargs='+', default=['diff'], choices=['diff', 'mask'])
+    parser.add_argument("--dtype", nargs='+', default=['int32'], choices=DENSITY_DTYPES,
+                        help="Data types of the density rasters")
+    parser.add_argument("--tile-size", type=int, nargs='+', default=[0],
+                        help="Tile sizes of solve in pixels; 0 means no tiling")
+    parser.add_argument("--density-workers", type=int, nargs='+', default=[1],
+                        help="Numbers of processes counting the requests")
+    parser.add_argument("--wms-tiles", type=int, nargs='+', default=[0],
+                        help="Tiles per side in WMS validation; 0 means one image")
+    parser.add_argument("--wfs-partitions", type=int, nargs='+', default=[0],
+                        help="Parts per side in WFS validation; 0 means the whole layer")
+    parser.add_argument("--resolution", type=int, default=1000,
+                        help="Resolution of the analysis in meters")
+    parser.add_argument("--max-raster-size", type=int, default=500000)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="How many times the stages are run in each scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-validation", action='store_true',
+                        help="Don't start a stub server and run validation")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Extra delay of each stub server response; in seconds")
+    parser.add_argument("--work-dir", help="Directory for generated files; "
+                                           "defaults to a temporary directory")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative change reported as slower or faster")
+    parser.add_argument("--fail-on-regression", action='store_true',
+                        help="Exit with status 1 if any stage got slower")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='spatineo_bench_') as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        results = []
+        for scenario in get_scenarios(args):
+            logging.info("Benchmark scenario {}".format(scenario['name']))
+            results.append(run_scenario(scenario, work_dir, args.repeat,
+                                        not args.no_validation, args.latency))
+
+    comparison = []
+    if args.baseline:
+        with open(args.baseline) as source:
+            comparison = compare(results, json.load(source)['scenarios'], args.tolerance)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'scenarios': results,
+        'comparison': comparison,
+    }
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+        print_results(results, comparison)
+        print("Results written to {}".format(args.output))
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.fail_on_regression and any(item['change'] == 'slower' for item in comparison):
+        sys.exit(1)
@@ -0,0 +1,306 @@
+"""stubserver.py
+
+A local WMS/WFS server for benchmarks. It serves one layer whose
+data covers a known footprint, so validation can be run and timed
+without a real service.
+
+How to run (serves until interrupted):
+
+        $ python3 StubServer.py --service WMS --crs EPSG:3067 --footprint circle
+
+"""
+
+import io
+import time
+import logging
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from PIL import Image
+from shapely.geometry import box
+
+from Synthetic import DEFAULT_EXTENTS, FOOTPRINTS, capabilities_xml, get_axis_order, \
+    is_geographic, make_footprint, render_footprint, footprint_features
+
+
+# Size of a WMS image the server accepts; in pixels
+MAX_IMAGE_SIZE = 4096
+
+
+def polygon_gml(polygon, gml_id, axis_order):
+    """Write a polygon as GML 3.2
+
+    :param shapely Polygon polygon: The polygon
+    :param str gml_id: Identifier of the geometry
+    :param str axis_order: Axis order of the coordinates, 'east' or 'north'
+
+    :return str: gml:Polygon element
+    """
+    def pos_list(ring):
+        coords = np.asarray(ring.coords)
+        if axis_order == 'north':
+            coords = coords[:, ::-1]
+        return " ".join("{!r} {!r}".format(float(x), float(y)) for x, y in coords)
+
+    interiors = "".join("<gml:interior><gml:LinearRing><gml:posList>{}</gml:posList>"
+                        "</gml:LinearRing></gml:interior>".format(pos_list(ring))
+                        for ring in polygon.interiors)
+    return "<gml:Polygon gml:id=\"{}\"><gml:exterior><gml:LinearRing><gml:posList>{}" \
+           "</gml:posList></gml:LinearRing></gml:exterior>{}</gml:Polygon>"\
+           .format(gml_id, pos_list(polygon.exterior), interiors)
+
+
+class StubServer(object):
+    """Serve a synthetic layer over HTTP in a background thread.
+
+    Can be used as a context manager:
+
+        with StubServer(footprint, 'WMS', 'bench:layer', 'EPSG:3067', extent) as server:
+            requests.get(server.url + "?SERVICE=WMS&REQUEST=GetCapabilities")
+    """
+
+    def __init__(self, footprint, service_type, layer_name, crs_code, extent,
+                 host='127.0.0.1', port=0, latency=0, feature_ids=True):
+        """ Set up the layer served
+
+        :param shapely geometry footprint: Area with data
+        :param str service_type: WMS/WFS
+        :param str layer_name: Name of the layer
+        :param str crs_code: EPSG code of the layer
+        :param list extent: Layer extent as [minx, miny, maxx, maxy] in east-north order
+        :param str host: Address to listen
+        :param int port: Port to listen; 0 picks a free port
+        :param float latency: Extra delay of each response; in seconds
+        :param boolean feature_ids: Whether WFS features have a gml:id; without
+                                    it OGR only numbers the features
+        """
+        self.footprint = footprint
+        self.service_type = service_type
+        self.layer_name = layer_name
+        self.crs_code = crs_code
+        self.extent = extent
+        self.latency = latency
+        self.feature_ids = feature_ids
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._features = footprint_features(footprint)
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}/ows".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info("Stub server listening at {}".format(self.url))
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {key.upper(): value for key, value in
+                          parse_qsl(urlparse(self.path).query, keep_blank_values=True)}
+                with server._lock:
+                    server.request_count += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    status, content_type, body = server.respond(params)
+                except Exception as e:
+                    status, content_type, body = 400, 'text/plain', str(e).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Stub server: " + format % args)
+
+        return Handler
+
+    def respond(self, params):
+        """Create the response for a request
+
+        :param dict params: Query parameters with upper case keys
+
+        :return tuple: HTTP status, content type and body
+        """
+        request = params.get('REQUEST', '').lower()
+
+        if request == 'getcapabilities':
+            body = capabilities_xml(self.service_type, self.layer_name, self.crs_code,
+                                    self.extent, url=self.url)
+            return 200, 'text/xml', body.encode()
+        if self.service_type == 'WMS' and request == 'getmap':
+            return 200, 'image/png', self.get_map(params)
+        if self.service_type == 'WFS' and request == 'describefeaturetype':
+            return 200, 'text/xml', self.describe_feature_type().encode()
+        if self.service_type == 'WFS' and request == 'getfeature':
+            return 200, 'text/xml; subtype=gml/3.2', self.get_feature(params).encode()
+
+        return 400, 'text/plain', "Unsupported request {}".format(request).encode()
+
+    def get_map(self, params):
+        """Render the footprint to a PNG image
+
+        Data is drawn with a checkerboard pattern, so that every part of
+        the image with data has variation. Other pixels are transparent.
+
+        :param dict params: Query parameters with upper case keys
+
+        :return bytes: The image
+        """
+        width = min(int(params['WIDTH']), MAX_IMAGE_SIZE)
+        height = min(int(params['HEIGHT']), MAX_IMAGE_SIZE)
+        bbox = [float(value) for value in params['BBOX'].split(',')[:4]]
+        crs_code = params.get('CRS', params.get('SRS', self.crs_code))
+        if get_axis_order('WMS', params.get('VERSION', '1.3.0'), crs_code) == 'north':
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+        data = render_footprint(self.footprint, bbox, width, height)
+        rows, cols = np.indices((height, width))
+        pattern = np.where((rows + cols) % 2 == 0, 60, 180).astype(np.uint8)
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        image[data, 0] = pattern[data]
+        image[data, 1] = 120
+        image[data, 3] = 255
+
+        out = io.BytesIO()
+        Image.fromarray(image).save(out, format='PNG')
+        return out.getvalue()
+
+    def describe_feature_type(self):
+        """Describe the feature type of the layer
+
+        :return str: XML schema document
+        """
+        prefix, name = self._split_name()
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+ xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:{prefix}="http://example.com/{prefix}"
+ targetNamespace="http://example.com/{prefix}" elementFormDefault="qualified">
+<xsd:import namespace="http://www.opengis.net/gml/3.2"
+ schemaLocation="http://schemas.opengis.net/gml/3.2.1/gml.xsd"/>
+<xsd:complexType name="{name}Type"><xsd:complexContent>
+<xsd:extension base="gml:AbstractFeatureType"><xsd:sequence>
+<xsd:element name="id" type="xsd:int"/>
+<xsd:element name="geometry" type="gml:SurfacePropertyType"/>
+</xsd:sequence></xsd:extension></xsd:complexContent></xsd:complexType>
+<xsd:element name="{name}" type="{prefix}:{name}Type" substitutionGroup="gml:AbstractFeature"/>
+</xsd:schema>
+""".format(prefix=prefix, name=name)
+
+    def get_feature(self, params):
+        """List the features of the layer as GML 3.2
+
+        Supports paging with STARTINDEX and COUNT, RESULTTYPE=hits and
+        filtering with BBOX. Features keep their ids when filtered.
+
+        :param dict params: Query parameters with upper case keys
+
+        :return str: wfs:FeatureCollection document
+        """
+        prefix, name = self._split_name()
+        selected = self.select_features(params)
+        total = len(selected)
+        start = int(params.get('STARTINDEX', 0))
+        count = params.get('COUNT', params.get('MAXFEATURES'))
+        stop = total if count is None else min(total, start + int(count))
+
+        header = """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0"
+ xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:{prefix}="http://example.com/{prefix}"
+ timeStamp="2019-01-01T00:00:00Z" numberMatched="{total}" numberReturned="{returned}">
+"""
+        if params.get('RESULTTYPE', '').lower() == 'hits':
+            return header.format(prefix=prefix, total=total, returned=0) \
+                   + "</wfs:FeatureCollection>\n"
+
+        srs = "urn:ogc:def:crs:EPSG::{}".format(self.crs_code.split(':')[-1])
+        axis_order = 'north' if is_geographic(self.crs_code) else 'east'
+
+        members = []
+        for i in selected[start:stop]:
+            members.append(
+                "<wfs:member><{prefix}:{name}{gml_id}><{prefix}:id>{fid}"
+                "</{prefix}:id><{prefix}:geometry>{geometry}</{prefix}:geometry>"
+                "</{prefix}:{name}></wfs:member>\n"
+                .format(prefix=prefix, name=name, fid=i + 1,
+                        gml_id=" gml:id=\"{}.{}\"".format(name, i + 1) if self.feature_ids else "",
+                        geometry=polygon_gml(self._features[i], "geom.{}".format(i + 1),
+                                             axis_order)
+                        .replace("<gml:Polygon ", "<gml:Polygon srsName=\"{}\" ".format(srs))))
+
+        return header.format(prefix=prefix, total=total, returned=max(0, stop - start)) \
+               + "".join(members) + "</wfs:FeatureCollection>\n"
+
+    def select_features(self, params):
+        """Find the features intersecting the BBOX of a request
+
+        :param dict params: Query parameters with upper case keys
+
+        :return list: Indices of the features, all of them without BBOX
+        """
+        if not params.get('BBOX'):
+            return list(range(len(self._features)))
+
+        values = params['BBOX'].split(',')
+        bbox = [float(value) for value in values[:4]]
+        crs_code = values[4] if len(values) > 4 else params.get('SRSNAME', self.crs_code)
+        version = params.get('VERSION', '2.0.0')
+        if get_axis_order('WFS', version, crs_code) == 'north':
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+        area = box(*bbox)
+        return [i for i, feature in enumerate(self._features) if feature.intersects(area)]
+
+    def _split_name(self):
+        if ':' in self.layer_name:
+            return self.layer_name.split(':', 1)
+        return 'bench', self.layer_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--service", default='WMS', choices=['WMS', 'WFS'])
+    parser.add_argument("--crs", default='EPSG:3067', choices=sorted(DEFAULT_EXTENTS))
+    parser.add_argument("--footprint", default='circle', choices=FOOTPRINTS)
+    parser.add_argument("--layer", default='bench:layer')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Extra delay of each response; in seconds")
+    parser.add_argument("--no-feature-ids", action='store_true',
+                        help="Serve WFS features without gml:id")
+    args = parser.parse_args()
+
+    extent = DEFAULT_EXTENTS[args.crs]
+    stub = StubServer(make_footprint(args.footprint, extent), args.service, args.layer,
+                      args.crs, extent, port=args.port, latency=args.latency,
+                      feature_ids=not args.no_feature_ids)
+    with stub:
+        print("Serving {} at {}".format(args.service, stub.url))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,438 @@
+"""synthetic.py
+
+Generate synthetic monitoring result files and matching
+Get_Capabilities documents for benchmarks. The location of
+the data (footprint) is known, so the monitoring results can be
+labelled the same way as the image analysis of the monitoring
+service would do it.
+
+"""
+
+import json
+import math
+import numpy as np
+import pyproj
+from pyproj import Transformer
+from shapely.geometry import Point, box, mapping
+from shapely.ops import unary_union
+from rasterio.features import geometry_mask
+from rasterio.transform import from_bounds
+
+
+# Shapes of the area with data
+FOOTPRINTS = ('circle', 'rectangle', 'ring', 'islands', 'full')
+
+# Distributions of the request bounding box sizes
+BBOX_SIZES = ('fixed', 'uniform', 'lognormal', 'zoom')
+
+# Layer extents as [minx, miny, maxx, maxy] in east-north order
+DEFAULT_EXTENTS = {
+    'EPSG:3067': [50000.0, 6600000.0, 750000.0, 7800000.0],
+    'EPSG:3857': [2100000.0, 8300000.0, 3500000.0, 11100000.0],
+    'EPSG:4326': [19.0, 59.5, 31.5, 70.1],
+}
+
+# Side length of the raster used to label requests
+LABEL_RASTER_SIZE = 2048
+
+
+def is_geographic(crs_code):
+    """Check if coordinates of the CRS are in degrees
+
+    :param str crs_code: EPSG code of a coordinate system
+
+    :return boolean: True for geographic coordinate systems
+    """
+    if crs_code == 'CRS:84':
+        return True
+    return pyproj.CRS(crs_code).is_geographic
+
+
+def get_axis_order(service_type, service_version, crs_code):
+    """Get the axis order the service uses for coordinates
+
+    WMS 1.3.0 and WFS 1.1.0 and newer use the axis order of the
+    EPSG database, which is north first for geographic coordinates.
+
+    :param str service_type: WMS/WFS
+    :param str service_version: Version of the service
+    :param str crs_code: EPSG code of a coordinate system
+
+    :return str: 'east' or 'north'
+    """
+    version = tuple(int(num) for num in service_version.split('.'))
+    if not is_geographic(crs_code) or crs_code == 'CRS:84':
+        return 'east'
+    if service_type == 'WMS' and version < (1, 3):
+        return 'east'
+    if service_type == 'WFS' and version < (1, 1):
+        return 'east'
+    return 'north'
+
+
+def order_bbox(bbox, axis_order):
+    """Return east-north bounding box in the given axis order
+
+    :param list bbox: Bounding box as [minx, miny, maxx, maxy]
+    :param str axis_order: 'east' or 'north'
+
+    :return list: Bounding box
+    """
+    if axis_order == 'north':
+        return [bbox[1], bbox[0], bbox[3], bbox[2]]
+    return list(bbox)
+
+
+def scale_extent(extent, crs_code, scale=1.0):
+    """Scale an extent around its center
+
+    Degrees are clipped to the valid range of longitudes and latitudes.
+
+    :param list extent: Extent as [minx, miny, maxx, maxy] in east-north order
+    :param str crs_code: EPSG code of the extent
+    :param float scale: Factor of the side lengths; defaults to 1.0
+
+    :return list: Scaled extent
+    """
+    center_x = (extent[0] + extent[2])/2
+    center_y = (extent[1] + extent[3])/2
+    half_width = (extent[2] - extent[0])*scale/2
+    half_height = (extent[3] - extent[1])*scale/2
+    scaled = [center_x - half_width, center_y - half_height,
+              center_x + half_width, center_y + half_height]
+    if is_geographic(crs_code):
+        scaled = [max(scaled[0], -180.0), max(scaled[1], -90.0),
+                  min(scaled[2], 180.0), min(scaled[3], 90.0)]
+    return scaled
+
+
+def make_footprint(shape, extent, seed=0):
+    """Create the area where the layer has data
+
+    :param str shape: One of FOOTPRINTS
+    :param list extent: Layer extent as [minx, miny, maxx, maxy]
+    :param int seed: Seed for the random shapes
+
+    :return shapely geometry: Area with data
+    """
+    minx, miny, maxx, maxy = extent
+    width = maxx - minx
+    height = maxy - miny
+    center = Point(minx + width/2, miny + height/2)
+    radius = min(width, height)/2
+
+    if shape == 'circle':
+        return center.buffer(0.6*radius, 32)
+    if shape == 'rectangle':
+        return box(minx + 0.2*width, miny + 0.3*height, minx + 0.7*width, miny + 0.8*height)
+    if shape == 'ring':
+        return center.buffer(0.8*radius, 32).difference(center.buffer(0.4*radius, 32))
+    if shape == 'islands':
+        rng = np.random.default_rng(seed)
+        islands = []
+        for _ in range(12):
+            x = rng.uniform(minx + 0.1*width, maxx - 0.1*width)
+            y = rng.uniform(miny + 0.1*height, maxy - 0.1*height)
+            islands.append(Point(x, y).buffer(rng.uniform(0.03, 0.12)*radius, 16))
+        return unary_union(islands)
+    if shape == 'full':
+        return box(*extent)
+
+    raise Exception("Unknown footprint {}, options: {}".format(shape, FOOTPRINTS))
+
+
+def render_footprint(footprint, bbox, width, height):
+    """Rasterize the footprint to a grid
+
+    :param shapely geometry footprint: Area with data
+    :param list bbox: Extent of the grid as [minx, miny, maxx, maxy]
+    :param int width: Number of columns
+    :param int height: Number of rows
+
+    :return numpy array: Boolean array; True means data
+    """
+    transform = from_bounds(*bbox, width, height)
+    if footprint.is_empty:
+        return np.zeros((height, width), dtype=bool)
+    return geometry_mask([mapping(footprint)], out_shape=(height, width),
+                         transform=transform, invert=True, all_touched=True)
+
+
+def random_bbox_sizes(rng, count, distribution, base_size):
+    """Draw side lengths of request bounding boxes
+
+    :param numpy Generator rng: Random number generator
+    :param int count: Number of sizes
+    :param str distribution: One of BBOX_SIZES
+    :param float base_size: Typical side length
+
+    :return numpy array: Side lengths
+    """
+    if distribution == 'fixed':
+        return np.full(count, base_size)
+    if distribution == 'uniform':
+        return rng.uniform(0.25, 1.75, count)*base_size
+    if distribution == 'lognormal':
+        return rng.lognormal(0, 0.75, count)*base_size
+    if distribution == 'zoom':
+        # Map clients request tiles of the zoom levels
+        return base_size*2.0**rng.integers(-3, 4, count)
+
+    raise Exception("Unknown bbox size distribution {}, options: {}"\
+                    .format(distribution, BBOX_SIZES))
+
+
+def label_requests(footprint, extent, bboxes):
+    """Find out which request bounding boxes contain data
+
+    The footprint is rasterized once, and the data pixels within
+    each bounding box are counted from a summed-area table.
+
+    :param shapely geometry footprint: Area with data
+    :param list extent: Extent of the label raster
+    :param numpy array bboxes: Nx4 array of east-north bounding boxes
+
+    :return numpy array: Boolean array; True if there is data in the bbox
+    """
+    size = LABEL_RASTER_SIZE
+    data = render_footprint(footprint, extent, size, size)
+    table = np.zeros((size + 1, size + 1), dtype=np.int64)
+    table[1:, 1:] = data.cumsum(axis=0).cumsum(axis=1)
+
+    minx, miny, maxx, maxy = extent
+    cols = (bboxes[:, [0, 2]] - minx)/(maxx - minx)*size
+    rows = (maxy - bboxes[:, [3, 1]])/(maxy - miny)*size
+    col_start = np.clip(np.floor(cols[:, 0]), 0, size).astype(np.int64)
+    col_stop = np.clip(np.ceil(cols[:, 1]), 0, size).astype(np.int64)
+    row_start = np.clip(np.floor(rows[:, 0]), 0, size).astype(np.int64)
+    row_stop = np.clip(np.ceil(rows[:, 1]), 0, size).astype(np.int64)
+
+    counts = table[row_stop, col_stop] - table[row_start, col_stop] \
+             - table[row_stop, col_start] + table[row_start, col_start]
+    return counts > 0
+
+
+def generate_responses(path, request_count, crs_code, extent, footprint,
+                       bbox_sizes='lognormal', bbox_size=0.02, service_type='WMS',
+                       service_version='1.3.0', layer_name='bench:layer',
+                       url='http://localhost/ows', noise=0.02, invalid=0.01,
+                       seed=0, ndjson=False):
+    """Write a synthetic monitoring result file
+
+    Requests are spread over the layer extent and a margin around it.
+    imageAnalysisResult tells if the bbox touches the footprint; a share
+    of the results is wrong on purpose, and a share of the requests failed.
+
+    :param str path: Path of the output file
+    :param int request_count: Number of requests
+    :param str crs_code: EPSG code of the requests
+    :param list extent: Layer extent as [minx, miny, maxx, maxy] in east-north order
+    :param shapely geometry footprint: Area with data
+    :param str bbox_sizes: Distribution of bbox sizes, one of BBOX_SIZES
+    :param float bbox_size: Typical bbox side as a fraction of the extent width
+    :param str service_type: WMS/WFS
+    :param str service_version: Version used in the request urls
+    :param str layer_name: Name of the layer
+    :param str url: Url of the service
+    :param float noise: Share of wrong image analysis results
+    :param float invalid: Share of failed requests
+    :param int seed: Seed of the random numbers
+    :param boolean ndjson: Write newline delimited JSON instead of one object
+
+    :return int: Number of requests with data
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = extent
+    width = maxx - minx
+    height = maxy - miny
+
+    sides = random_bbox_sizes(rng, request_count, bbox_sizes, bbox_size*width)
+    sides = np.minimum(sides, min(width, height))
+    x = rng.uniform(minx - 0.05*width, maxx + 0.05*width - sides)
+    y = rng.uniform(miny - 0.05*height, maxy + 0.05*height - sides)
+    bboxes = np.column_stack([x, y, x + sides, y + sides])
+
+    # Label raster covers the margin too
+    label_extent = [minx - 0.1*width, miny - 0.1*height, maxx + 0.1*width, maxy + 0.1*height]
+    has_data = label_requests(footprint, label_extent, bboxes)
+    analysis = np.where(rng.random(request_count) < noise, ~has_data, has_data).astype(int)
+    test_result = np.where(rng.random(request_count) < invalid, 1, 0)
+
+    axis_order = get_axis_order(service_type, service_version, crs_code)
+    if axis_order == 'north':
+        bboxes = bboxes[:, [1, 0, 3, 2]]
+
+    if service_type == 'WMS':
+        query = "SERVICE=WMS&REQUEST=GetMap&VERSION={}&LAYERS={}&CRS={}&WIDTH=256&HEIGHT=256"\
+                "&FORMAT=image/png&BBOX=".format(service_version, layer_name, crs_code)
+    else:
+        query = "SERVICE=WFS&REQUEST=GetFeature&VERSION={}&TYPENAMES={}&COUNT=3&SRSNAME={}"\
+                "&BBOX=".format(service_version, layer_name, crs_code)
+
+    header = {'crs': crs_code, 'layerName': layer_name}
+    start_time = 1553731309383
+
+    def results():
+        for i in range(request_count):
+            bbox = ",".join(repr(float(value)) for value in bboxes[i])
+            result = {
+                'testResult': int(test_result[i]),
+                'requestTime': start_time + i*60000,
+                'bBox': bbox,
+                'url': "{}?{}{}".format(url, query, bbox)
+            }
+            # Failed requests are not analysed
+            if test_result[i] == 0:
+                result['imageAnalysisResult'] = int(analysis[i])
+            yield result
+
+    with open(path, 'w') as out:
+        if ndjson:
+            out.write(json.dumps({'layerKey': header}) + "\n")
+            for result in results():
+                out.write(json.dumps(result) + "\n")
+        else:
+            json.dump({'layerKey': header, 'results': list(results())}, out)
+
+    return int(has_data.sum())
+
+
+def get_wgs84_bbox(extent, crs_code):
+    """Transform an extent to longitudes and latitudes
+
+    :param list extent: Extent as [minx, miny, maxx, maxy] in east-north order
+    :param str crs_code: EPSG code of the extent
+
+    :return list: Bounding box as [minlon, minlat, maxlon, maxlat]
+    """
+    if is_geographic(crs_code):
+        return list(extent)
+    transformer = Transformer.from_crs(crs_code, "EPSG:4326", always_xy=True)
+    xs = np.linspace(extent[0], extent[2], 21)
+    ys = np.linspace(extent[1], extent[3], 21)
+    xx, yy = np.meshgrid(xs, ys)
+    lon, lat = transformer.transform(xx.ravel(), yy.ravel())
+    return [float(np.min(lon)), float(np.min(lat)), float(np.max(lon)), float(np.max(lat))]
+
+
+def capabilities_xml(service_type, layer_name, crs_code, extent,
+                     service_version=None, url='http://localhost/ows'):
+    """Create a Get_Capabilities document for the layer
+
+    :param str service_type: WMS/WFS
+    :param str layer_name: Name of the layer
+    :param str crs_code: EPSG code of the layer extent
+    :param list extent: Layer extent as [minx, miny, maxx, maxy] in east-north order
+    :param str service_version: Version of the document; defaults to 1.3.0 for WMS
+                                and 2.0.0 for WFS
+    :param str url: Url of the service
+
+    :return str: The document
+    """
+    lon_lat = get_wgs84_bbox(extent, crs_code)
+
+    if service_type == 'WMS':
+        service_version = service_version or '1.3.0'
+        axis_order = get_axis_order('WMS', service_version, crs_code)
+        minx, miny, maxx, maxy = order_bbox(extent, axis_order)
+        ref = 'CRS' if service_version == '1.3.0' else 'SRS'
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="{version}" xmlns="http://www.opengis.net/wms"
+ xmlns:xlink="http://www.w3.org/1999/xlink">
+<Service><Name>WMS</Name><Title>Benchmark</Title></Service>
+<Capability>
+<Request><GetMap><Format>image/png</Format>
+<DCPType><HTTP><Get><OnlineResource xlink:href="{url}?"/></Get></HTTP></DCPType>
+</GetMap></Request>
+<Layer><Title>Root</Title>
+<{ref}>{crs}</{ref}>
+<Layer queryable="0"><Name>{name}</Name><Title>{name}</Title>
+<{ref}>{crs}</{ref}>
+<EX_GeographicBoundingBox><westBoundLongitude>{lon_lat[0]}</westBoundLongitude>
+<eastBoundLongitude>{lon_lat[2]}</eastBoundLongitude>
+<southBoundLatitude>{lon_lat[1]}</southBoundLatitude>
+<northBoundLatitude>{lon_lat[3]}</northBoundLatitude></EX_GeographicBoundingBox>
+<BoundingBox {ref}="{crs}" minx="{minx}" miny="{miny}" maxx="{maxx}" maxy="{maxy}"/>
+</Layer>
+</Layer>
+</Capability>
+</WMS_Capabilities>
+""".format(version=service_version, url=url, ref=ref, crs=crs_code, name=layer_name,
+           lon_lat=lon_lat, minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+
+    if service_type == 'WFS':
+        service_version = service_version or '2.0.0'
+        epsg = crs_code.split(':')[-1]
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<wfs:WFS_Capabilities version="{version}" xmlns:wfs="http://www.opengis.net/wfs/2.0"
+ xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink"
+ xmlns:fes="http://www.opengis.net/fes/2.0" xmlns:bench="http://example.com/bench">
+<ows:ServiceIdentification><ows:Title>Benchmark</ows:Title>
+<ows:ServiceType>WFS</ows:ServiceType><ows:ServiceTypeVersion>2.0.0</ows:ServiceTypeVersion>
+</ows:ServiceIdentification>
+<ows:OperationsMetadata>
+<ows:Operation name="GetCapabilities"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?"/>
+</ows:HTTP></ows:DCP></ows:Operation>
+<ows:Operation name="DescribeFeatureType"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?"/>
+</ows:HTTP></ows:DCP></ows:Operation>
+<ows:Operation name="GetFeature"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?"/>
+</ows:HTTP></ows:DCP></ows:Operation>
+<ows:Constraint name="ImplementsResultPaging"><ows:NoValues/>
+<ows:DefaultValue>TRUE</ows:DefaultValue></ows:Constraint>
+</ows:OperationsMetadata>
+<wfs:FeatureTypeList>
+<wfs:FeatureType><wfs:Name>{name}</wfs:Name><wfs:Title>{name}</wfs:Title>
+<wfs:DefaultCRS>urn:ogc:def:crs:EPSG::{epsg}</wfs:DefaultCRS>
+<ows:WGS84BoundingBox><ows:LowerCorner>{lon_lat[0]} {lon_lat[1]}</ows:LowerCorner>
+<ows:UpperCorner>{lon_lat[2]} {lon_lat[3]}</ows:UpperCorner></ows:WGS84BoundingBox>
+</wfs:FeatureType>
+</wfs:FeatureTypeList>
+</wfs:WFS_Capabilities>
+""".format(version=service_version, url=url, name=layer_name, epsg=epsg, lon_lat=lon_lat)
+
+    raise Exception("Unknown service type {}".format(service_type))
+
+
+def generate_capabilities(path, service_type, layer_name, crs_code, extent,
+                          service_version=None, url='http://localhost/ows'):
+    """Write a Get_Capabilities document for the layer
+
+    :param str path: Path of the output file
+    :param str service_type: WMS/WFS
+    :param str layer_name: Name of the layer
+    :param str crs_code: EPSG code of the layer extent
+    :param list extent: Layer extent as [minx, miny, maxx, maxy] in east-north order
+    :param str service_version: Version of the document
+    :param str url: Url of the service
+    """
+    with open(path, 'w') as out:
+        out.write(capabilities_xml(service_type, layer_name, crs_code, extent,
+                                   service_version, url))
+
+
+def footprint_features(footprint):
+    """Split the footprint to polygons
+
+    :param shapely geometry footprint: Area with data
+
+    :return list: Polygons
+    """
+    if footprint.is_empty:
+        return []
+    if hasattr(footprint, 'geoms'):
+        return [geom for geom in footprint.geoms if not geom.is_empty]
+    return [footprint]
+
+
+def footprint_area_share(footprint, extent):
+    """Share of the extent covered by data
+
+    :param shapely geometry footprint: Area with data
+    :param list extent: Extent as [minx, miny, maxx, maxy]
+
+    :return float: Share between 0 and 1
+    """
+    area = (extent[2] - extent[0])*(extent[3] - extent[1])
+    if area <= 0 or math.isnan(area):
+        return 0.0
+    return footprint.intersection(box(*extent)).area/area
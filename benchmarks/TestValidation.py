@@ -0,0 +1,84 @@
+"""testvalidation.py
+
+Check WFS validation against the stub server: fetching the features
+in partitions must give the same validation raster as fetching the
+whole layer at once, whether or not the features have a gml:id.
+Needs GDAL, like validation itself.
+
+How to run:
+
+        $ cd benchmarks
+        $ python3 -m unittest TestValidation
+
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ResultData import RasterGrid
+from Synthetic import DEFAULT_EXTENTS, make_footprint
+from StubServer import StubServer
+
+try:
+    from Validate import ValidationOptions, fetch_real_data
+    VALIDATE_IMPORT_ERROR = None
+except ImportError as e:
+    VALIDATE_IMPORT_ERROR = str(e)
+
+LAYER_NAME = 'bench:layer'
+
+
+def get_grid(extent, crs_code, width=300):
+    """Create a raster grid of square pixels over an extent
+
+    :param list extent: Extent as [minx, miny, maxx, maxy] in east-north order
+    :param str crs_code: EPSG code of the grid
+    :param int width: Number of columns
+
+    :return RasterGrid: The grid
+    """
+    resolution = (extent[2] - extent[0])/width
+    height = int(round((extent[3] - extent[1])/resolution))
+    return RasterGrid(height, width, from_origin(extent[0], extent[3], resolution, resolution),
+                      crs_code)
+
+
+@unittest.skipIf(VALIDATE_IMPORT_ERROR, "validation is not available: {}"
+                 .format(VALIDATE_IMPORT_ERROR))
+class WfsPartitionTest(unittest.TestCase):
+
+    def check_partitions(self, crs_code, flip_features, feature_ids):
+        extent = DEFAULT_EXTENTS[crs_code]
+        grid = get_grid(extent, crs_code)
+        with StubServer(make_footprint('islands', extent), 'WFS', LAYER_NAME, crs_code, extent,
+                        feature_ids=feature_ids) as server:
+            results = [fetch_real_data(server.url, LAYER_NAME, crs_code, grid, 'WFS', '2.0.0',
+                                       None, ValidationOptions(wfs_partitions=partitions),
+                                       flip_features)
+                       for partitions in (0, 4)]
+
+        whole, partitioned = results
+        self.assertIsNotNone(whole)
+        self.assertIsNotNone(partitioned)
+        self.assertGreater(whole.sum(), 0)
+        np.testing.assert_array_equal(whole, partitioned)
+
+    def test_with_feature_ids(self):
+        self.check_partitions('EPSG:3067', False, True)
+
+    def test_without_feature_ids(self):
+        # OGR numbers the features of each connection from 1, so features
+        # of different partitions have the same FIDs.
+        self.check_partitions('EPSG:3067', False, False)
+
+    def test_geographic_without_feature_ids(self):
+        self.check_partitions('EPSG:4326', True, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
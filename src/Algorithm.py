@@ -8,10 +8,16 @@ of a service.
 
 import datetime
 import logging
+import tempfile
 import pdb
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
-import rasterio
-from rasterio import mask
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+
+from InputData import RequestTable
+from ResultData import write_raster, open_raster, get_tile_windows
 
 # logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
 logging.basicConfig(filename="../../output_data/logs/" \
@@ -19,55 +25,691 @@ logging.basicConfig(filename="../../output_data/logs/" \
                     + '.log', level=logging.INFO)
 
 
-def compute_density_rasters(features, empty_raster):
-    """Compute arrays of values based on features
+def get_pixel_ranges(bboxes, transform, height, width):
+    """Convert request bounding boxes to pixel row and column ranges
+
+    A pixel belongs to a request if its centre lies within the
+    request bounding box, which is the same rule rasterio uses
+    when masking a polygon without all_touched.
+
+    :param numpy array bboxes: Nx4 array of (minx, miny, maxx, maxy)
+                               in the coordinate order of the raster
+    :param Affine transform: Affine transformation matrix of the raster
+    :param int height: Height of the raster
+    :param int width: Width of the raster
+
+    :return:
+        numpy array row_start: First row covered by each request
+        numpy array row_stop: Row after the last row covered by each request
+        numpy array col_start: First column covered by each request
+        numpy array col_stop: Column after the last column covered by each request
+    """
+
+    cols = (bboxes[:, [0, 2]] - transform.c) / transform.a
+    rows = (bboxes[:, [1, 3]] - transform.f) / transform.e
+    cols.sort(axis=1)
+    rows.sort(axis=1)
+
+    # Pixel i has its centre at i + 0.5. GDAL includes centres lying
+    # exactly on the right edge, but not on the left edge. On rows
+    # centres on both edges are included.
+    col_start = np.clip(np.floor(cols[:, 0] - 0.5) + 1, 0, width).astype(np.int64)
+    col_stop = np.clip(np.floor(cols[:, 1] - 0.5) + 1, 0, width).astype(np.int64)
+    row_start = np.clip(np.ceil(rows[:, 0] - 0.5), 0, height).astype(np.int64)
+    row_stop = np.clip(np.floor(rows[:, 1] - 0.5) + 1, 0, height).astype(np.int64)
+
+    return row_start, row_stop, col_start, col_stop
+
+
+def accumulate_ranges(diff, row_start, row_stop, col_start, col_stop, weights=1, layers=None):
+    """Add rectangles of pixels to a 2D difference array
+
+    Each rectangle adds its weight to the upper left and lower right
+    corner and subtracts it from the two other corners. Cumulative
+    sums over both axes then give the value of every pixel.
+
+    :param numpy array diff: Difference array of shape (height + 1, width + 1),
+                             or (layers, height + 1, width + 1) if layers are given
+    :param numpy array row_start: First row of each rectangle
+    :param numpy array row_stop: Row after the last row of each rectangle
+    :param numpy array col_start: First column of each rectangle
+    :param numpy array col_stop: Column after the last column of each rectangle
+    :param weights: Weight of each rectangle; defaults to 1
+    :param numpy array layers: Layer of each rectangle in a 3D difference array;
+                               defaults to None
+    """
+
+    # Empty rectangles (outside of the raster) would cancel out anyway,
+    # but skipping them keeps the difference array clean.
+    keep = (row_start < row_stop) & (col_start < col_stop)
+    if not np.all(keep):
+        row_start, row_stop = row_start[keep], row_stop[keep]
+        col_start, col_stop = col_start[keep], col_stop[keep]
+        if not np.isscalar(weights):
+            weights = weights[keep]
+        if layers is not None:
+            layers = layers[keep]
+
+    index = () if layers is None else (layers,)
+    np.add.at(diff, index + (row_start, col_start), weights)
+    np.add.at(diff, index + (row_start, col_stop), np.negative(weights))
+    np.add.at(diff, index + (row_stop, col_start), np.negative(weights))
+    np.add.at(diff, index + (row_stop, col_stop), weights)
+
+
+def integrate_difference_array(diff):
+    """Turn a 2D difference array into pixel values
+
+    A 3D array is integrated layer by layer.
+
+    :param numpy array diff: Difference array of shape (height + 1, width + 1)
+                             or (layers, height + 1, width + 1)
+
+    :return numpy array: Pixel values of shape (height, width) or (layers, height, width)
+    """
+    np.cumsum(diff, axis=-2, out=diff)
+    np.cumsum(diff, axis=-1, out=diff)
+    return diff[..., :-1, :-1]
+
+
+# See solve
+THRESHOLD_CONSTANT = 0.02
+
+# Data types the density rasters can be accumulated in
+DENSITY_DTYPES = ('int16', 'int32', 'int64', 'float32', 'float64')
+
+# Wider data type used when a count might not fit in the configured one
+WIDER_DTYPES = {'int16': 'int32', 'int32': 'int64', 'float32': 'float64'}
+
+
+def get_count_limit(dtype):
+    """Get the largest count a data type holds exactly
+
+    :param str dtype: Name of the data type
+
+    :return int: The largest count
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 2**(np.finfo(dtype).nmant + 1)
+    return int(np.iinfo(dtype).max)
+
+
+def fit_dtype(dtype, request_count):
+    """Choose a data type which can hold the given number of requests
+
+    A pixel can't be covered by more requests than there are, so the
+    counts (and the intermediate sums of the difference arrays) fit if
+    the number of requests does.
+
+    :param str dtype: Configured data type
+    :param int request_count: Number of requests accumulated
+
+    :return str: The data type, or a wider one if needed
+    """
+    while request_count > get_count_limit(dtype) and dtype in WIDER_DTYPES:
+        logging.warning("{} requests might overflow {} density rasters, using {} instead"\
+                        .format(request_count, dtype, WIDER_DTYPES[dtype]))
+        dtype = WIDER_DTYPES[dtype]
+    return dtype
+
+
+# Decayed counts below this are treated as zero, see normalize_decayed_rasters
+DECAY_TOLERANCE = 2**-20
+
+# Weights are rescaled before they exceed 2**DECAY_RESCALE_LIMIT, see get_decay_reference
+DECAY_RESCALE_LIMIT = 256
+
+
+def get_decay_weights(request_time, reference_time, half_life):
+    """Weight requests by their age
+
+    A request made at reference_time has weight 1, a request made
+    half_life earlier has weight 0.5 and so on.
+
+    :param numpy array request_time: requestTime of the requests
+    :param int reference_time: requestTime with weight 1
+    :param float half_life: Half-life of the weights in requestTime units
+
+    :return numpy array: float64 weight of each request
+    """
+    return np.exp2((request_time - reference_time) / half_life)
+
+
+def get_decay_reference(reference_time, request_time, half_life):
+    """Choose the reference time of decay weights for a chunk of requests
+
+    The newest request of the first chunk is used as the reference. Newer
+    requests get weights above 1, so the reference is moved forward only
+    when the weights would become too large. The rasters accumulated so
+    far must then be multiplied by the returned factor.
+
+    :param int reference_time: Current reference time, None for the first chunk
+    :param numpy array request_time: requestTime of the requests in the chunk
+    :param float half_life: Half-life of the weights in requestTime units
+
+    :return:
+        int reference_time: Reference time for the chunk
+        float factor: Factor for the rasters accumulated so far
+    """
+    newest = int(request_time.max())
+    if reference_time is None:
+        return newest, 1.0
+    if newest - reference_time > DECAY_RESCALE_LIMIT*half_life:
+        return newest, float(np.exp2((reference_time - newest) / half_life))
+    return reference_time, 1.0
+
+
+def normalize_decayed_rasters(eval_raster, norm_raster, reference_time, newest_time, half_life):
+    """Rescale decayed density rasters so that the newest request has weight 1
+
+    Cumulative sums of the difference arrays leave rounding errors in
+    pixels without requests, so values smaller than DECAY_TOLERANCE are
+    set to zero. Requests older than about 20 half-lives don't count anyway.
+    The rasters are modified in place.
+
+    :param numpy array eval_raster: see compute_density_rasters
+    :param numpy array norm_raster: see compute_density_rasters
+    :param int reference_time: Time with weight 1 in the rasters
+    :param int newest_time: Time which should have weight 1
+    :param float half_life: Half-life of the weights in requestTime units
+    """
+    factor = np.exp2((reference_time - newest_time) / half_life)
+    for raster in (eval_raster, norm_raster):
+        if factor != 1:
+            raster *= factor
+        raster[np.abs(raster) < DECAY_TOLERANCE] = 0
+
+
+def compute_density_rasters(requests, grid, engine='diff', dtype='int32', workers=1,
+                            half_life=None):
+    """Compute arrays of values based on requests
 
     Compute two arrays. Eval_raster counts how many
     negative requests there were for a particular pixel.
     Norm_raster keeps count of the number of all valid
     requests for a pixel.
 
-    :param list features: Responses in GeoJson format
-    :param str empty_raster: Path to empty raster
+    Two engines are available. 'mask' masks every request
+    against the raster separately, which is slow for large
+    numbers of requests. 'diff' converts all bounding boxes to
+    pixel ranges at once and sums them using difference arrays.
+    Both produce the same rasters.
+
+    Requests can be given as one table or as an iterable of
+    tables, e.g. chunks streamed from the response file. Memory
+    use then depends on the raster size only.
+
+    Counts are kept in a compact data type. If there are more requests
+    than the data type can count, a wider type is used instead.
+
+    With more than one worker the requests are split across worker
+    processes, see compute_density_rasters_parallel.
+
+    If half_life is given, requests are weighted by their age with
+    get_decay_weights, so that recent requests count more than old ones.
+    The rasters then hold weighted counts in float64, where the newest
+    request has weight 1.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str engine: Accumulation engine, 'diff' or 'mask'; defaults to 'diff'
+    :param str dtype: Data type of the rasters, one of DENSITY_DTYPES;
+                      defaults to 'int32'
+    :param int workers: Number of worker processes; defaults to 1
+    :param float half_life: Half-life of the request weights in requestTime
+                            units (milliseconds); defaults to None, which
+                            means all requests have the same weight
     :return:
         numpy array eval_raster: see above
         numpy array norm_raster: see above
         int request_counter: number of requests
     """
 
-    open_raster = rasterio.open(empty_raster)
-    eval_raster = open_raster.read()
-    norm_raster = np.copy(eval_raster)
+    if engine not in ('diff', 'mask'):
+        raise Exception("Unknown density engine '{}'. Options: diff, mask".format(engine))
+
+    if dtype not in DENSITY_DTYPES:
+        raise Exception("Unknown density dtype '{}'. Options: {}"\
+                        .format(dtype, ", ".join(DENSITY_DTYPES)))
+
+    if isinstance(requests, RequestTable):
+        requests = [requests]
+
+    if half_life and dtype != 'float64':
+        logging.warning("Decayed weights are accumulated in float64 instead of {}".format(dtype))
+        dtype = 'float64'
+
+    if workers > 1:
+        if engine != 'diff':
+            logging.warning("Parallel accumulation always uses the diff engine")
+        return compute_density_rasters_parallel(requests, grid, dtype, workers, half_life)
+
+    request_counter = 0
+    reference_time = newest_time = None
+
+    if engine == 'diff':
+        logging.info("Accumulating requests with difference arrays...")
+        shape = (grid.height + 1, grid.width + 1)
+    else:
+        logging.info("Iterating through geojson objects...")
+        shape = (1, grid.height, grid.width)
+    # With the diff engine these are difference arrays until they are integrated.
+    eval_raster = np.zeros(shape, dtype=dtype)
+    norm_raster = np.zeros(shape, dtype=dtype)
+
+    for chunk in requests:
+        chunk_dtype = fit_dtype(dtype, request_counter + len(chunk))
+        if chunk_dtype != dtype:
+            dtype = chunk_dtype
+            eval_raster = eval_raster.astype(dtype)
+            norm_raster = norm_raster.astype(dtype)
+
+        weights = 1
+        if half_life and len(chunk) > 0:
+            reference_time, factor = get_decay_reference(reference_time, chunk.request_time,
+                                                         half_life)
+            if factor != 1:
+                eval_raster *= factor
+                norm_raster *= factor
+            newest_time = max(int(chunk.request_time.max()), newest_time or reference_time)
+            weights = get_decay_weights(chunk.request_time, reference_time, half_life)
+
+        if engine == 'diff':
+            accumulate_density_diff(eval_raster, norm_raster, chunk, grid.transform, weights)
+        else:
+            accumulate_density_mask(eval_raster, norm_raster, chunk.to_geojson(),
+                                    grid, request_counter, weights)
+        request_counter += len(chunk)
+
+    if engine == 'diff':
+        # Pixel values are computed in place, the rasters are views of the difference arrays.
+        norm_raster = integrate_difference_array(norm_raster)[np.newaxis]
+        eval_raster = integrate_difference_array(eval_raster)[np.newaxis]
+        np.negative(eval_raster, out=eval_raster)
+
+    if reference_time is not None:
+        normalize_decayed_rasters(eval_raster, norm_raster, reference_time, newest_time,
+                                  half_life)
+
+    return eval_raster, norm_raster, request_counter
+
+
+def classify_results(results):
+    """Find positive and negative image analysis results
+
+    Requests with unexpected values are neither, and they are logged.
+
+    :param numpy array results: imageAnalysisResult of the requests
+
+    :return:
+        numpy array positive: True for requests with data
+        numpy array negative: True for requests without data
+    """
+    positive = results == 1
+    negative = (results == 0) | (results == -1)
+    unexpected = ~(positive | negative)
+    if np.any(unexpected):
+        logging.warning("unexpected imageTestResult values: {}" \
+                        .format(np.unique(results[unexpected])))
+        logging.warning("{} requests with unexpected values skipped" \
+                        .format(np.count_nonzero(unexpected)))
+    return positive, negative
+
+
+def accumulate_density_diff(eval_diff, norm_diff, requests, transform, weights=1):
+    """Add requests to the difference arrays of the density rasters
+
+    Eval_diff counts negative requests (as positive numbers),
+    norm_diff all valid requests. See compute_density_rasters.
+
+    :param numpy array eval_diff: Difference array of negative requests
+    :param numpy array norm_diff: Difference array of all valid requests
+    :param RequestTable requests: Valid requests within the layer
+    :param Affine transform: Affine transformation matrix of the raster
+    :param weights: Weight of each request; defaults to 1
+    """
+
+    accumulate_bboxes_diff(eval_diff, norm_diff, requests.bboxes,
+                           requests.image_analysis_result, transform, weights)
+
+
+def accumulate_bboxes_diff(eval_diff, norm_diff, bboxes, results, transform, weights=1,
+                           layers=None):
+    """Add request bounding boxes to the difference arrays of the density rasters
+
+    See accumulate_density_diff.
+
+    :param numpy array eval_diff: Difference array of negative requests
+    :param numpy array norm_diff: Difference array of all valid requests
+    :param numpy array bboxes: Nx4 array of request bounding boxes
+    :param numpy array results: imageAnalysisResult of the requests
+    :param Affine transform: Affine transformation matrix of the raster
+    :param weights: Weight of each request; defaults to 1
+    :param numpy array layers: Layer of each request in 3D difference arrays,
+                               see accumulate_ranges; defaults to None
+    """
+
+    positive, negative = classify_results(results)
+
+    row_start, row_stop, col_start, col_stop = get_pixel_ranges(
+        bboxes, transform, norm_diff.shape[-2] - 1, norm_diff.shape[-1] - 1)
+
+    valid = positive | negative
+    accumulate_ranges(norm_diff, row_start[valid], row_stop[valid],
+                      col_start[valid], col_stop[valid],
+                      weights if np.isscalar(weights) else weights[valid],
+                      None if layers is None else layers[valid])
+    accumulate_ranges(eval_diff, row_start[negative], row_stop[negative],
+                      col_start[negative], col_stop[negative],
+                      weights if np.isscalar(weights) else weights[negative],
+                      None if layers is None else layers[negative])
+
+
+def create_shared_array(shape, dtype):
+    """Allocate a zero filled array in shared memory
+
+    :param tuple shape: Shape of the array
+    :param str dtype: Data type of the array
+
+    :return:
+        SharedMemory shm: The memory block; the caller closes and unlinks it
+        tuple spec: (name, shape, dtype) for attach_shared_array
+    """
+    size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    # New blocks are zero filled by the operating system.
+    return shm, (shm.name, tuple(shape), dtype)
+
+
+def attach_shared_array(spec):
+    """Open an array created by create_shared_array
+
+    :param tuple spec: (name, shape, dtype) of the array
+
+    :return:
+        SharedMemory shm: The memory block; the caller closes it
+        numpy array array: The array
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# The worker functions below close the shared memory only when they succeed.
+# If they fail, the arrays may still be referenced by the traceback, and the
+# memory is released when the pool shuts down. The blocks are always unlinked
+# by compute_density_rasters_parallel.
+
+def accumulate_partial(partial_spec, bboxes_spec, results_spec, start, stop, transform,
+                       weights_spec=None):
+    """Add a slice of requests to the partial difference arrays of one worker
+
+    :param tuple partial_spec: Shared 2x(height + 1)x(width + 1) array
+                               of eval and norm difference arrays
+    :param tuple bboxes_spec: Shared Nx4 array of request bounding boxes
+    :param tuple results_spec: Shared imageAnalysisResult of the requests
+    :param int start: First request of the slice
+    :param int stop: Request after the last request of the slice
+    :param Affine transform: Affine transformation matrix of the raster
+    :param tuple weights_spec: Shared weights of the requests; defaults to None,
+                               which means weight 1
+    """
+    partial_shm, partial = attach_shared_array(partial_spec)
+    bboxes_shm, bboxes = attach_shared_array(bboxes_spec)
+    results_shm, results = attach_shared_array(results_spec)
+    shms = [partial_shm, bboxes_shm, results_shm]
+    weights = 1
+    if weights_spec is not None:
+        weights_shm, weights = attach_shared_array(weights_spec)
+        shms.append(weights_shm)
+        weights = weights[start:stop]
+
+    accumulate_bboxes_diff(partial[0], partial[1], bboxes[start:stop],
+                           results[start:stop], transform, weights)
+
+    del partial, bboxes, results, weights
+    for shm in shms:
+        shm.close()
+
+
+def reduce_partials(partial_specs, start, stop):
+    """Sum rows of the partial difference arrays into the first one
+
+    The rows are integrated along the columns at the same time, see
+    integrate_partials.
+
+    :param list partial_specs: Shared partial arrays of every worker
+    :param int start: First row to reduce
+    :param int stop: Row after the last row to reduce
+    """
+    shms, partials = zip(*[attach_shared_array(spec) for spec in partial_specs])
+
+    target = partials[0][:, start:stop]
+    for i in range(1, len(partials)):
+        target += partials[i][:, start:stop]
+    np.cumsum(target, axis=2, out=target)
+
+    del target, partials
+    for shm in shms:
+        shm.close()
+
+
+def integrate_partials(partial_spec, start, stop):
+    """Integrate columns of the reduced difference arrays along the rows
+
+    :param tuple partial_spec: Shared array reduced by reduce_partials
+    :param int start: First column to integrate
+    :param int stop: Column after the last column to integrate
+    """
+    shm, partial = attach_shared_array(partial_spec)
+
+    target = partial[:, :, start:stop]
+    np.cumsum(target, axis=1, out=target)
+
+    del target, partial
+    shm.close()
+
+
+def get_bands(size, workers):
+    """Split a range of rows or columns to one band per worker
+
+    :param int size: Number of rows or columns
+    :param int workers: Number of workers
+
+    :return list: (start, stop) of the bands
+    """
+    bounds = np.linspace(0, size, workers + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+
+
+def compute_density_rasters_parallel(requests, grid, dtype, workers, half_life=None):
+    """Compute the density rasters in several worker processes
+
+    Every chunk of requests is split evenly across the workers. Each
+    worker adds its requests to its own partial difference arrays,
+    which are kept in shared memory. The partial arrays are then
+    summed and integrated in bands of rows and columns, also in parallel.
+
+    Memory use is about workers times the size of the difference arrays.
+
+    :param requests: Iterable of RequestTables with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str dtype: Data type of the rasters, one of DENSITY_DTYPES
+    :param int workers: Number of worker processes
+    :param float half_life: Half-life of the request weights, see compute_density_rasters
+
+    :return: see compute_density_rasters
+    """
+
+    logging.info("Accumulating requests with difference arrays in {} processes..."\
+                 .format(workers))
+    shape = (2, grid.height + 1, grid.width + 1)
     request_counter = 0
-    logging.info("Iterating through geojson objects...")
+    reference_time = newest_time = None
+    partials = []
+    chunk_shms = []
+
+    try:
+        partials = [create_shared_array(shape, dtype) for _ in range(workers)]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk in requests:
+                chunk_dtype = fit_dtype(dtype, request_counter + len(chunk))
+                if chunk_dtype != dtype:
+                    dtype = chunk_dtype
+                    partials = widen_shared_arrays(partials, dtype)
+
+                columns = [np.ascontiguousarray(chunk.bboxes, dtype=np.float64),
+                           np.ascontiguousarray(chunk.image_analysis_result)]
+                if half_life and len(chunk) > 0:
+                    reference_time, factor = get_decay_reference(reference_time,
+                                                                 chunk.request_time, half_life)
+                    if factor != 1:
+                        for shm, (_, partial_shape, partial_dtype) in partials:
+                            np.ndarray(partial_shape, dtype=partial_dtype,
+                                       buffer=shm.buf)[...] *= factor
+                    newest_time = max(int(chunk.request_time.max()),
+                                      newest_time or reference_time)
+                    columns.append(get_decay_weights(chunk.request_time, reference_time,
+                                                     half_life))
+                chunk_specs = []
+                for column in columns:
+                    shm, spec = create_shared_array(column.shape, column.dtype.str)
+                    chunk_shms.append(shm)
+                    np.ndarray(column.shape, dtype=column.dtype, buffer=shm.buf)[...] = column
+                    chunk_specs.append(spec)
+
+                weights_spec = chunk_specs[2] if len(chunk_specs) > 2 else None
+                futures = [executor.submit(accumulate_partial, spec, chunk_specs[0],
+                                           chunk_specs[1], start, stop, grid.transform,
+                                           weights_spec)
+                           for (_, spec), (start, stop)
+                           in zip(partials, get_bands(len(chunk), workers))]
+                for future in futures:
+                    future.result()
+
+                for shm in chunk_shms:
+                    shm.close()
+                    shm.unlink()
+                chunk_shms = []
+                request_counter += len(chunk)
+
+            partial_specs = [spec for _, spec in partials]
+            futures = [executor.submit(reduce_partials, partial_specs, start, stop)
+                       for start, stop in get_bands(shape[1], workers)]
+            for future in futures:
+                future.result()
+            futures = [executor.submit(integrate_partials, partial_specs[0], start, stop)
+                       for start, stop in get_bands(shape[2], workers)]
+            for future in futures:
+                future.result()
+
+        reduced = np.ndarray(shape, dtype=dtype, buffer=partials[0][0].buf)
+        eval_raster = np.negative(reduced[0, :-1, :-1])[np.newaxis]
+        norm_raster = reduced[1, :-1, :-1].copy()[np.newaxis]
+        del reduced
+    finally:
+        for shm in chunk_shms + [shm for shm, _ in partials]:
+            shm.close()
+            shm.unlink()
+
+    if reference_time is not None:
+        normalize_decayed_rasters(eval_raster, norm_raster, reference_time, newest_time,
+                                  half_life)
+
+    return eval_raster, norm_raster, request_counter
+
 
-    for feat in features['features']:
+def widen_shared_arrays(partials, dtype):
+    """Copy shared partial arrays to a wider data type
+
+    :param list partials: (SharedMemory, spec) of each array; these are released
+    :param str dtype: The new data type
+
+    :return list: (SharedMemory, spec) of the new arrays
+    """
+    widened = []
+    try:
+        for shm, (name, shape, old_dtype) in partials:
+            new_shm, spec = create_shared_array(shape, dtype)
+            widened.append((new_shm, spec))
+            np.ndarray(shape, dtype=dtype, buffer=new_shm.buf)[...] = \
+                np.ndarray(shape, dtype=old_dtype, buffer=shm.buf)
+    except Exception:
+        for new_shm, _ in widened:
+            new_shm.close()
+            new_shm.unlink()
+        raise
+    for shm, _ in partials:
+        shm.close()
+        shm.unlink()
+    return widened
+
+
+def accumulate_density_mask(eval_raster, norm_raster, features, grid, request_counter=0,
+                            weights=1):
+    """Add requests to the density rasters by masking every request separately
+
+    See compute_density_rasters.
+
+    :param numpy array eval_raster: see compute_density_rasters
+    :param numpy array norm_raster: see compute_density_rasters
+    :param list features: Responses in GeoJson format
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param int request_counter: Number of requests handled before these
+    :param weights: Weight of each request; defaults to 1
+    """
+
+    for i, feat in enumerate(features['features']):
+        weight = weights if np.isscalar(weights) else weights[i]
         request_counter += 1
         if request_counter % 1000 == 0:
             logging.debug("Feature no. {}".format(request_counter))
-        mask = rasterio.mask.raster_geometry_mask(open_raster, [feat['geometry']],
-                                                  crop=False, invert=True)[0]
+        mask = geometry_mask([feat['geometry']], out_shape=(grid.height, grid.width),
+                             transform=grid.transform, invert=True)
 
         props = feat['properties']
         if props['imageAnalysisResult'] == 1:
-            norm_raster[0][mask] += 1
+            norm_raster[0][mask] += weight
         elif (props['imageAnalysisResult'] == 0 or props['imageAnalysisResult'] == -1):
-            norm_raster[0][mask] += 1
-            eval_raster[0][mask] -= 1
+            norm_raster[0][mask] += weight
+            eval_raster[0][mask] -= weight
         else:
             logging.warning("unexpected imageTestResult value: {}" \
                             .format(props['imageAnalysisResult']))
             logging.warning(feat)
 
 
-    return eval_raster, norm_raster, request_counter
+def get_binary_raster(eval_raster, norm_raster, threshold_constant=THRESHOLD_CONSTANT):
+    """Interpret pixels as data or non-data areas
 
-def solve(features, empty_raster, bin_output_path):
-    """Write resulting binary raster to disk
+    A pixel has data if its eval_raster value is above the threshold,
+    which is the average of eval_raster times threshold_constant.
+    Pixels without any requests have no data.
+
+    :param numpy array eval_raster: see compute_density_rasters
+    :param numpy array norm_raster: see compute_density_rasters
+    :param float threshold_constant: see solve; defaults to THRESHOLD_CONSTANT
+
+    :return numpy array binary_raster: 2D uint8 array, 1 means data
+    """
+    threshold = np.average(eval_raster)*threshold_constant
+    logging.debug("threshold is: {}".format(threshold))
+    binary_raster = eval_raster[0] > threshold
+    binary_raster[norm_raster[0] == 0] = False
+    return binary_raster.astype(np.uint8)
+
+
+def solve(requests, grid, bin_output_path=None, engine='diff', dtype='int32', tile_size=None,
+          workers=1, density=None, half_life=None):
+    """Produce resulting binary raster
 
     Produce resulting binary raster whose values are
     set to True when the normalized value of eval_raster
-    is above a threshold. Write raster to disk.
+    is above a threshold. Write raster to disk if a path
+    is given.
     
     :const int THRESHOLD_CONSTANT: constant used for computing
     the threshold. Not finding a reliable and robust way to base
@@ -76,61 +718,714 @@ def solve(features, empty_raster, bin_output_path):
     positive and false negative pixels when comparing against the
     actual service data in validation.
 
-    :param list features: Responses in GeoJson format
-    :param str empty_raster: Path to empty raster
-    :param str bin_output_path: Path to store resulting raster
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str bin_output_path: Path to store resulting raster; defaults to None,
+                                which means the raster is not written
+    :param str engine: Accumulation engine, see compute_density_rasters
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+    :param int tile_size: If given, the raster is processed in tiles of this size
+                          (in pixels), see solve_tiled; defaults to None
+    :param int workers: Number of worker processes, see compute_density_rasters
+    :param tuple density: Density rasters and request count computed earlier by
+                          compute_density_rasters; requests are not used then.
+                          Not used with tile_size. Defaults to None
+    :param float half_life: Half-life of the request weights, see compute_density_rasters.
+                            Not supported by tiled processing. Defaults to None
 
+    :return numpy array binary_raster: 2D uint8 array, 1 means data
     """
 
-    eval_raster, norm_raster, request_counter = compute_density_rasters(features, empty_raster)
-    open_raster = rasterio.open(empty_raster)
-    # Divide eval_raster by norm_raster to get values normalized by the number of requests
-    np.divide(eval_raster, norm_raster,
-              out=np.zeros_like(eval_raster),
-              where=norm_raster != 0)
+    if tile_size and half_life:
+        logging.warning("Tiled processing doesn't support decay weights, tile_size not used")
+    elif tile_size:
+        if engine != 'diff':
+            logging.warning("Tiled processing always uses the diff engine")
+        if workers > 1:
+            logging.warning("Tiled processing runs in one process")
+        return solve_tiled(requests, grid, tile_size, bin_output_path, dtype)
 
+    if density is None:
+        density = compute_density_rasters(requests, grid, engine, dtype, workers, half_life)
+    eval_raster, norm_raster, request_counter = density
 
-    zero_mask = norm_raster[0] == 0
     logging.info("there was {} requests included in the analysis".format(request_counter))
-    
-    '''# Save the image into disk.
-    img_output = rasterio.open(
-        "../../output_data/eval_raster.tif",
-        'w',
-        driver='GTiff',
-        nodata=99,
-        height=open_raster.height,
-        width = open_raster.width,
-        count=1,
-        dtype = open_raster.dtypes[0],
-        crs=open_raster.crs,
-        transform=open_raster.transform)
-    img_output.write(eval_raster)
-    img_output.close()'''
 
     logging.info("request_counter: {}".format(request_counter))
     logging.debug("norm average: {}".format(np.average(norm_raster)))
 
-    THRESHOLD_CONSTANT = 0.02
-    threshold = np.average(eval_raster)*THRESHOLD_CONSTANT
-    logging.debug("threshold is: {}".format(threshold))
-    binary_raster = eval_raster > threshold
-    binary_raster[0][zero_mask] = False
+    binary_raster = get_binary_raster(eval_raster, norm_raster)
 
     # Save the image into disk.
-    bin_output = rasterio.open(
-        bin_output_path,
-        'w',
-        nbits=1,
-        driver='GTiff',
-        nodata=99,
-        height=open_raster.height,
-        width=open_raster.width,
-        count=1,
-        dtype='uint8',
-        crs=open_raster.crs,
-        transform=open_raster.transform)
-    bin_output.write(binary_raster.astype(np.uint8))
-    bin_output.close()
+    if bin_output_path:
+        write_raster(bin_output_path, binary_raster, grid, nodata=99, nbits=1)
+
+    logging.info("Algorithm finished, binary raster created.")
+
+    return binary_raster
+
+
+def collect_pixel_ranges(requests, grid):
+    """Convert valid requests to pixel ranges
+
+    Only requests covering at least one pixel are kept.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+
+    :return:
+        tuple ranges: Arrays row_start, row_stop, col_start and col_stop,
+                      see get_pixel_ranges
+        numpy array negative: True for requests without data
+        int request_counter: Number of requests
+    """
+    if isinstance(requests, RequestTable):
+        requests = [requests]
+
+    parts = []
+    request_counter = 0
+    for chunk in requests:
+        positive, negative = classify_results(chunk.image_analysis_result)
+        ranges = get_pixel_ranges(chunk.bboxes, grid.transform, grid.height, grid.width)
+        row_start, row_stop, col_start, col_stop = ranges
+        keep = (positive | negative) & (row_start < row_stop) & (col_start < col_stop)
+        parts.append([values[keep] for values in ranges] + [negative[keep]])
+        request_counter += len(chunk)
+
+    if not parts:
+        parts.append([np.zeros(0, dtype=np.int64)]*4 + [np.zeros(0, dtype=bool)])
+
+    columns = [np.concatenate(column) for column in zip(*parts)]
+    return tuple(columns[:4]), columns[4], request_counter
+
+
+def assign_to_tiles(ranges, grid, tile_size):
+    """Find the tiles each request overlaps
+
+    Every request is listed once for each tile it overlaps, and the
+    list is sorted by tile. Tiles are numbered row by row as in
+    get_tile_windows.
+
+    :param tuple ranges: Pixel ranges of the requests, see collect_pixel_ranges
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param int tile_size: Side length of a tile in pixels
+
+    :return:
+        numpy array requests: Indices of the requests sorted by tile
+        numpy array bounds: Requests of tile i are requests[bounds[i]:bounds[i + 1]]
+    """
+    row_start, row_stop, col_start, col_stop = ranges
+    tile_cols = -(-grid.width // tile_size)
+    tile_count = -(-grid.height // tile_size)*tile_cols
+
+    first_row = row_start // tile_size
+    first_col = col_start // tile_size
+    row_count = (row_stop - 1) // tile_size - first_row + 1
+    col_count = (col_stop - 1) // tile_size - first_col + 1
+    tiles_per_request = row_count*col_count
+
+    # Expand each request to one item per overlapped tile.
+    requests = np.repeat(np.arange(len(row_start)), tiles_per_request)
+    offsets = np.arange(len(requests)) - np.repeat(np.cumsum(tiles_per_request)
+                                                   - tiles_per_request, tiles_per_request)
+    tiles = (first_row[requests] + offsets // col_count[requests])*tile_cols \
+            + first_col[requests] + offsets % col_count[requests]
+
+    order = np.argsort(tiles, kind='stable')
+    bounds = np.searchsorted(tiles[order], np.arange(tile_count + 1))
+    return requests[order], bounds
+
+
+def solve_tile(ranges, negative, index, window, threshold, dtype='int32'):
+    """Produce the binary raster of one tile
+
+    :param tuple ranges: Pixel ranges of the requests, see collect_pixel_ranges
+    :param numpy array negative: True for requests without data
+    :param numpy array index: Indices of the requests overlapping the tile,
+                              see assign_to_tiles
+    :param Window window: The tile
+    :param float threshold: Threshold of eval_raster, see get_binary_raster
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+
+    :return numpy array: 2D uint8 array of the shape of the tile, 1 means data
+    """
+    row_start, row_stop, col_start, col_stop = ranges
+    tile_dtype = fit_dtype(dtype, len(index))
+    diff_shape = (window.height + 1, window.width + 1)
+    eval_diff = np.zeros(diff_shape, dtype=tile_dtype)
+    norm_diff = np.zeros(diff_shape, dtype=tile_dtype)
+
+    # Ranges relative to the tile
+    tile_ranges = [np.clip(row_start[index] - window.row_off, 0, window.height),
+                   np.clip(row_stop[index] - window.row_off, 0, window.height),
+                   np.clip(col_start[index] - window.col_off, 0, window.width),
+                   np.clip(col_stop[index] - window.col_off, 0, window.width)]
+    accumulate_ranges(norm_diff, *tile_ranges)
+    tile_negative = negative[index]
+    accumulate_ranges(eval_diff, *[values[tile_negative] for values in tile_ranges])
+
+    norm_tile = integrate_difference_array(norm_diff)
+    eval_tile = integrate_difference_array(eval_diff)
+    np.negative(eval_tile, out=eval_tile)
+
+    binary_tile = (eval_tile > threshold) & (norm_tile != 0)
+    return binary_tile.astype(np.uint8)
+
+
+def get_tiled_threshold(ranges, negative, grid):
+    """Compute the threshold of get_binary_raster without the eval_raster
+
+    The average of eval_raster is the total area of negative requests
+    (in pixels) divided by the number of pixels.
+
+    :param tuple ranges: Pixel ranges of the requests, see collect_pixel_ranges
+    :param numpy array negative: True for requests without data
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+
+    :return float: The threshold
+    """
+    row_start, row_stop, col_start, col_stop = ranges
+    negative_area = np.sum((row_stop[negative] - row_start[negative])
+                           * (col_stop[negative] - col_start[negative]))
+    threshold = -int(negative_area)/(grid.height*grid.width)*THRESHOLD_CONSTANT
+    logging.debug("threshold is: {}".format(threshold))
+    return threshold
+
+
+def solve_tiled(requests, grid, tile_size, bin_output_path=None, dtype='int32'):
+    """Produce resulting binary raster tile by tile
+
+    Gives the same result as solve, but the density rasters are
+    computed for one tile at a time, using only the requests which
+    overlap the tile. Memory needed for the density rasters is
+    then bounded by the tile size. The threshold needs the average
+    of the whole eval_raster, which is the total area of negative
+    requests (in pixels) divided by the number of pixels.
+
+    Tiles are processed one row of tiles at a time. The pixel ranges
+    of all requests are kept (33 bytes per request), and the requests
+    overlapping the current row of tiles are listed once per tile they
+    overlap in it, see assign_to_tiles.
+
+    The binary raster is kept in a temporary file mapped to memory,
+    so written tiles don't need to stay in memory. If a path is given,
+    it is also written to the GeoTIFF one tile at a time.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param int tile_size: Side length of a tile in pixels
+    :param str bin_output_path: Path to store resulting raster; defaults to None,
+                                which means the raster is not written
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+
+    :return numpy memmap binary_raster: 2D uint8 array, 1 means data
+    """
+    if dtype not in DENSITY_DTYPES:
+        raise Exception("Unknown density dtype '{}'. Options: {}"\
+                        .format(dtype, ", ".join(DENSITY_DTYPES)))
+
+    ranges, negative, request_counter = collect_pixel_ranges(requests, grid)
+    logging.info("there was {} requests included in the analysis".format(request_counter))
+
+    threshold = get_tiled_threshold(ranges, negative, grid)
+    row_start, row_stop, col_start, col_stop = ranges
+
+    with tempfile.TemporaryFile() as binary_file:
+        binary_raster = np.memmap(binary_file, dtype=np.uint8, mode='w+',
+                                  shape=(grid.height, grid.width))
+    dataset = None
+    if bin_output_path:
+        options = {}
+        if tile_size % 16 == 0:
+            options = {'tiled': True, 'blockxsize': tile_size, 'blockysize': tile_size}
+        dataset = open_raster(bin_output_path, grid, 'uint8', nodata=99, nbits=1, **options)
+
+    tile_count = 0
+    try:
+        for band_start in range(0, grid.height, tile_size):
+            # One row of tiles; only the shape of band_grid is used.
+            band_grid = grid._replace(height=min(tile_size, grid.height - band_start))
+            in_band = np.flatnonzero((row_start < band_start + band_grid.height)
+                                     & (row_stop > band_start))
+            band_ranges = (np.clip(row_start[in_band] - band_start, 0, band_grid.height),
+                           np.clip(row_stop[in_band] - band_start, 0, band_grid.height),
+                           col_start[in_band], col_stop[in_band])
+            band_negative = negative[in_band]
+
+            tile_requests, bounds = assign_to_tiles(band_ranges, band_grid, tile_size)
+            for tile, window in enumerate(get_tile_windows(band_grid, tile_size)):
+                index = tile_requests[bounds[tile]:bounds[tile + 1]]
+                binary_tile = solve_tile(band_ranges, band_negative, index, window, threshold,
+                                         dtype)
+                window = Window(window.col_off, window.row_off + band_start, window.width,
+                                window.height)
+                binary_raster[window.toslices()] = binary_tile
+                if dataset is not None:
+                    dataset.write(binary_tile, 1, window=window)
+                tile_count += 1
+    finally:
+        if dataset is not None:
+            dataset.close()
+            logging.info("Raster written to {}".format(bin_output_path))
+
+    logging.info("Processed {} tiles of {} pixels".format(tile_count, tile_size))
+    logging.info("Algorithm finished, binary raster created.")
+
+    return binary_raster
+
+
+# Default side length of the tiles recomputed on each refinement level; in pixels
+REFINE_TILE_SIZE = 256
+
+
+def collect_bboxes(requests):
+    """Collect the bounding boxes of valid requests
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+
+    :return:
+        numpy array bboxes: Nx4 array of (minx, miny, maxx, maxy)
+        numpy array negative: True for requests without data
+        int request_counter: Number of requests
+    """
+    if isinstance(requests, RequestTable):
+        requests = [requests]
+
+    bboxes = [np.zeros((0, 4))]
+    negative = [np.zeros(0, dtype=bool)]
+    request_counter = 0
+    for chunk in requests:
+        chunk_positive, chunk_negative = classify_results(chunk.image_analysis_result)
+        keep = chunk_positive | chunk_negative
+        bboxes.append(chunk.bboxes[keep])
+        negative.append(chunk_negative[keep])
+        request_counter += len(chunk)
+
+    return np.concatenate(bboxes), np.concatenate(negative), request_counter
+
+
+def get_finer_grid(grid):
+    """Define the grid with half the pixel size
+
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+
+    :return RasterGrid: Grid with the same origin and twice the shape
+    """
+    return grid._replace(height=grid.height*2, width=grid.width*2,
+                         transform=grid.transform*grid.transform.scale(0.5))
+
+
+def get_boundary_pixels(binary_raster):
+    """Find pixels with a neighbour of a different value
+
+    :param numpy array binary_raster: 2D array
+
+    :return numpy array: 2D boolean array, True if one of the
+                         8 neighbours differs from the pixel
+    """
+    height, width = binary_raster.shape
+    padded = np.pad(binary_raster, 1, mode='edge')
+    boundary = np.zeros((height, width), dtype=bool)
+    for row in range(3):
+        for col in range(3):
+            boundary |= padded[row:row + height, col:col + width] != binary_raster
+    return boundary
+
+
+def get_active_tiles(mask, tile_size):
+    """Find tiles with at least one pixel set
+
+    :param numpy array mask: 2D boolean array
+    :param int tile_size: Side length of a tile in pixels
+
+    :return numpy array: 2D boolean array with one value per tile,
+                         in the order of get_tile_windows
+    """
+    rows = np.logical_or.reduceat(mask, np.arange(0, mask.shape[0], tile_size), axis=0)
+    return np.logical_or.reduceat(rows, np.arange(0, mask.shape[1], tile_size), axis=1)
+
+
+def overlaps_tiles(ranges, tiles, tile_size):
+    """Find requests overlapping at least one of the given tiles
+
+    :param tuple ranges: Pixel ranges of the requests, see collect_pixel_ranges
+    :param numpy array tiles: 2D boolean array of tiles, see get_active_tiles
+    :param int tile_size: Side length of a tile in pixels
+
+    :return numpy array: True for requests overlapping a tile
+    """
+    row_start, row_stop, col_start, col_stop = ranges
+    # Summed-area table of the tiles
+    table = np.zeros((tiles.shape[0] + 1, tiles.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = tiles.cumsum(axis=0).cumsum(axis=1)
+
+    first_row = row_start // tile_size
+    first_col = col_start // tile_size
+    last_row = (row_stop - 1) // tile_size + 1
+    last_col = (col_stop - 1) // tile_size + 1
+    count = table[last_row, last_col] - table[first_row, last_col] \
+            - table[last_row, first_col] + table[first_row, first_col]
+    return count > 0
+
+
+def solve_refined(requests, grid, levels, bin_output_path=None, dtype='int32',
+                  tile_size=REFINE_TILE_SIZE):
+    """Produce a binary raster with fine resolution on the boundaries of data
+
+    The binary raster is first computed as in solve with the resolution
+    of the grid. On each refinement level the pixel size is halved, and
+    only the pixels on the boundary between data and no data on the
+    previous level are computed again. Other pixels keep the value of
+    the coarser pixel they are part of. Computing is done in tiles as in
+    solve_tiled, for the tiles with boundary pixels and the requests
+    which overlap them. The threshold of each level is the same as it
+    would be for the whole raster of that level.
+
+    The result is close to running solve with the finest resolution.
+    It differs where data and no data alternate on a scale smaller than
+    the pixels of a coarser level. Only the binary raster of the finest
+    level is kept for the whole layer.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the coarsest raster
+    :param int levels: Number of refinement levels
+    :param str bin_output_path: Path to store resulting raster; defaults to None,
+                                which means the raster is not written
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+    :param int tile_size: Side length of the tiles computed again on each level;
+                          defaults to REFINE_TILE_SIZE
+
+    :return:
+        RasterGrid grid: Grid of the finest level
+        numpy array binary_raster: 2D uint8 array of the finest level, 1 means data
+    """
+    if dtype not in DENSITY_DTYPES:
+        raise Exception("Unknown density dtype '{}'. Options: {}"\
+                        .format(dtype, ", ".join(DENSITY_DTYPES)))
+
+    bboxes, negative, request_counter = collect_bboxes(requests)
+    logging.info("there was {} requests included in the analysis".format(request_counter))
+
+    binary_raster = np.zeros((grid.height, grid.width), dtype=np.uint8)
+    refine = np.ones((grid.height, grid.width), dtype=bool)
+    for level in range(levels + 1):
+        if level > 0:
+            refine = get_boundary_pixels(binary_raster)
+            refine = np.repeat(np.repeat(refine, 2, axis=0), 2, axis=1)
+            binary_raster = np.repeat(np.repeat(binary_raster, 2, axis=0), 2, axis=1)
+            grid = get_finer_grid(grid)
+
+        ranges = get_pixel_ranges(bboxes, grid.transform, grid.height, grid.width)
+        keep = (ranges[0] < ranges[1]) & (ranges[2] < ranges[3])
+        ranges = tuple(values[keep] for values in ranges)
+        level_negative = negative[keep]
+        threshold = get_tiled_threshold(ranges, level_negative, grid)
+
+        active = get_active_tiles(refine, tile_size)
+        inside = overlaps_tiles(ranges, active, tile_size)
+        ranges = tuple(values[inside] for values in ranges)
+        level_negative = level_negative[inside]
+
+        tile_requests, bounds = assign_to_tiles(ranges, grid, tile_size)
+        windows = get_tile_windows(grid, tile_size)
+        for tile in np.flatnonzero(active):
+            window = windows[tile]
+            index = tile_requests[bounds[tile]:bounds[tile + 1]]
+            binary_tile = solve_tile(ranges, level_negative, index, window, threshold, dtype)
+            np.copyto(binary_raster[window.toslices()], binary_tile,
+                      where=refine[window.toslices()])
+
+        logging.info("Refinement level {} of size {}, {}: {} pixels in {} tiles computed"\
+                     .format(level, grid.height, grid.width, np.count_nonzero(refine),
+                             np.count_nonzero(active)))
+
+    if bin_output_path:
+        write_raster(bin_output_path, binary_raster, grid, nodata=99, nbits=1)
 
     logging.info("Algorithm finished, binary raster created.")
+
+    return grid, binary_raster
+
+def sum_blocks(raster):
+    """Sum 2x2 blocks of pixels
+
+    A raster with an odd height or width is padded with zeros.
+
+    :param numpy array raster: Array of shape (1, height, width)
+
+    :return numpy array: Array of shape (1, ceil(height/2), ceil(width/2))
+    """
+    _, height, width = raster.shape
+    padded = np.pad(raster[0], ((0, height % 2), (0, width % 2)), mode='constant')
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    return blocks.sum(axis=(1, 3), dtype=raster.dtype)[np.newaxis]
+
+
+def get_coarser_grid(grid):
+    """Define the grid with twice the pixel size
+
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+
+    :return RasterGrid: Grid with the same origin and half the shape
+    """
+    return grid._replace(height=-(-grid.height // 2), width=-(-grid.width // 2),
+                         transform=grid.transform*grid.transform.scale(2))
+
+
+def solve_pyramid(requests, grid, levels, bin_output_paths=None, engine='diff', dtype='int32',
+                  workers=1, density=None, half_life=None):
+    """Produce binary rasters in several resolutions
+
+    Density rasters are computed once with the resolution of the
+    grid. Each coarser level doubles the pixel size, and its density
+    rasters are sums of 2x2 blocks of the previous level. Then every
+    level is thresholded as in solve. The result is close to running
+    solve with the coarser resolution, but not identical, because a
+    request is counted in every fine pixel it covers.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the finest raster
+    :param int levels: Number of coarser levels
+    :param list bin_output_paths: Paths to store the binary raster of each level,
+                                  finest first; None means not written; defaults to None
+    :param str engine: Accumulation engine, see compute_density_rasters
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+    :param int workers: Number of worker processes, see compute_density_rasters
+    :param tuple density: Density rasters computed earlier, see solve
+    :param float half_life: Half-life of the request weights, see compute_density_rasters
+
+    :return list: (RasterGrid, binary raster) for each level, finest first
+    """
+    if density is None:
+        density = compute_density_rasters(requests, grid, engine, dtype, workers, half_life)
+    eval_raster, norm_raster, request_counter = density
+    logging.info("there was {} requests included in the analysis".format(request_counter))
+
+    results = []
+    for level in range(levels + 1):
+        if level > 0:
+            # A pixel of this level counts requests in 4**level finest pixels.
+            level_dtype = fit_dtype(str(eval_raster.dtype), request_counter*4**level)
+            eval_raster = sum_blocks(eval_raster.astype(level_dtype, copy=False))
+            norm_raster = sum_blocks(norm_raster.astype(level_dtype, copy=False))
+            grid = get_coarser_grid(grid)
+
+        binary_raster = get_binary_raster(eval_raster, norm_raster)
+        if bin_output_paths and bin_output_paths[level]:
+            write_raster(bin_output_paths[level], binary_raster, grid, nodata=99, nbits=1)
+        logging.info("Pyramid level {} of size {}, {} created".format(level, grid.height,
+                                                                       grid.width))
+        results.append((grid, binary_raster))
+
+    return results
+
+
+def solve_sweep(requests, grid, threshold_constants, bin_output_paths=None, engine='diff',
+                dtype='int32', workers=1, density=None, half_life=None):
+    """Produce binary rasters with several threshold constants
+
+    Density rasters are computed once and thresholded with each
+    constant as in solve. Used to find a good THRESHOLD_CONSTANT.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param list threshold_constants: Constants used instead of THRESHOLD_CONSTANT
+    :param list bin_output_paths: Paths to store the binary raster of each constant;
+                                  None means not written; defaults to None
+    :param str engine: Accumulation engine, see compute_density_rasters
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+    :param int workers: Number of worker processes, see compute_density_rasters
+    :param tuple density: Density rasters computed earlier, see solve
+    :param float half_life: Half-life of the request weights, see compute_density_rasters
+
+    :return list: Binary raster for each constant
+    """
+    if density is None:
+        density = compute_density_rasters(requests, grid, engine, dtype, workers, half_life)
+    eval_raster, norm_raster, request_counter = density
+    logging.info("there was {} requests included in the analysis".format(request_counter))
+
+    results = []
+    for i, threshold_constant in enumerate(threshold_constants):
+        binary_raster = get_binary_raster(eval_raster, norm_raster, threshold_constant)
+        if bin_output_paths and bin_output_paths[i]:
+            write_raster(bin_output_paths[i], binary_raster, grid, nodata=99, nbits=1)
+        logging.info("Binary raster with threshold constant {} created"\
+                     .format(threshold_constant))
+        results.append(binary_raster)
+
+    return results
+
+
+# Time periods of the temporal results, see get_time_periods
+TIME_PERIODS = ('day', 'week', 'month', 'year')
+
+
+def get_time_periods(request_time, period):
+    """Find the time period of each request
+
+    Periods are numbered from the one containing 1.1.1970 (UTC).
+    Weeks start on Monday.
+
+    :param numpy array request_time: requestTime of the requests in milliseconds
+    :param str period: Length of the periods, one of TIME_PERIODS
+
+    :return numpy array: int64 number of the period of each request
+    """
+    times = request_time.astype('datetime64[ms]')
+    if period == 'week':
+        # 1.1.1970 was a Thursday.
+        return (times.astype('datetime64[D]').astype(np.int64) + 3) // 7
+    unit = {'day': 'D', 'month': 'M', 'year': 'Y'}[period]
+    return times.astype('datetime64[{}]'.format(unit)).astype(np.int64)
+
+
+def get_period_label(period_number, period):
+    """Name a time period by its first day, month or year
+
+    :param int period_number: Number of the period, see get_time_periods
+    :param str period: Length of the periods, one of TIME_PERIODS
+
+    :return str: e.g. '2019-02' for a month
+    """
+    if period == 'week':
+        return str(np.datetime64(int(period_number)*7 - 3, 'D'))
+    unit = {'day': 'D', 'month': 'M', 'year': 'Y'}[period]
+    return str(np.datetime64(int(period_number), unit))
+
+
+def insert_cube_layers(periods, new_periods, *cubes):
+    """Add zero filled layers for new time periods to 3D arrays
+
+    :param numpy array periods: Sorted periods of the layers of the arrays
+    :param numpy array new_periods: Periods to add
+    :param cubes: 3D arrays with one layer per period
+
+    :return:
+        numpy array periods: Sorted periods of the new arrays
+        list cubes: The new arrays
+    """
+    merged = np.union1d(periods, new_periods)
+    positions = np.searchsorted(merged, periods)
+    grown = []
+    for cube in cubes:
+        grown.append(np.zeros((len(merged),) + cube.shape[1:], dtype=cube.dtype))
+        grown[-1][positions] = cube
+    return merged, grown
+
+
+def compute_density_cube(requests, grid, period, dtype='int32'):
+    """Compute density rasters for each time period in one pass
+
+    Requests are binned by their requestTime, and every bin gets its own
+    layer in 3D difference arrays. The arrays grow when requests of a new
+    period appear, so the periods don't need to be known in advance.
+    Each layer equals the density rasters of compute_density_rasters for
+    the requests of that period only.
+
+    Memory use is the number of periods times the size of the density rasters.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str period: Length of the periods, one of TIME_PERIODS
+    :param str dtype: Data type of the rasters, see compute_density_rasters
+
+    :return:
+        numpy array periods: Sorted numbers of the periods with requests,
+                             see get_time_periods
+        numpy array eval_cube: eval_raster of each period, (periods, height, width)
+        numpy array norm_cube: norm_raster of each period, (periods, height, width)
+        int request_counter: number of requests
+    """
+
+    if period not in TIME_PERIODS:
+        raise Exception("Unknown time period '{}'. Options: {}"\
+                        .format(period, ", ".join(TIME_PERIODS)))
+
+    if dtype not in DENSITY_DTYPES:
+        raise Exception("Unknown density dtype '{}'. Options: {}"\
+                        .format(dtype, ", ".join(DENSITY_DTYPES)))
+
+    if isinstance(requests, RequestTable):
+        requests = [requests]
+
+    logging.info("Accumulating requests by {} with difference arrays...".format(period))
+    periods = np.empty(0, dtype=np.int64)
+    eval_cube = np.zeros((0, grid.height + 1, grid.width + 1), dtype=dtype)
+    norm_cube = np.zeros((0, grid.height + 1, grid.width + 1), dtype=dtype)
+    request_counter = 0
+
+    for chunk in requests:
+        chunk_dtype = fit_dtype(dtype, request_counter + len(chunk))
+        if chunk_dtype != dtype:
+            dtype = chunk_dtype
+            eval_cube = eval_cube.astype(dtype)
+            norm_cube = norm_cube.astype(dtype)
+
+        chunk_periods = get_time_periods(chunk.request_time, period)
+        new_periods = np.setdiff1d(chunk_periods, periods)
+        if len(new_periods) > 0:
+            periods, (eval_cube, norm_cube) = insert_cube_layers(periods, new_periods,
+                                                                 eval_cube, norm_cube)
+
+        accumulate_bboxes_diff(eval_cube, norm_cube, chunk.bboxes, chunk.image_analysis_result,
+                               grid.transform, layers=np.searchsorted(periods, chunk_periods))
+        request_counter += len(chunk)
+
+    norm_cube = integrate_difference_array(norm_cube)
+    eval_cube = integrate_difference_array(eval_cube)
+    np.negative(eval_cube, out=eval_cube)
+
+    return periods, eval_cube, norm_cube, request_counter
+
+
+def solve_periods(requests, grid, period, bin_output_path=None, cube_output_path=None,
+                  dtype='int32'):
+    """Produce a binary raster for each time period and for all requests
+
+    Density rasters are computed once per period with compute_density_cube.
+    Every period is thresholded separately as in solve, which gives the
+    same result as running solve on the requests of that period. The
+    result of all requests comes from the sums of the periods.
+
+    :param requests: RequestTable or iterable of RequestTables
+                     with valid requests within the layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str period: Length of the periods, one of TIME_PERIODS
+    :param str bin_output_path: Path to store the binary raster of all requests;
+                                defaults to None, which means not written
+    :param str cube_output_path: Path to store the binary rasters of the periods
+                                 as bands of one raster; defaults to None
+    :param str dtype: Data type of the density rasters, see compute_density_rasters
+
+    :return:
+        numpy array binary_raster: Binary raster of all requests
+        list period_results: (label, binary raster) of each period with requests
+    """
+    periods, eval_cube, norm_cube, request_counter = compute_density_cube(requests, grid,
+                                                                          period, dtype)
+    logging.info("there was {} requests included in the analysis in {} periods"\
+                 .format(request_counter, len(periods)))
+
+    binary_raster = get_binary_raster(eval_cube.sum(axis=0, dtype=eval_cube.dtype)[np.newaxis],
+                                      norm_cube.sum(axis=0, dtype=norm_cube.dtype)[np.newaxis])
+    if bin_output_path:
+        write_raster(bin_output_path, binary_raster, grid, nodata=99, nbits=1)
+
+    labels = [get_period_label(period_number, period) for period_number in periods]
+    period_rasters = [get_binary_raster(eval_cube[i:i + 1], norm_cube[i:i + 1])
+                      for i in range(len(periods))]
+    if cube_output_path and period_rasters:
+        write_raster(cube_output_path, np.stack(period_rasters), grid, nodata=99,
+                     descriptions=labels, nbits=1)
+    logging.info("Binary rasters of periods {} created".format(", ".join(labels)))
+
+    return binary_raster, list(zip(labels, period_rasters))
@@ -2,35 +2,322 @@
 
 Automatizes the execution of the functionality in process.py for
 multiple files within one folder. It requires a configuration file.
+Files can be processed in parallel, each in its own worker process.
 
 How to run:
 
         $ python3 batch.py batch.ini
+        $ python3 batch.py batch.ini --workers 8
+
+Finished files are recorded in a manifest in the output directory.
+Running the batch again skips files whose inputs haven't changed.
 
 """
 
+import csv
 import glob
+import time
 import logging
 import datetime
 import configparser
 import argparse
 import pdb
 import signal
+import multiprocessing
+from multiprocessing.connection import wait
 from pathlib import Path
 from Process import Process
-from Validate import validate
+from Validate import validate, validate_sweep, get_statistics_path
+from Manifest import load_manifest, add_to_manifest, is_up_to_date, task_key
+from HttpCache import get_http_cache
 
 logging.basicConfig(filename="../../output_data/logs/" \
                     + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
                     + '.log', level=logging.INFO)
 
+# Maximum time for validation of one file; in seconds
+VALIDATION_TIMEOUT = 180
+
+# Time a worker process gets after task_timeout to report the timeout itself,
+# and after being terminated to exit, before it is killed; in seconds
+TERMINATE_GRACE = 10
+
+
 def handler(signum, frame):
    logging.error ("validation took too long - terminated")
    raise Exception("validation took too long - terminated")
 
+def task_handler(signum, frame):
+   logging.error ("processing took too long - terminated")
+   raise Exception("processing took too long - terminated")
+
+
+def get_file_config(cfg, file_path):
+    """Generate configuration for processing one file.
+
+    All options of the batch configuration are copied and
+    the paths are set for the given file.
+
+    :param ConfigParser cfg: Batch configuration
+    :param str file_path: Path to the monitoring result file
+
+    :return dict: Configuration as a dictionary of sections
+    """
+
+    get_capabilities_docs = cfg.get('data', 'get_capabilities')
+    output_dir = cfg.get('data', 'output_dir')
+    file = Path(file_path).stem
+
+    config = {section: dict(cfg.items(section, raw=True)) for section in cfg.sections()}
+    for section in ('data', 'other', 'result', 'input'):
+        config.setdefault(section, {})
+
+    config['data']['response_file'] = file_path
+    config['data']['get_capabilities'] = get_capabilities_docs + file.split("_")[0] + ".xml"
+    config['data']['output_dir'] = output_dir
+    config['data']['raster_output_path'] = output_dir + file + ".tif"
+    config['data']['binary_raster_output_path'] = output_dir + "bin_" + file + ".tif"
+    config['data']['validation_raster_output_path'] = output_dir + "val_" + file + ".tif"
+
+    return config
+
+
+def process_file(file_config, task_timeout=None):
+    """Process and validate one monitoring result file.
+
+    Errors are caught so that one file can't stop the batch.
+
+    :param dict file_config: Configuration from get_file_config
+    :param int task_timeout: Maximum time for the whole file in seconds;
+                             defaults to None, which means no limit
+
+    :return dict: Summary of the task: file, status ('done' or 'failed'),
+                  validated, validation_skipped (on purpose, see ValidationSkipped),
+                  error, output files and timings in seconds
+    """
+
+    file = Path(file_config['data']['response_file']).stem
+    logging.info("file {} begins".format(file))
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(file_config)
+
+    summary = {'file': file, 'status': 'done', 'validated': False,
+               'validation_skipped': False, 'error': '', 'outputs': [],
+               'algorithm_seconds': None, 'validation_seconds': None}
+    start = time.time()
+
+    if task_timeout:
+        signal.signal(signal.SIGALRM, task_handler)
+        signal.alarm(task_timeout)
+
+    try:
+        process = Process(config)
+        process.run_algorithm()
+        summary['algorithm_seconds'] = round(time.time() - start, 3)
+        summary['outputs'] = process.output_files
+
+        validation_timeout = VALIDATION_TIMEOUT
+        if task_timeout:
+            remaining = task_timeout - (time.time() - start)
+            validation_timeout = max(1, min(VALIDATION_TIMEOUT, int(remaining)))
+
+        signal.signal(signal.SIGALRM, handler)
+        signal.alarm(validation_timeout)
+        validation_start = time.time()
+        try:
+            # validation of the result.
+            validation = validate(process.url, process.layer_name,
+                                  process.crs.crs_code, process.layer_bbox,
+                                  process.binary_raster, process.grid,
+                                  process.val_raster_output_path,
+                                  process.service_type, process.service_version,
+                                  process.max_features_for_validation,
+                                  process.flip_features, process.data_bounds,
+                                  process.service,
+                                  process.validation_options)
+            summary['validated'] = validation == 0
+            summary['validation_skipped'] = validation == 1
+            if validation == 0:
+                # Removing the validation outputs makes the file run again.
+                summary['outputs'] = summary['outputs'] + [
+                    process.val_raster_output_path,
+                    get_statistics_path(process.val_raster_output_path)]
+            elif validation == -1:
+                summary['error'] = "validation failed"
+
+            if process.sweep_results and process.sweep_validation and validation == 0:
+                if validate_sweep(process.url, process.layer_name, process.crs.crs_code,
+                                  process.layer_bbox, process.sweep_results, process.grid,
+                                  process.val_raster_output_path, process.service_type,
+                                  process.service_version,
+                                  process.max_features_for_validation,
+                                  process.flip_features, process.service,
+                                  process.validation_options) == 0:
+                    summary['outputs'].append(
+                        get_statistics_path(process.val_raster_output_path, "sweep_stats_"))
+                else:
+                    summary['error'] = "sweep validation failed"
+
+        except Exception as e:
+            print(e)
+            summary['error'] = "validation: {}".format(e)
+        signal.alarm(0)
+        summary['validation_seconds'] = round(time.time() - validation_start, 3)
+
+        logging.info("File '{}' done. \n \n".format(file))
+    except Exception as e:
+        signal.alarm(0)
+        summary['status'] = 'failed'
+        summary['error'] = str(e)
+        logging.info("File '{}' failed.\nError message: '{}' \n \n".format(file, e))
+
+    summary['seconds'] = round(time.time() - start, 3)
+
+    return summary
+
+
+def failed_summary(file_config, error):
+    """Create the summary of a file whose worker process didn't report one
 
+    :param dict file_config: Configuration from get_file_config
+    :param str error: What happened to the worker
 
-def run_batch(cfg):
+    :return dict: Summary of the task, see process_file
+    """
+    file = Path(file_config['data']['response_file']).stem
+    logging.info("File '{}' failed.\nError message: '{}' \n \n".format(file, error))
+    return {'file': file, 'status': 'failed', 'validated': False,
+            'validation_skipped': False, 'error': error, 'outputs': [],
+            'seconds': None, 'algorithm_seconds': None, 'validation_seconds': None}
+
+
+def run_task(connection, file_config, task_timeout):
+    """Process one file in a worker process and send the summary to the batch
+
+    :param Connection connection: Sending end of a pipe to the batch process
+    :param dict file_config: Configuration from get_file_config
+    :param int task_timeout: see process_file
+    """
+    connection.send(process_file(file_config, task_timeout))
+    connection.close()
+
+
+def stop_worker(worker):
+    """Wait for a worker process to exit, and kill it if it doesn't
+
+    :param multiprocessing.Process worker: The worker
+    """
+    worker.join(TERMINATE_GRACE)
+    if worker.is_alive():
+        worker.kill()
+        worker.join()
+
+
+def run_isolated(tasks, workers, task_timeout, finish):
+    """Process files in separate worker processes
+
+    Each file gets a new process, so a worker which dies (e.g. runs out
+    of memory or crashes in GDAL) only fails its own file. The timeout
+    is also enforced here: a worker still running TERMINATE_GRACE
+    seconds after task_timeout is terminated, since the alarm in
+    process_file can't interrupt blocking calls in C code.
+
+    :param list tasks: (file_config, key) of each file
+    :param int workers: Number of files processed at the same time
+    :param int task_timeout: Maximum time for one file in seconds; None means no limit
+    :param function finish: Called with the summary and the key of each file
+    """
+    pending = list(tasks)
+    running = []
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                file_config, key = pending.pop(0)
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                worker = multiprocessing.Process(target=run_task,
+                                                 args=(sender, file_config, task_timeout))
+                worker.start()
+                sender.close()
+                deadline = time.time() + task_timeout + TERMINATE_GRACE if task_timeout else None
+                running.append({'worker': worker, 'receiver': receiver, 'config': file_config,
+                                'key': key, 'deadline': deadline, 'summary': None})
+
+            deadlines = [task['deadline'] for task in running if task['deadline'] is not None]
+            timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+            # The summary is read as soon as it is sent, so a worker never
+            # blocks on a full pipe.
+            ready = wait([task['receiver'] for task in running if task['summary'] is None]
+                         + [task['worker'].sentinel for task in running], timeout)
+
+            for task in list(running):
+                worker, receiver = task['worker'], task['receiver']
+                if task['summary'] is None and receiver in ready:
+                    try:
+                        task['summary'] = receiver.recv()
+                    except EOFError:
+                        # The worker died without sending a summary.
+                        task['summary'] = False
+
+                if worker.sentinel in ready or task['summary']:
+                    stop_worker(worker)
+                    summary = task['summary'] or failed_summary(
+                        task['config'], "worker failed with exit code {}".format(worker.exitcode))
+                elif task['deadline'] is not None and time.time() >= task['deadline']:
+                    worker.terminate()
+                    stop_worker(worker)
+                    summary = failed_summary(task['config'],
+                                             "processing took too long - terminated")
+                else:
+                    continue
+
+                receiver.close()
+                running.remove(task)
+                finish(summary, task['key'])
+    finally:
+        for task in running:
+            task['worker'].kill()
+            task['worker'].join()
+
+
+def write_summary(output_dir, summaries):
+    """Log the results of the batch and write them to a csv file.
+
+    :param str output_dir: Directory where the summary file is written
+    :param list summaries: Task summaries returned by process_file
+    """
+
+    done = [s for s in summaries if s['status'] == 'done']
+    skipped = [s for s in summaries if s['status'] == 'skipped']
+    failed = [s for s in summaries if s['status'] == 'failed']
+    validated = [s for s in done if s['validated']]
+    total_time = sum(s['seconds'] or 0 for s in summaries)
+
+    message = ("Batch finished: {} files, {} done ({} validated), {} skipped as up to date, "
+               "{} failed. Total processing time {:.1f} s.".format(len(summaries), len(done),
+                                                                   len(validated), len(skipped),
+                                                                   len(failed), total_time))
+    logging.info(message)
+    print(message)
+    for s in failed:
+        logging.info("Failed: '{}': {}".format(s['file'], s['error']))
+        print("Failed: '{}': {}".format(s['file'], s['error']))
+
+    summary_path = output_dir + "batch_summary_" \
+                   + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") + ".csv"
+    fields = ['file', 'status', 'validated', 'seconds', 'algorithm_seconds',
+              'validation_seconds', 'error']
+    with open(summary_path, "w") as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        for s in sorted(summaries, key=lambda s: s['file']):
+            writer.writerow(s)
+
+    logging.info("Batch summary written to {}".format(summary_path))
+
+
+def run_batch(cfg, workers=1, task_timeout=None, resume=True):
     """For each file in folder given in configuration,
     generates a configuration file, creates an instance
     of the process.py class, runs algorithm which produces
@@ -40,71 +327,83 @@ def run_batch(cfg):
     Parameters
     ----------
     cfg : ConfigParser object
+    workers : int, number of worker processes; 1 processes
+              files one by one in this process, see run_isolated
+    task_timeout : int, maximum time for one file in seconds;
+                   None means no limit
+    resume : boolean, skip files which are already done according
+             to the manifest in the output directory
+
+    Returns
+    -------
+    list of task summaries, see process_file
 
     """
 
     directory = cfg.get('data', 'response_file')
-    get_capabilities_docs = cfg.get('data', 'get_capabilities')
     output_dir = cfg.get('data', 'output_dir')
-    input_first_axis_direction = cfg.get('input', 'first_axis_direction')
-    resolution = cfg.get('result', 'resolution')
-    output_crs = cfg.get('result', 'output_crs')
-    output_first_axis_direction = cfg.get('result', 'first_axis_direction')
-    max_raster_size = cfg.get('other', 'max_raster_size')
-    max_features = cfg.get('other', 'max_features_for_validation')
 
     signal.signal(signal.SIGALRM, handler)
 
-    for file_path in glob.glob(directory + '*.json'):
-        file = Path(file_path).stem
-        logging.info("file {} begins".format(file))
-
-        config = configparser.ConfigParser()
-        config.add_section('data')
-        config.add_section('other')
-        config.add_section('result')
-        config.add_section('input')
-
-        config.set('data', 'response_file', file_path)
-        config.set('data', 'get_capabilities', get_capabilities_docs + file.split("_")[0] + ".xml")
-        config.set('data', 'raster_output_path', output_dir + file + ".tif")
-
-        config.set('data', 'output_dir', output_dir)
-        config.set('data', 'raster_output_path', output_dir + file + ".tif")
-        config.set('data', 'binary_raster_output_path', output_dir + "bin_" + file + ".tif")
-        config.set('data', 'validation_raster_output_path', output_dir + "val_" + file + ".tif")
-        config.set('input', 'first_axis_direction', input_first_axis_direction)
-        config.set('result', 'resolution', resolution)
-        config.set('result', 'output_crs', output_crs)
-        config.set('result', 'first_axis_direction', output_first_axis_direction)
-        config.set('other', 'max_raster_size', max_raster_size)
-        config.set('other', 'max_features_for_validation', max_features)
+    manifest = load_manifest(output_dir) if resume else {}
+    summaries = []
+    tasks = []
 
+    for file_path in glob.glob(directory + '*.json'):
+        file_config = get_file_config(cfg, file_path)
         try:
-            process = Process(config)
-            process.run_algorithm()
+            key = task_key(file_config)
+        except OSError as e:
+            # Missing input file, processing will fail and report it.
+            logging.warning("Couldn't hash inputs of '{}': {}".format(file_path, e))
+            key = None
 
+        if key is not None and is_up_to_date(manifest, key):
+            logging.info("File '{}' is up to date, skipped.".format(Path(file_path).stem))
+            summaries.append({'file': Path(file_path).stem, 'status': 'skipped',
+                              'validated': manifest[key]['validated'],
+                              'validation_skipped': manifest[key].get('validation_skipped',
+                                                                      False),
+                              'error': '',
+                              'seconds': None, 'algorithm_seconds': None,
+                              'validation_seconds': None})
+            continue
+        tasks.append((file_config, key))
 
-            signal.alarm(180)
-            try:
-                # validation of the result.
-                validate(process.url, process.layer_name, process.crs.crs_code,
-                         process.layer_bbox, process.bin_raster_path,
-                         process.val_raster_output_path, process.service_type,
-                         process.service_version, process.max_features_for_validation,
-                         process.flip_features, process.data_bounds, process.service)
+    def finish(summary, key):
+        summaries.append(summary)
+        # Files whose validation failed are processed again on the next run,
+        # since the failure may be temporary (e.g. the server was down).
+        if summary['status'] == 'done' and not summary['error'] and key is not None \
+                and (summary['validated'] or summary['validation_skipped']):
+            add_to_manifest(output_dir, key, summary)
 
-            except Exception as e:
-                print(e)
-            signal.alarm(0)
+    if workers <= 1:
+        for file_config, key in tasks:
+            finish(process_file(file_config, task_timeout), key)
 
-            logging.info("File '{}' done. \n \n".format(file))
-        except Exception as e:
-            logging.info("File '{}' failed.\nError message: '{}' \n \n".format(file, e))
+    else:
+        logging.info("Processing {} files with {} workers".format(len(tasks), workers))
+        run_isolated(tasks, workers, task_timeout, finish)
+
+    # The files share the HTTP cache, so it is trimmed once for the batch.
+    http_cache = get_http_cache(cfg)
+    if http_cache is not None:
+        http_cache.evict()
+
+    write_summary(output_dir, summaries)
+
+    return summaries
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("path_to_config", help="Path to the file containing configuration.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of files processed in parallel.")
+    parser.add_argument("--timeout", type=int, default=None,
+                        help="Maximum time for processing one file in seconds.")
+    parser.add_argument("--force", action='store_true',
+                        help="Process all files, also those which are up to date.")
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
@@ -112,4 +411,4 @@ if __name__ == '__main__':
     if len(data) == 0:
         raise Exception("Configuration file not found.")
 
-    run_batch(config)
+    run_batch(config, workers=args.workers, task_timeout=args.timeout, resume=not args.force)
@@ -1,9 +1,14 @@
 """capabilities.py
 
 Functions to retrieve bounding box from the Get_Capabilities
-document.
+document. Documents are parsed once into an index of layer
+bounding boxes, which can be shared by all layers of a service.
 
 """
+import os
+import pickle
+import functools
+import hashlib
 import logging
 import datetime
 import xml.etree.ElementTree as ET
@@ -69,88 +74,364 @@ def transform_bbox(bbox, transform_from, transform_to):
     return transformed
 
 
-def get_layer_bbox_wms(root, layer_name, crs):
-    """Get bounding box from a document describing WMS service
+WMS_NS = '{http://www.opengis.net/wms}'
+WFS_NS = '{http://www.opengis.net/wfs}'
+WFS2_NS = '{http://www.opengis.net/wfs/2.0}'
+OWS_NS = '{http://www.opengis.net/ows}'
+OWS11_NS = '{http://www.opengis.net/ows/1.1}'
+
+# Number of parsed documents kept in memory by a process. A batch uses
+# each document for a few layers in a row, so a few are enough.
+INDEX_CACHE_SIZE = 8
+
+
+def get_service_type_from_root(root):
+    """Find out the type of service from a Get_Capabilities document
 
     :param ElementTree object root: Root of the xml document
-    :param str layer_name: Name of a layer for which this is being done
-    :param CRS object crs: Contains information related to CRS
 
-    :return tuple bbox: Bounding box retrieved from the document
+    :return str service: Either 'WMS' or 'WFS'
     """
-    bbox = None
+    service = None
+
+    if "wms" in root.tag.lower():
+        service = 'WMS'
 
-    epsg_code = crs.to_epsg()
+    elif "wfs" in root.tag.lower():
+        service = 'WFS'
 
-    def get_ref_system(element):
-        """Find reference system value in an xml element
+    else:
+        for element in root:
+            for child in element:
+                if "wms" in child.text.lower():
+                    return 'WMS'
+                elif "wfs" in child.text.lower():
+                    return "WFS"
 
-        :param ElementTree object element: An xml element
+    if service is None:
+        raise Exception("Couldn't retrieve service type from {}".format(root.tag))
 
-        :return str ref_system: Reference system as specified in the element
-        """
+    return service
+
+
+def get_ref_system(element):
+    """Find reference system value in an xml element
+
+    :param ElementTree object element: An xml element
+
+    :return str ref_system: Reference system as specified in the element
+    """
+    try:
+        ref_system = element.attrib['CRS']
+    except KeyError:
         try:
-            ref_system = element.attrib['CRS']
+            ref_system = element.attrib['SRS']
         except KeyError:
-            try:
-                ref_system = element.attrib['SRS']
-            except KeyError:
-                raise Exception("CRS not found in {}".format(element.attrib))
-        return ref_system
+            raise Exception("CRS not found in {}".format(element.attrib))
+    return ref_system
 
-    def search(elements, layer_name, epsg_code, crs_flag=False):
-        """Find reference system value in an xml element
 
-        :param list elements: List of xml elements
-        :param str layer_name: Name of a layer for which this is being done
+def parse_corners(element):
+    """Read LowerCorner and UpperCorner of an OWS bounding box element
+
+    :param ElementTree object element: WGS84BoundingBox element
+
+    :return list: Bounding box as [minx, miny, maxx, maxy]
+    """
+    for elem in element:
+        if "LowerCorner" in elem.tag:
+            lonlat1 = [float(i) for i in elem.text.split()]
+        elif "UpperCorner" in elem.tag:
+            lonlat2 = [float(i) for i in elem.text.split()]
+        else:
+            raise Exception("Unexpected bbox value when"
+                            + "parsing xml: {}.".format(elem.tag)
+                            + "Expected LowerCorner or UpperCorner")
+    return lonlat1 + lonlat2
+
+
+class CapabilitiesIndex(object):
+    """Contents of a Get_Capabilities document needed by the process.
+
+    The document is parsed once. Bounding boxes of all layers are
+    stored in compact lookup tables, so finding the bounding box of
+    any layer doesn't need the xml tree anymore.
+    """
+
+    def __init__(self, root):
+        """ Build lookup tables from the xml document
+
+        :param ElementTree object root: Root of the xml document
+        """
+        self.service_type = get_service_type_from_root(root)
+        self._index_wms(root)
+        self._index_wfs(root)
+        self._bbox_cache = {}
+
+    def _index_wms(self, root):
+        """ Index WMS layer names and bounding boxes
+
+        Layer elements are listed in the same order as they are searched
+        in the document. For each text the position of its first element
+        is stored, and every BoundingBox element is stored with its position.
+        """
+        elements = root.findall(WMS_NS + 'Capability/' + WMS_NS + 'Layer/' + WMS_NS
+                                + 'Layer/' + WMS_NS + 'Layer/') \
+                   + root.findall(WMS_NS + 'Capability/' + WMS_NS + 'Layer/' + WMS_NS + 'Layer/') \
+                   + root.findall(WMS_NS + 'Capability/' + WMS_NS + 'Layer/') \
+                   + root.findall('Capability/Layer/Layer/Layer/') \
+                   + root.findall('Capability/Layer/') \
+                   + root.findall('Capability/Layer/Layer/')
+
+        # layer name -> position of the first element with the name
+        self.wms_names = {}
+        # (position, reference system, bbox) of all BoundingBox elements
+        self.wms_bboxes = []
+
+        for position, element in enumerate(elements):
+            self.wms_names.setdefault(element.text, position)
+            if element.tag in (WMS_NS + 'BoundingBox', 'BoundingBox'):
+                ref_system = element.attrib.get('CRS', element.attrib.get('SRS'))
+                try:
+                    bbox = [float(element.attrib[i]) for i in ['minx', 'miny', 'maxx', 'maxy']]
+                except (KeyError, ValueError) as e:
+                    bbox = e
+                self.wms_bboxes.append((position, ref_system, bbox, dict(element.attrib)))
+
+    def _index_wfs(self, root):
+        """ Index children of WFS FeatureType elements
+
+        Children are stored as (tag, text, bbox) tuples. Bbox is parsed
+        for bounding box elements, or it is the exception raised when
+        parsing the element.
+        """
+        def index_feature_types(path):
+            feature_types = []
+            for elem in root.findall(path):
+                children = []
+                for child in elem:
+                    bbox = None
+                    try:
+                        if child.tag == WFS_NS + 'LatLongBoundingBox':
+                            bbox = [float(child.attrib[i])
+                                    for i in ['minx', 'miny', 'maxx', 'maxy']]
+                        elif child.tag in (OWS_NS + 'WGS84BoundingBox',
+                                           OWS11_NS + 'WGS84BoundingBox'):
+                            bbox = parse_corners(child)
+                    except Exception as e:
+                        bbox = e
+                    children.append((child.tag, child.text, bbox))
+                feature_types.append(children)
+            return feature_types
+
+        self.wfs2_feature_types = index_feature_types('./' + WFS2_NS + 'FeatureTypeList/'
+                                                      + WFS2_NS + 'FeatureType')
+        self.wfs_feature_types = index_feature_types('./' + WFS_NS + 'FeatureTypeList/'
+                                                     + WFS_NS + 'FeatureType')
+
+    def search_wms(self, layer_name, epsg_code, crs_flag=False):
+        """Find bounding box of a WMS layer
+
+        The first BoundingBox element after the element with the layer name
+        is used, as in the order of the document.
+
+        :param str layer_name: Name of a layer for which this is being done,
+                               "not_required" accepts any layer
         :param str epsg_code: EPSG code for a coordinate system
         :param boolean crs_flag: if set to True, the function searches for
                                  a bounding box in any coordinate system
         :return tuple bbox: Bounding box retrieved from the document
         """
-        bbox = None
         if layer_name == "not_required":
-            layer = True
+            start = 0
         else:
-            layer = False
+            start = self.wms_names.get(layer_name)
+            if start is None:
+                return None
+
+        for position, ref_system, bbox, attrib in self.wms_bboxes:
+            if position < start:
+                continue
+            if ref_system is None:
+                raise Exception("CRS not found in {}".format(attrib))
+            if (str(epsg_code) in ref_system) or crs_flag is True:
+                if isinstance(bbox, Exception):
+                    raise bbox
+                bbox = list(bbox)
+                if crs_flag is True:
+                    bbox = transform_bbox(bbox, ref_system, epsg_code)
+                return bbox
+        return None
+
+    def get_layer_bbox_wms(self, layer_name, crs):
+        """Get bounding box of a WMS layer
+
+        :param str layer_name: Name of a layer for which this is being done
+        :param CRS object crs: Contains information related to CRS
 
-        for element in elements:
-            if layer is False:
-                layer = element.text == layer_name
+        :return tuple bbox: Bounding box retrieved from the document
+        """
+        epsg_code = crs.to_epsg()
 
-            if (element.tag == '{http://www.opengis.net/wms}BoundingBox'
-                    or element.tag == 'BoundingBox') and layer:
-                if (str(epsg_code) in get_ref_system(element)) or crs_flag is True:
+        bbox = self.search_wms(layer_name, epsg_code)
+        if bbox is None:
+            bbox = self.search_wms(layer_name, epsg_code, crs_flag=True)
+            if bbox is None:
+                bbox = self.search_wms("not_required", epsg_code)
+                if bbox is None:
+                    bbox = self.search_wms("not_required", epsg_code, crs_flag=True)
 
-                    bbox = [float(i) for i in [element.attrib['minx'], element.attrib['miny'],
-                                               element.attrib['maxx'], element.attrib['maxy']]]
-                    if crs_flag is True:
-                        bbox = transform_bbox(bbox, get_ref_system(element), epsg_code)
+        return bbox
+
+    def get_layer_bbox_wfs(self, layer_name, crs):
+        """Get bounding box of a WFS layer
+
+        :param str layer_name: Name of a layer for which this is being done
+        :param CRS object crs: Contains information related to CRS
+
+        :return tuple bbox: Bounding box retrieved from the document
+        """
+        bbox = None
+        bbox0 = None
+        layer = False
+        layer_string = None
+
+        def parsed(value):
+            if isinstance(value, Exception):
+                raise value
+            return list(value)
+
+        #WFS ver. 2.x.x
+        for children in self.wfs2_feature_types:
+            for tag, text, child_bbox in children:
+                if text:
+                    if ":" in text:
+                        layer_string = text.split(":")[1]
+                if tag == WFS2_NS + 'Name' \
+                 and (text in layer_name or layer_string in layer_name):
+                    layer = True
+
+                if layer and tag == OWS11_NS + 'WGS84BoundingBox':
+                    bbox0 = parsed(child_bbox)
+                    layer = False
                     break
+
+        #WFS ver. 1.x.x (1.0.x, 1.1.x)
+        for children in self.wfs_feature_types:
+            for tag, text, child_bbox in children:
+                if text:
+                    if ':' in text:
+                        layer_string = text.split(':')[1]
+                if tag == WFS_NS + 'Name' and \
+                    (text in layer_name or layer_string in layer_name):
+                    layer = True
+                if layer and (tag == OWS_NS + 'WGS84BoundingBox'\
+                    or tag == WFS_NS + 'LatLongBoundingBox'):
+                    if tag == WFS_NS + 'LatLongBoundingBox':
+                        bbox = parsed(child_bbox)
+                    else:
+                        bbox0 = parsed(child_bbox)
+                    layer = False
+
+        # conversion of bbox0 (WGS84 to self.crs)
+        if not bbox and bbox0:
+            bbox = transform_bbox(bbox0, "EPSG:4326", crs.to_epsg())
+
         return bbox
 
-    elements = root.findall('{http://www.opengis.net/wms}Capability/{http://www.opengis.net/wms}' 
-                            + 'Layer/{http://www.opengis.net/wms}Layer/'
-                            + '{http://www.opengis.net/wms}Layer/')  \
-                            + root.findall('{http://www.opengis.net/wms}Capability/'
-                            +    '{http://www.opengis.net/wms}Layer/'
-                            +    '{http://www.opengis.net/wms}Layer/') \
-                            + root.findall('{http://www.opengis.net/wms}Capability/'
-                            +    '{http://www.opengis.net/wms}Layer/') \
-                            + root.findall('Capability/Layer/Layer/Layer/')\
-                            + root.findall('Capability/Layer/')\
-                            + root.findall('Capability/Layer/Layer/')
-
-    bbox = search(elements, layer_name=layer_name, epsg_code=epsg_code)
-    if bbox is None:
-        bbox = search(elements, layer_name=layer_name, epsg_code=epsg_code, crs_flag=True)
-        if bbox is None:
-            bbox = search(elements, layer_name="not_required", epsg_code=epsg_code)
-            if bbox is None:
-                bbox = search(elements, layer_name="not_required",
-                              epsg_code=epsg_code, crs_flag=True)
+    def get_layer_bbox(self, layer_name, crs, service_type=None):
+        """Get bounding box of a layer
+
+        Results are remembered, so repeated lookups are free.
+
+        :param str layer_name: name of a layer for which this is being done
+        :param CRS object crs: Contains information related to CRS
+        :param str service_type: the type of service WMS/WFS; defaults to
+                                 the type of the document
+
+        :return tuple bbox: bounding box retrieved from the document
+        """
+        if service_type is None:
+            service_type = self.service_type
+
+        key = (layer_name, crs.to_epsg(), service_type)
+        if key not in self._bbox_cache:
+            bbox = None
+            if service_type == 'WMS':
+                bbox = self.get_layer_bbox_wms(layer_name, crs)
+            elif service_type == 'WFS':
+                bbox = self.get_layer_bbox_wfs(layer_name, crs)
+            self._bbox_cache[key] = bbox
+
+        bbox = self._bbox_cache[key]
+        return list(bbox) if bbox else bbox
+
+
+def get_capabilities_index(path_to_capabl, cache_dir=None):
+    """Get parsed Get_Capabilities document
+
+    The most recently used documents are kept in memory, see
+    INDEX_CACHE_SIZE. If cache_dir is given, the parsed document is
+    also stored there and reused by later processes until the document
+    is modified.
+
+    :param str path_to_capabl: path to the file
+    :param str cache_dir: directory for parsed documents; defaults to None
+
+    :return CapabilitiesIndex: parsed document
+    """
+    path = os.path.abspath(path_to_capabl)
+    stat = os.stat(path)
+    return _load_index(path, (stat.st_mtime_ns, stat.st_size), cache_dir)
 
-    return bbox
+
+@functools.lru_cache(maxsize=INDEX_CACHE_SIZE)
+def _load_index(path, version, cache_dir):
+    """Parse a document, or load it from cache_dir, see get_capabilities_index
+
+    :param str path: absolute path to the file
+    :param tuple version: modification time and size of the file, so that
+                          a modified document is not found in memory
+    :param str cache_dir: directory for parsed documents or None
+
+    :return CapabilitiesIndex: parsed document
+    """
+    index = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir,
+                                  hashlib.sha1(path.encode()).hexdigest() + ".pickle")
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cached_version, index = pickle.load(cache_file)
+            if cached_version != version:
+                index = None
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            index = None
+
+    if index is None:
+        logging.info("Parsing capabilities document {}".format(path))
+        index = CapabilitiesIndex(ET.parse(path).getroot())
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first, other processes may read the cache.
+            tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump((version, index), cache_file)
+            os.replace(tmp_path, cache_path)
+
+    return index
+
+
+def get_layer_bbox_wms(root, layer_name, crs):
+    """Get bounding box from a document describing WMS service
+
+    :param ElementTree object root: Root of the xml document
+    :param str layer_name: Name of a layer for which this is being done
+    :param CRS object crs: Contains information related to CRS
+
+    :return tuple bbox: Bounding box retrieved from the document
+    """
+    return CapabilitiesIndex(root).get_layer_bbox_wms(layer_name, crs)
 
 
 def get_layer_bbox_wfs(root, layer_name, crs):
@@ -162,98 +443,22 @@ def get_layer_bbox_wfs(root, layer_name, crs):
 
     :return tuple bbox: bounding box retrieved from the document
     """
-    bbox = None
-    bbox0 = None
-    layer = False
-
-    #WFS ver. 2.x.x
-    for elem in root.findall('./{http://www.opengis.net/wfs/2.0}FeatureTypeList/' \
-                             + '{http://www.opengis.net/wfs/2.0}FeatureType'):
-        for child in elem:
-            if child.text:
-                if ":" in child.text:
-                    layer_string = child.text.split(":")[1]
-            if child.tag == '{http://www.opengis.net/wfs/2.0}Name'\
-             and (child.text in layer_name or layer_string in layer_name):
-                layer = True
-
-
-            if layer and (child.tag == '{http://www.opengis.net/ows/1.1}WGS84BoundingBox'):
-                for elem in child:
-                    if "LowerCorner" in elem.tag:
-                        lonlat1 = elem.text.split()
-                        lonlat1 = [float(i) for i in lonlat1]
-                    elif "UpperCorner" in elem.tag:
-                        lonlat2 = elem.text.split()
-                        lonlat2 = [float(i) for i in lonlat2]
-                    else:
-                        raise Exception("Unexpected bbox value when"
-                                        + "parsing xml: {}.".format(elem.tag) 
-                                        + "Expected LowerCorner or UpperCorner")
-
-                bbox0 = lonlat1 + lonlat2
-                layer = False
-                break
-
-
-    #WFS ver. 1.x.x (1.0.x, 1.1.x)
-    for elem in root.findall('./{http://www.opengis.net/wfs}FeatureTypeList'
-                             + '/{http://www.opengis.net/wfs}FeatureType'):
-        for child in elem:
-            if child.text:
-                if ':' in child.text:
-                    layer_string = child.text.split(':')[1]
-            if child.tag == '{http://www.opengis.net/wfs}Name' and \
-                (child.text in layer_name or layer_string in layer_name):
-                layer = True
-            if layer and (child.tag == '{http://www.opengis.net/ows}WGS84BoundingBox'\
-                or child.tag == '{http://www.opengis.net/wfs}LatLongBoundingBox'):
-                if child.tag == '{http://www.opengis.net/wfs}LatLongBoundingBox':
-                    bbox = [child.attrib['minx'], child.attrib['miny'],
-                            child.attrib['maxx'], child.attrib['maxy']]
-                    for i in range(len(bbox)):
-                        bbox[i] = float(bbox[i])
-                else:
-                    for elem in child.getchildren():
-                        if "LowerCorner" in elem.tag:
-                            lonlat1 = elem.text.split()
-                            lonlat1 = [float(i) for i in lonlat1]
-                        elif "UpperCorner" in elem.tag:
-                            lonlat2 = elem.text.split()
-                            lonlat2 = [float(i) for i in lonlat2]
-                        else:
-                            raise Exception("Unexpected bbox value when parsing xml: {}.\
-                                            Expected LowerCorner or UpperCorner".format(elem.tag))
-                    bbox0 = lonlat1 + lonlat2
-                layer = False
-
-
-    # conversion of bbox0 (WGS84 to self.crs)
-    if not bbox and bbox0:
-        bbox = transform_bbox(bbox0, "EPSG:4326", crs.to_epsg())
+    return CapabilitiesIndex(root).get_layer_bbox_wfs(layer_name, crs)
 
 
-    return bbox
-
-def get_layer_bbox(path_to_capabl, layer_name, crs, service_type):
+def get_layer_bbox(path_to_capabl, layer_name, crs, service_type, cache_dir=None):
 
     """Get bounding box from a Get_Capabilities document
 
     :param str path_to_capabl: path to the file
     :param str layer_name: name of a layer for which this is being done
     :param str service_type: the type of service WMS/WFS
+    :param str cache_dir: directory for parsed documents; defaults to None
 
     :return tuple bbox: bounding box retrieved from the document
     """
-    root = ET.parse(path_to_capabl).getroot()
-    bbox = None
-
-    if service_type == 'WMS':
-        bbox = get_layer_bbox_wms(root, layer_name, crs)
-
-    elif service_type == 'WFS':
-
-        bbox = get_layer_bbox_wfs(root, layer_name, crs)
+    bbox = get_capabilities_index(path_to_capabl, cache_dir).get_layer_bbox(layer_name, crs,
+                                                                            service_type)
 
     # throw exception if the bbox is not found
     if not bbox:
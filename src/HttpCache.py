@@ -0,0 +1,289 @@
+"""httpcache.py
+
+Persistent cache for the HTTP responses fetched in validation, so
+that rerunning a batch doesn't fetch the same data from the servers
+again.
+
+Responses are identified by their normalized URL. A response is used
+without contacting the server for the time-to-live; after that it is
+revalidated with its ETag or Last-Modified header, and only fetched
+again if the server has changed it. The cache is trimmed to its
+maximum size by evict, once per run, by removing the least recently
+used responses.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+import configparser
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
+logging.basicConfig(filename="../../output_data/logs/" \
+                    + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
+                    + '.log', level=logging.INFO)
+
+# Time a response is used without revalidation; in seconds
+DEFAULT_TTL = 7*24*60*60
+
+# Size of the cache directory after which responses are removed; in bytes
+DEFAULT_MAX_SIZE = 1 << 30
+
+# Part of every key. Increase when the format of the entries changes.
+HTTP_CACHE_VERSION = 2
+
+# Suffix of the file holding the metadata of a response
+METADATA_SUFFIX = '.json'
+
+
+def normalize_url(url):
+    """Normalize a URL so that equivalent requests have the same key
+
+    Scheme and host are lower case, default ports are removed and the
+    query parameters are sorted by their upper case names, since
+    parameter names of OGC services are case insensitive. Values are
+    kept as they are.
+
+    :param str url: The URL
+
+    :return str: The normalized URL
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, parts.port) in (('http', 80), ('https', 443)):
+        netloc = netloc.rsplit(':', 1)[0]
+    params = sorted((name.upper(), value) for name, value in
+                    parse_qsl(parts.query, keep_blank_values=True))
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(params), ''))
+
+
+class HttpCache(object):
+    """Responses stored in a directory, two files per response.
+
+    The body is stored as it is, and the metadata (URL, time stored,
+    ETag and Last-Modified) in a small JSON file next to it, so that
+    revalidating a response doesn't write the body again. Files are
+    written to a temporary path first, so several processes and
+    threads can share the directory. The modification time of the
+    body is its last use, so evict only needs to list the directory.
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        """ Set up the cache
+
+        :param str cache_dir: Directory of the cache, created when needed
+        :param float ttl: Time a response is used without revalidation; in seconds
+        :param int max_size: Size of the directory after which responses are
+                             removed, see evict; in bytes
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def _path(self, url, *params):
+        key = repr((HTTP_CACHE_VERSION, normalize_url(url)) + params)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, path):
+        try:
+            with open(path + METADATA_SUFFIX) as source:
+                metadata = json.load(source)
+            with open(path, 'rb') as source:
+                body = source.read()
+        except (OSError, ValueError):
+            return None, None
+        return metadata, body
+
+    def _replace(self, path, content):
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as target:
+            target.write(content)
+        os.replace(tmp_path, path)
+
+    def _write(self, path, metadata, body=None):
+        # The body is written first, so metadata is never newer than its body.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if body is not None:
+            self._replace(path, body)
+        self._replace(path + METADATA_SUFFIX, json.dumps(metadata).encode())
+
+    def _is_fresh(self, metadata):
+        return time.time() - metadata['stored'] < self.ttl
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        for file_path in (path + METADATA_SUFFIX, path):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def get(self, session, url, timeout=None):
+        """Get the body of a response, from the cache if possible
+
+        A stale response is revalidated with a conditional request. If the
+        server can't be reached, a stale response is used anyway.
+
+        :param requests.Session session: Session used for the request
+        :param str url: URL of the request
+        :param float timeout: Time to wait for the server; defaults to None
+
+        :return bytes: The body
+
+        :raises requests.RequestException: if there is no usable response
+        """
+        path = self._path(url)
+        metadata, body = self._read(path)
+        if metadata is not None and self._is_fresh(metadata):
+            logging.info("HTTP cache hit: {}".format(url))
+            self._touch(path)
+            return body
+
+        conditions = {}
+        if metadata is not None:
+            if metadata.get('etag'):
+                conditions['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                conditions['If-Modified-Since'] = metadata['last_modified']
+
+        try:
+            response = session.get(url, headers=conditions, timeout=timeout)
+            if response.status_code == 304 and metadata is not None:
+                logging.info("HTTP cache revalidated: {}".format(url))
+                metadata['stored'] = time.time()
+                self._write(path, metadata)
+                self._touch(path)
+                return body
+            response.raise_for_status()
+        except Exception:
+            if metadata is None:
+                raise
+            logging.warning("HTTP cache revalidation failed, using stale response: {}"\
+                            .format(url))
+            return body
+
+        logging.info("HTTP cache miss: {}".format(url))
+        self._write(path, {'url': url, 'stored': time.time(),
+                           'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')},
+                    response.content)
+        return response.content
+
+    def remove(self, url, *params):
+        """Remove a response, e.g. if its content turned out to be unusable
+
+        :param str url: URL of the request
+        :param params: see load
+        """
+        self._remove(self._path(url, *params))
+
+    def load(self, url, *params):
+        """Load data stored by store, if it is within the time-to-live
+
+        Used for data fetched by other libraries (e.g. OGR), whose
+        responses can't be revalidated.
+
+        :param str url: URL of the request the data was fetched with
+        :param params: Other parameters the data depends on. Their repr is
+                       hashed, so they must have a stable one.
+
+        :return bytes: The data, or None if not cached or expired
+        """
+        path = self._path(url, *params)
+        metadata, body = self._read(path)
+        if metadata is None or not self._is_fresh(metadata):
+            logging.info("HTTP cache miss: {}".format(url))
+            return None
+        logging.info("HTTP cache hit: {}".format(url))
+        self._touch(path)
+        return body
+
+    def store(self, url, body, *params):
+        """Store data fetched with a request, see load
+
+        :param str url: URL of the request the data was fetched with
+        :param bytes body: The data
+        :param params: see load
+        """
+        self._write(self._path(url, *params), {'url': url, 'stored': time.time()}, body)
+
+    def evict(self):
+        """Remove the least recently used responses until the directory is
+        within the maximum size
+
+        Only the sizes and modification times of the files are needed,
+        so this lists the whole directory and is meant to be called once
+        per run. Expired responses are not removed separately: they are
+        replaced when they are used again, and otherwise they become the
+        least recently used ones.
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+
+        # Last use and total size of each response, by the path of its body
+        entries = {}
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            is_body = not name.endswith(METADATA_SUFFIX)
+            if not is_body:
+                path = path[:-len(METADATA_SUFFIX)]
+            last_use, size = entries.get(path, (None, 0))
+            if is_body or last_use is None:
+                last_use = stat.st_mtime
+            entries[path] = (last_use, size + stat.st_size)
+
+        total = sum(size for _, size in entries.values())
+        removed = 0
+        for last_use, size, path in sorted((last_use, size, path) for path, (last_use, size)
+                                           in entries.items()):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+
+        if removed:
+            logging.info("HTTP cache: removed {} responses, {} bytes left".format(removed, total))
+
+
+def get_http_cache(cfg):
+    """Set up the HTTP cache of validation from a configuration
+
+    :param ConfigParser cfg: Configuration with the options http_cache_dir,
+                             http_cache_ttl and http_cache_max_size
+
+    :return HttpCache: The cache, or None if http_cache_dir is not set
+    """
+    try:
+        # Hours to seconds
+        ttl = cfg.getfloat('other', 'http_cache_ttl')*60*60
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        ttl = DEFAULT_TTL
+    try:
+        # Megabytes to bytes
+        max_size = int(cfg.getfloat('other', 'http_cache_max_size')*1024*1024)
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        max_size = DEFAULT_MAX_SIZE
+    try:
+        return HttpCache(cfg.get('data', 'http_cache_dir'), ttl, max_size)
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        return None
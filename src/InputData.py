@@ -5,18 +5,28 @@ Functions related to processing input data.
 """
 
 import math
+import json
 import logging
+import itertools
 import datetime
+import numpy as np
 from geojson import Polygon, Feature, FeatureCollection
 
-import xml.etree.ElementTree as ET
 from Projection import change_bbox_axis_order, is_first_axis_east
+from Capabilities import get_capabilities_index
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
 logging.basicConfig(filename="../../output_data/logs/" \
                     + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
                     + '.log', level=logging.INFO)
 
+# Number of responses parsed at a time when streaming a response file
+CHUNK_SIZE = 100000
 
 def get_resolution(crs, cfg_resolution):
     """Convert resolution from configuration if crs unit is degrees
@@ -39,55 +49,401 @@ def get_resolution(crs, cfg_resolution):
     return resolution
 
 
-def get_service_type(path_to_capabl):
+def get_service_type(path_to_capabl, cache_dir=None):
     """Parse Get_Capabilities document and find out the type of service
 
     :param str path_to_capabl: Path to Get_Capabilities document
+    :param str cache_dir: directory for parsed documents; defaults to None
 
     :return str service: Either 'WMS' or 'WFS'
     """
 
-    root = ET.parse(path_to_capabl).getroot()
-    service = None
+    return get_capabilities_index(path_to_capabl, cache_dir).service_type
 
-    if "wms" in root.tag.lower():
-        service = 'WMS'
 
-    elif "wfs" in root.tag.lower():
-        service = 'WFS'
+class RequestTable(object):
+    """Monitoring requests stored as columns of numpy arrays.
 
-    else:
-        for element in root:
-            for child in element:
-                if "wms" in child.text.lower():
-                    return 'WMS'
-                elif "wfs" in child.text.lower():
-                    return "WFS"
+    Bounding boxes are stored as an Nx4 array of (minx, miny, maxx, maxy)
+    in the coordinate order used by the analysis raster.
+    """
 
-    if service is None:
-        raise Exception("Couldn't retrieve service type from {}".format(root.tag))
+    # Value used in integer columns when the attribute is missing
+    MISSING = -128
 
-    return service
+    # Value of request_time when the response has no requestTime
+    NO_TIME = np.iinfo(np.int64).min
 
-def get_bboxes_as_geojson(layer_bbox, responses, crs, sample=False, flip_features=False):
-    """Convert response file to geojson geometries.
+    def __init__(self, bboxes, image_analysis_result, test_result, request_time):
+        """ Store the columns
 
-    imageAnalysisResult is included to the geojson features.
+        :param numpy array bboxes: Nx4 float64 array of bounding boxes
+        :param numpy array image_analysis_result: int8 array of imageAnalysisResult values
+        :param numpy array test_result: int8 array of testResult values
+        :param numpy array request_time: int64 array of requestTime values
+        """
+        self.bboxes = bboxes
+        self.image_analysis_result = image_analysis_result
+        self.test_result = test_result
+        self.request_time = request_time
+
+    def __len__(self):
+        return len(self.image_analysis_result)
+
+    def subset(self, index):
+        """ Select rows of the table
+
+        :param index: Boolean mask, slice or array of indices
+
+        :return RequestTable: Table with the selected rows
+        """
+        return RequestTable(self.bboxes[index], self.image_analysis_result[index],
+                            self.test_result[index], self.request_time[index])
+
+    def flip(self):
+        """ Flip the axis order of the bounding boxes
+
+        :return RequestTable: Table with flipped bounding boxes
+        """
+        return RequestTable(self.bboxes[:, [1, 0, 3, 2]], self.image_analysis_result,
+                            self.test_result, self.request_time)
+
+    def valid_mask(self):
+        """ Find requests with a successful response and an image analysis result
+
+        :return numpy array: Boolean mask of valid requests
+        """
+        return ((self.test_result == 0)
+                & (self.image_analysis_result != RequestTable.MISSING))
+
+    def timed_mask(self):
+        """ Find requests with a requestTime
+
+        :return numpy array: Boolean mask of requests with a requestTime
+        """
+        return self.request_time != RequestTable.NO_TIME
+
+    def inside_mask(self, extent, flip=False):
+        """ Find requests whose bounding box is completely within the extent
+
+        :param list extent: Extent as (minx, miny, maxx, maxy)
+        :param boolean flip: test bounding boxes with flipped axis order;
+                             defaults to False
+
+        :return numpy array: Boolean mask of requests inside the extent
+        """
+        order = [1, 0, 3, 2] if flip else [0, 1, 2, 3]
+        return ((self.bboxes[:, order[0]] >= extent[0]) & (self.bboxes[:, order[1]] >= extent[1])
+                & (self.bboxes[:, order[2]] <= extent[2]) & (self.bboxes[:, order[3]] <= extent[3]))
+
+    def to_geojson(self):
+        """ Convert the requests to geojson features
+
+        :return FeatureCollection: Closed polygons following the edges
+                                   of the bounding boxes
+        """
+        features = []
+        for i, bbox in enumerate(self.bboxes.tolist()):
+            g = Polygon([[(bbox[0], bbox[1]), (bbox[0], bbox[3]),
+                          (bbox[2], bbox[3]), (bbox[2], bbox[1]), (bbox[0], bbox[1])]])
+            props = {
+                'imageAnalysisResult': int(self.image_analysis_result[i]),
+                'testResult': int(self.test_result[i]),
+                'requestTime': int(self.request_time[i]) \
+                               if self.request_time[i] != RequestTable.NO_TIME else None
+            }
+            features.append(Feature(geometry=g, properties=props))
+
+        return FeatureCollection(features)
+
+
+def parse_responses(responses, newer_than=None):
+    """Convert responses to a columnar request table.
+
+    Bounding boxes of responses missing imageAnalysisResult or
+    testResult, or with a failed test result, are not parsed and
+    are set to NaN. Responses without requestTime get NO_TIME.
+    Attributes set to null are treated as missing.
 
-    :param tuple layer_bbox: Bounding box as specified in the service metadata
     :param list responses: list of original responses
-    :param CRS object crs: Contains information related to CRS
-    :param boolean sample: only get every tenth element; defaults to False
+    :param int newer_than: Responses with this or an earlier requestTime
+                           are left out, responses without requestTime are
+                           kept (see filter_requests); defaults to None,
+                           which means all
+
+    :return RequestTable: Requests in the order of the responses
+    """
+    if newer_than is not None:
+        responses = [res for res in responses if is_newer(res, newer_than)]
+
+    count = len(responses)
+    bbox_strings = []
+    image_analysis_result = np.full(count, RequestTable.MISSING, dtype=np.int64)
+    test_result = np.full(count, RequestTable.MISSING, dtype=np.int64)
+    request_time = np.full(count, RequestTable.NO_TIME, dtype=np.int64)
+
+    for i, res in enumerate(responses):
+        if res.get('imageAnalysisResult') is not None:
+            image_analysis_result[i] = res['imageAnalysisResult']
+        if res.get('testResult') is not None:
+            test_result[i] = res['testResult']
+        if res.get('requestTime') is not None:
+            request_time[i] = res['requestTime']
+
+        if (res.get('imageAnalysisResult') is None or res.get('testResult') is None
+                or res['testResult'] != 0):
+            bbox_strings.append("nan,nan,nan,nan")
+        else:
+            bbox_strings.append(res['bBox'])
+
+    if count > 0:
+        bboxes = np.array(",".join(bbox_strings).split(","), dtype=np.float64).reshape(-1, 4)
+    else:
+        bboxes = np.empty((0, 4))
+
+    # Only 0 matters in testResult, clipping keeps other codes distinct from it.
+    limit = np.iinfo(np.int8).max
+    return RequestTable(bboxes,
+                        np.clip(image_analysis_result, -limit - 1, limit).astype(np.int8),
+                        np.clip(test_result, -limit - 1, limit).astype(np.int8),
+                        request_time)
+
+
+def is_newer(response, newer_than):
+    """Check if a response is newer than a requestTime
+
+    :param dict response: Original response
+    :param int newer_than: requestTime to compare to
+
+    :return boolean: True if the response is newer or has no requestTime
+    """
+    return response.get('requestTime') is None or response['requestTime'] > newer_than
+
+
+def is_ndjson(path):
+    """Check if a response file is in newline delimited JSON format
+
+    In NDJSON format the first line contains the header (layerKey etc.)
+    and every following line one result.
+
+    :param str path: Path to the response file
+
+    :return boolean: True if the file is NDJSON
+    """
+    return path.endswith('.ndjson') or path.endswith('.jsonl')
+
+
+def read_response_header(path):
+    """Read the header and the first result of a response file
+
+    Only the beginning of the file is read when streaming is possible.
+
+    :param str path: Path to the response file
+
+    :return:
+        dict layer_key: layerKey of the response file
+        dict first_result: First result or None if there are no results
+    """
+    with open(path) as source:
+        if is_ndjson(path):
+            layer_key = json.loads(source.readline())['layerKey']
+            line = source.readline()
+            first_result = json.loads(line) if line.strip() else None
+
+        elif ijson is not None:
+            layer_key = next(ijson.items(source, 'layerKey'))
+            source.seek(0)
+            first_result = next(ijson.items(source, 'results.item'), None)
+
+        else:
+            logging.warning("ijson not installed, reading the whole response file.")
+            responses_file = json.load(source)
+            layer_key = responses_file['layerKey']
+            first_result = next(iter(responses_file['results']), None)
+
+    return layer_key, first_result
+
+
+def iter_responses(path):
+    """Iterate over the results of a response file one by one
+
+    :param str path: Path to the response file
+
+    :return generator: Results as dicts
+    """
+    with open(path) as source:
+        if is_ndjson(path):
+            # Skip header
+            source.readline()
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+        elif ijson is not None:
+            for res in ijson.items(source, 'results.item'):
+                yield res
+
+        else:
+            logging.warning("ijson not installed, reading the whole response file.")
+            for res in json.load(source)['results']:
+                yield res
+
+
+def iter_response_tables(path, chunk_size=CHUNK_SIZE, newer_than=None):
+    """Stream a response file as request tables of limited size
+
+    :param str path: Path to the response file
+    :param int chunk_size: Maximum number of requests in a table
+    :param int newer_than: see parse_responses
+
+    :return generator: RequestTables in the order of the file
+    """
+    chunk = []
+    for res in iter_responses(path):
+        if newer_than is not None and not is_newer(res, newer_than):
+            continue
+        chunk.append(res)
+        if len(chunk) == chunk_size:
+            yield parse_responses(chunk)
+            chunk = []
+
+    if len(chunk) > 0:
+        yield parse_responses(chunk)
+
+
+def filter_requests(table, extent, flip_features=False, require_time=False):
+    """Select valid requests which are completely within the extent
+
+    :param RequestTable table: Requests to be filtered
+    :param list extent: Extent as (minx, miny, maxx, maxy)
     :param boolean flip_features: flip coordinate order; defaults to False
+    :param boolean require_time: leave out requests without requestTime, for
+                                 results that depend on it; defaults to False
+
+    :return:
+        RequestTable requests: Valid requests within the extent
+        int invalid_request_count: Number of requests with failed response
+        int bbox_out_count: Number of valid requests outside of the extent
+        int untimed_request_count: Number of valid requests within the extent
+                                   left out because they have no requestTime
+    """
+    valid = table.valid_mask()
+    inside = table.inside_mask(extent, flip_features)
 
-    :return list: Geojson elements
+    invalid_request_count = np.count_nonzero(~valid)
+    bbox_out_count = np.count_nonzero(valid & ~inside)
+
+    selected = valid & inside
+    untimed_request_count = 0
+    if require_time:
+        untimed_request_count = np.count_nonzero(selected & ~table.timed_mask())
+        selected &= table.timed_mask()
+
+    requests = table.subset(selected)
+    if flip_features is True:
+        requests = requests.flip()
+
+    return requests, invalid_request_count, bbox_out_count, untimed_request_count
+
+
+def log_filtered_requests(invalid_request_count, bbox_out_count, untimed_request_count=0):
+    """Log how many requests were filtered away
+
+    :param int invalid_request_count: Number of requests with failed response
+    :param int bbox_out_count: Number of valid requests outside of the layer bbox
+    :param int untimed_request_count: Number of valid requests without requestTime
+    """
+    if invalid_request_count > 0:
+        logging.info("Filtered {} requests away due to failed request." \
+                     .format(invalid_request_count))
+
+    if bbox_out_count > 0:
+        logging.info("Filtered {} requests away because".format(bbox_out_count)  \
+                      + " request bbox was not completely within layer bbox")
+
+    if untimed_request_count > 0:
+        logging.warning("Filtered {} requests away because they have no requestTime"\
+                        .format(untimed_request_count))
+
+
+class RequestStream(object):
+    """Valid requests within the layer, streamed from a response file
+    as RequestTables of limited size.
+
+    The first chunk is parsed when the stream is created, to detect
+    the axis order unless it is given, and it is reused by the first
+    iteration. The stream can be iterated several times; later
+    iterations read the file again.
     """
-    features = []
 
+    def __init__(self, path, layer_bbox, crs, flip_features=None, chunk_size=CHUNK_SIZE,
+                 newer_than=None, require_time=False):
+        """ Open the stream and decide the axis order
+
+        :param str path: Path to the response file
+        :param tuple layer_bbox: Bounding box as specified in the service metadata
+        :param CRS object crs: Contains information related to CRS
+        :param boolean flip_features: flip coordinate order; defaults to None,
+                                      which means detecting the order from the
+                                      first chunk
+        :param int chunk_size: Maximum number of responses parsed at a time
+        :param int newer_than: see parse_responses
+        :param boolean require_time: see filter_requests
+
+        :raises Exception: if the order must be detected and there are no responses
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.newer_than = newer_than
+        self.require_time = require_time
+        self.extent = get_layer_extent(layer_bbox, crs)
+
+        tables = iter_response_tables(path, chunk_size, newer_than)
+        first_table = next(tables, None)
+        if flip_features is None:
+            if first_table is None:
+                raise Exception("No results in {}, can't detect the axis order".format(path))
+            flip_features = detect_axis_order(first_table, self.extent)
+        self.flip_features = flip_features
+        self._first_pass = (first_table, tables)
+
+    def __iter__(self):
+        if self._first_pass is not None:
+            first_table, tables = self._first_pass
+            self._first_pass = None
+            if first_table is not None:
+                tables = itertools.chain([first_table], tables)
+        else:
+            tables = iter_response_tables(self.path, self.chunk_size, self.newer_than)
+
+        invalid_request_count = 0
+        bbox_out_count = 0
+        untimed_request_count = 0
+
+        logging.info("Streaming requests from {}".format(self.path))
+        for table in tables:
+            requests, invalid, out, untimed = filter_requests(table, self.extent,
+                                                              self.flip_features,
+                                                              self.require_time)
+            invalid_request_count += invalid
+            bbox_out_count += out
+            untimed_request_count += untimed
+            yield requests
+
+        log_filtered_requests(invalid_request_count, bbox_out_count, untimed_request_count)
+
+
+def get_layer_extent(layer_bbox, crs):
+    """Get the extent within which requests are included in the analysis.
+
+    :param tuple layer_bbox: Bounding box as specified in the service metadata
+    :param CRS object crs: Contains information related to CRS
+
+    :return list extent: Rounded bounding box in the axis order of the requests
+    """
     if not is_first_axis_east(crs):
         layer_bbox = change_bbox_axis_order(layer_bbox)
 
-
     unit = crs.axis_info[0].unit_name
     if unit == 'metre' or 'meter':
         extent = [math.floor(layer_bbox[0]), math.floor(layer_bbox[1]),
@@ -97,105 +453,106 @@ def get_bboxes_as_geojson(layer_bbox, responses, crs, sample=False, flip_feature
         extent = [math.floor(layer_bbox[0]*c)/c, math.floor(layer_bbox[1]*c)/c,
                   math.ceil(layer_bbox[2]*c)/c, math.ceil(layer_bbox[3]*c)/c]
     else:
-        raise Exception("Unknown unit type '{}'. Error in get_bboxes_as_geojson".format(unit))
+        raise Exception("Unknown unit type '{}'. Error in get_layer_extent".format(unit))
 
-    invalid_request_count = 0
-    bbox_out_count = 0
+    return extent
 
-    count = 0
 
-    '''
-    coords_min = [float('inf'), float('inf')]
-    coords_max = [float('-inf'), float('-inf')]
-    '''
+def get_request_table(layer_bbox, responses, crs, sample=False, flip_features=None,
+                      newer_than=None, require_time=False):
+    """Convert responses to a table of valid requests within the layer.
 
-    logging.info("Creating geojson objects.")
-    for res in responses:
-        count += 1
-        # If in sampling mode, only process 1 out of 10 features
-        if sample is True:
-            if count % 10 != 0:
-                continue
+    Unless the axis order is given, both orders are tested in one pass
+    by counting the valid requests that are inside the layer bounding
+    box. The order with more hits is used, the declared order wins ties.
 
-        if count % 1000 == 0:
-            logging.debug("Result no. {}".format(count))
+    :param tuple layer_bbox: Bounding box as specified in the service metadata
+    :param responses: list of original responses or a RequestTable
+    :param CRS object crs: Contains information related to CRS
+    :param boolean sample: only get every tenth element; defaults to False
+    :param boolean flip_features: flip coordinate order; defaults to None,
+                                  which means detecting the order
+    :param int newer_than: see parse_responses
+    :param boolean require_time: see filter_requests
+
+    :return:
+        RequestTable table: Valid requests within the layer bounding box
+        boolean features_flipped: True if the coordinate order was flipped
+    """
+    if isinstance(responses, RequestTable):
+        table = responses
+        if newer_than is not None:
+            table = table.subset((table.request_time > newer_than) | ~table.timed_mask())
+    else:
+        logging.info("Creating request table.")
+        table = parse_responses(responses, newer_than)
 
-        # Filter out invalid test results
-        if ('imageAnalysisResult' not in res.keys() or 'testResult' not in res.keys()
-                or res['testResult'] != 0):
-            invalid_request_count += 1
-            continue
+    # If in sampling mode, only process 1 out of 10 requests
+    if sample is True:
+        table = table.subset(slice(9, None, 10))
 
-        # Convert bbox as a list.
-        bbox = list(map(float, res['bBox'].split(',')))
+    extent = get_layer_extent(layer_bbox, crs)
 
+    if flip_features is None:
+        features_flipped = detect_axis_order(table, extent)
+    else:
+        features_flipped = flip_features
 
-        inside = [
-            bbox[0] >= extent[0],
-            bbox[1] >= extent[1],
-            bbox[2] <= extent[2],
-            bbox[3] <= extent[3],
-        ]
+    requests, invalid_request_count, bbox_out_count, untimed_request_count = \
+        filter_requests(table, extent, features_flipped, require_time)
+    log_filtered_requests(invalid_request_count, bbox_out_count, untimed_request_count)
 
-        # Filter out requests out of the interest area
-        if not all(inside):
-            bbox_out_count += 1
-            continue
+    # With a known order there may just be no new requests.
+    if len(requests) == 0 and flip_features is None:
+        raise Exception("Coordinate order problem!")
 
-        '''
-        if bbox_out_count == 0:
-            for i in range(len(coords_min)):
-                if bbox[i] < coords_min[i]:
-                    coords_min[i] = bbox[i]
-            for i in range(len(coords_max)):
-                if bbox[i + len(coords_max)] > coords_max[i]:
-                    coords_max[i] = bbox[i  + len(coords_max)]
-        '''
-
-
-        # Create a closed Polygon following the edges of the bbox.
-        if flip_features is True:
-            g = Polygon([[(bbox[1], bbox[0]), (bbox[3], bbox[0]),
-                          (bbox[3], bbox[2]), (bbox[1], bbox[2]), (bbox[1], bbox[0])]])
-        else:
-            g = Polygon([[(bbox[0], bbox[1]), (bbox[0], bbox[3]),
-                          (bbox[2], bbox[3]), (bbox[2], bbox[1]), (bbox[0], bbox[1])]])
+    return requests, features_flipped
 
 
-        # Save other data
-        props = {
-            'imageAnalysisResult': res['imageAnalysisResult'],
-            'testResult': res['testResult'],
-            'requestTime': res['requestTime']
-        }
-        feat = Feature(geometry=g, properties=props)
+def detect_axis_order(table, extent):
+    """Find out which axis order places the requests within the extent
 
-        features.append(feat)
+    :param RequestTable table: Requests
+    :param list extent: Extent as (minx, miny, maxx, maxy)
 
-    if invalid_request_count > 0:
-        logging.info("Filtered {} requests away due to failed request." \
-                     .format(invalid_request_count))               
+    :return boolean: True if the coordinate order should be flipped
+    """
+    valid = table.valid_mask()
+    valid_count = np.count_nonzero(valid)
+    hits = np.count_nonzero(valid & table.inside_mask(extent))
+    flipped_hits = np.count_nonzero(valid & table.inside_mask(extent, flip=True))
 
+    if valid_count > 0:
+        logging.info("Requests inside layer bbox: {:.1%} with declared axis order, "
+                     "{:.1%} with flipped axis order ({} valid requests)"
+                     .format(hits / valid_count, flipped_hits / valid_count, valid_count))
+
+    if hits == 0 and flipped_hits == 0:
+        raise Exception("Coordinate order problem!")
+
+    if flipped_hits > hits:
+        logging.warning("More requests within layer bounding box with flipped axis order. "
+                        + "Using flipped axis order.")
+        return True
+
+    return False
 
-    if bbox_out_count > 0:
-        logging.info("Filtered {} requests away because".format(bbox_out_count)  \
-                      + " request bbox was not completely within layer bbox")
 
-    '''else:
-        self.bbox = coords_min + coords_max
-        logging.info("Bounding box set to the extent of all requests to {}".format(self.bbox))'''
+def get_bboxes_as_geojson(layer_bbox, responses, crs, sample=False, flip_features=None):
+    """Convert response file to geojson geometries.
 
-    features_flipped = False
+    imageAnalysisResult is included to the geojson features.
 
-    if len(features) == 0:
-        if flip_features:
-            raise Exception("Coordinate order problem!")
-        logging.warning("No features found within layer bounding box."
-                        + "Trying again with different axis order.")
-        features, features_flipped = get_bboxes_as_geojson(layer_bbox, responses, crs,
-                                                           sample=sample, flip_features=True)
-        features_flipped = True
+    :param tuple layer_bbox: Bounding box as specified in the service metadata
+    :param list responses: list of original responses
+    :param CRS object crs: Contains information related to CRS
+    :param boolean sample: only get every tenth element; defaults to False
+    :param boolean flip_features: flip coordinate order; defaults to None,
+                                  which means detecting the order
 
-    feat_c = FeatureCollection(features)
+    :return list: Geojson elements
+    """
+    requests, features_flipped = get_request_table(layer_bbox, responses, crs,
+                                                   sample=sample, flip_features=flip_features)
 
-    return feat_c, features_flipped
+    return requests.to_geojson(), features_flipped
@@ -0,0 +1,146 @@
+"""layerstate.py
+
+Persistent density rasters of a layer, so that a new monitoring
+result file only needs to add the requests made after the previous
+run instead of counting the whole history again.
+
+The state of a layer holds the raster grid, the eval and norm
+counters, the number of requests counted and the newest requestTime
+counted (the high-water mark). With decay weights the counters are
+weighted so that a request at the high-water mark has weight 1, and
+they are decayed to the new mark before new requests are added.
+
+"""
+
+import os
+import hashlib
+import logging
+import datetime
+import numpy as np
+
+from Algorithm import fit_dtype, normalize_decayed_rasters
+
+# logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
+logging.basicConfig(filename="../../output_data/logs/" \
+                    + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
+                    + '.log', level=logging.INFO)
+
+
+def get_layer_state_path(state_dir, url, layer_name):
+    """Get the path of the state of a layer
+
+    :param str state_dir: Directory of the states
+    :param str url: URL of the service
+    :param str layer_name: Name of the layer
+
+    :return str: Path to the state file
+    """
+    name = hashlib.sha1("{} {}".format(url, layer_name).encode()).hexdigest()
+    return os.path.join(state_dir, name + ".npz")
+
+
+def get_grid_definition(grid):
+    """Get the values that define a raster grid
+
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+
+    :return list: Height, width, the six transform coefficients and the CRS
+    """
+    return [str(value) for value in
+            [grid.height, grid.width] + list(grid.transform)[:6] + [grid.crs]]
+
+
+def load_layer_state(path, grid, half_life=None):
+    """Load the state of a layer
+
+    A state computed with a different grid or half-life can't be used,
+    since the counters would have to be computed again from all requests.
+
+    :param str path: Path to the state file
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param float half_life: Half-life of the request weights; defaults to None
+
+    :return dict: eval_raster, norm_raster, request_counter, high_water_mark,
+                  flip_features and half_life, or None if there is no usable state
+    """
+    if not os.path.exists(path):
+        logging.info("No layer state in {}, counting all requests".format(path))
+        return None
+
+    with np.load(path) as stored:
+        if stored['grid'].tolist() != get_grid_definition(grid):
+            logging.warning("Layer state {} has a different raster grid, counting all requests"\
+                            .format(path))
+            return None
+        # States without decay weights may be stored without a half-life.
+        stored_half_life = float(stored['half_life']) if 'half_life' in stored.files else 0.0
+        if stored_half_life != float(half_life or 0):
+            logging.warning("Layer state {} has a different half-life, counting all requests"\
+                            .format(path))
+            return None
+        state = {
+            'eval_raster': stored['eval_raster'],
+            'norm_raster': stored['norm_raster'],
+            'request_counter': int(stored['request_counter']),
+            'high_water_mark': int(stored['high_water_mark']),
+            'flip_features': bool(stored['flip_features']),
+            'half_life': stored_half_life,
+        }
+
+    logging.info("Layer state loaded from {}: {} requests until requestTime {}"\
+                 .format(path, state['request_counter'], state['high_water_mark']))
+    return state
+
+
+def save_layer_state(path, grid, state):
+    """Store the state of a layer
+
+    The file is written to a temporary path first, so an interrupted
+    run leaves the previous state intact.
+
+    :param str path: Path to the state file
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param dict state: see load_layer_state
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as target:
+        np.savez(target, grid=np.array(get_grid_definition(grid)), **state)
+    os.replace(tmp_path, path)
+    logging.info("Layer state saved to {}".format(path))
+
+
+def add_to_layer_state(state, density, high_water_mark, flip_features, half_life=None):
+    """Add density rasters of new requests to the state of a layer
+
+    :param dict state: see load_layer_state; None if there is no state yet
+    :param tuple density: Density rasters and request count of the new requests,
+                          see compute_density_rasters
+    :param int high_water_mark: Newest requestTime of the new requests
+    :param boolean flip_features: Axis order of the requests
+    :param float half_life: Half-life of the request weights; defaults to None
+
+    :return dict: The updated state
+    """
+    eval_raster, norm_raster, request_counter = density
+    if state is not None:
+        if half_life:
+            # Decay the stored counters from the old mark to the new one.
+            normalize_decayed_rasters(state['eval_raster'], state['norm_raster'],
+                                      state['high_water_mark'],
+                                      max(high_water_mark, state['high_water_mark']), half_life)
+        request_counter += state['request_counter']
+        dtype = fit_dtype(str(np.result_type(eval_raster, state['eval_raster'])),
+                          request_counter)
+        eval_raster = np.add(state['eval_raster'], eval_raster, dtype=dtype)
+        norm_raster = np.add(state['norm_raster'], norm_raster, dtype=dtype)
+        high_water_mark = max(high_water_mark, state['high_water_mark'])
+
+    return {
+        'eval_raster': eval_raster,
+        'norm_raster': norm_raster,
+        'request_counter': request_counter,
+        'high_water_mark': high_water_mark,
+        'flip_features': flip_features,
+        'half_life': float(half_life or 0),
+    }
@@ -0,0 +1,125 @@
+"""manifest.py
+
+Keeps record of the files a batch process has finished, so that
+an interrupted or repeated batch run can skip them. Each finished
+file is stored with a hash of its inputs: the monitoring result
+file, the Capabilities.xml document and the configuration values
+that affect the result. A file is processed again if any of these
+change, if its output files are missing or if its validation didn't
+succeed.
+
+The manifest is a file in the output directory with one JSON
+object per line. Lines are only appended, so the manifest stays
+usable even if the batch is killed while writing it.
+
+"""
+
+import os
+import json
+import hashlib
+import logging
+import datetime
+
+# logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
+logging.basicConfig(filename="../../output_data/logs/" \
+                    + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
+                    + '.log', level=logging.INFO)
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def file_digest(path):
+    """Compute SHA-256 hash of a file
+
+    :param str path: Path to the file
+
+    :return str: Hash as a hex string
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def task_key(file_config):
+    """Compute a hash of the inputs of processing one file
+
+    Paths in the [data] section are left out. The files they point
+    to are hashed instead, so moving the data doesn't change the key.
+    The name of the response file is included, because output file
+    names are based on it.
+
+    :param dict file_config: Configuration as a dictionary of sections
+
+    :return str: Hash as a hex string
+    """
+    options = {section: values for section, values in file_config.items() if section != 'data'}
+
+    sha = hashlib.sha256()
+    sha.update(os.path.basename(file_config['data']['response_file']).encode())
+    sha.update(file_digest(file_config['data']['response_file']).encode())
+    sha.update(file_digest(file_config['data']['get_capabilities']).encode())
+    sha.update(json.dumps(options, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def load_manifest(output_dir):
+    """Read the manifest of finished files
+
+    :param str output_dir: Directory containing the manifest
+
+    :return dict: Manifest entries by task key
+    """
+    manifest = {}
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return manifest
+
+    with open(path) as source:
+        for line in source:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line may be incomplete if the batch was killed.
+                logging.warning("Skipping broken line in manifest: {}".format(line))
+                continue
+            manifest[entry['key']] = entry
+
+    return manifest
+
+
+def add_to_manifest(output_dir, key, summary):
+    """Record a finished file in the manifest
+
+    :param str output_dir: Directory containing the manifest
+    :param str key: Task key, see task_key
+    :param dict summary: Task summary with file name and output paths
+    """
+    entry = {'key': key, 'file': summary['file'], 'outputs': summary['outputs'],
+             'validated': summary['validated'],
+             'validation_skipped': summary.get('validation_skipped', False),
+             'finished': datetime.datetime.now().isoformat()}
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'a') as manifest_file:
+        manifest_file.write(json.dumps(entry) + "\n")
+        manifest_file.flush()
+
+
+def is_up_to_date(manifest, key):
+    """Check if a file has been processed with the same inputs
+
+    :param dict manifest: Manifest entries by task key
+    :param str key: Task key, see task_key
+
+    :return boolean: True if the file is in the manifest, it was validated
+                     or validation was skipped on purpose, and all of
+                     its output files exist
+    """
+    entry = manifest.get(key)
+    if entry is None:
+        return False
+    # Entries of earlier versions may have a failed validation.
+    if not (entry.get('validated') or entry.get('validation_skipped')):
+        return False
+    return all(os.path.isfile(path) for path in entry['outputs'])
@@ -21,10 +21,17 @@ import datetime
 import pdb
 import json
 
-from Algorithm import solve
-from Validate import validate
-from InputData import get_resolution, get_service_type, get_bboxes_as_geojson
-from ResultData import create_empty_raster, convert_to_vector_format
+from Algorithm import THRESHOLD_CONSTANT, REFINE_TILE_SIZE, solve, solve_pyramid, solve_sweep, \
+    solve_periods, solve_refined, compute_density_rasters, get_coarser_grid, get_finer_grid
+from Validate import ValidationOptions, validate, validate_sweep
+from InputData import RequestTable, get_resolution, get_service_type, get_request_table, \
+    read_response_header, RequestStream
+from ResultData import SMOOTHING_FACTOR, SIMPLIFICATION_FACTOR, get_raster_grid, \
+    write_raster, convert_to_vector_format
+from StageCache import StageCache, hash_file, hash_arrays
+from HttpCache import get_http_cache
+from LayerState import get_layer_state_path, load_layer_state, save_layer_state, \
+    add_to_layer_state
 from Projection import CRS, solve_first_axis_direction
 from Capabilities import get_layer_bbox
 
@@ -59,6 +66,28 @@ class Process(object):
             self.bin_raster_path = cfg.get('data', 'binary_raster_output_path')
         except (configparser.NoOptionError, configparser.NoSectionError):
             self.bin_raster_path = self.output_dir + "bin_" + file + ".tif"
+        try:
+            self.write_binary_raster = cfg.getboolean('result', 'write_binary_raster')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.write_binary_raster = True
+        try:
+            self.pyramid_levels = cfg.getint('result', 'pyramid_levels')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.pyramid_levels = 0
+        try:
+            self.threshold_constants = [float(value) for value in
+                                        cfg.get('result', 'threshold_constants').split(',')
+                                        if value.strip()]
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.threshold_constants = []
+        try:
+            self.time_period = cfg.get('result', 'time_period') or None
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.time_period = None
+        try:
+            self.sweep_validation = cfg.getboolean('result', 'sweep_validation')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.sweep_validation = False
         try:
             self.val_raster_output_path = cfg.get('data', 'validation_raster_output_path')
         except (configparser.NoOptionError, configparser.NoSectionError):
@@ -67,20 +96,131 @@ class Process(object):
             self.max_features_for_validation = int(cfg.get('other', 'max_features_for_validation'))
         except (configparser.NoOptionError, configparser.NoSectionError):
             self.max_features_for_validation = None
+        defaults = ValidationOptions()
+        try:
+            wms_tiles = cfg.getint('other', 'wms_validation_tiles')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            wms_tiles = defaults.wms_tiles
+        try:
+            validation_workers = cfg.getint('other', 'validation_workers')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            validation_workers = defaults.workers
+        try:
+            max_connections_per_host = cfg.getint('other', 'max_connections_per_host')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            max_connections_per_host = defaults.max_connections_per_host
+        try:
+            wms_grid = cfg.getint('other', 'wms_validation_grid')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            wms_grid = defaults.wms_grid
+        try:
+            wfs_partitions = cfg.getint('other', 'wfs_validation_partitions')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            wfs_partitions = defaults.wfs_partitions
+        self.validation_options = ValidationOptions(wms_tiles, validation_workers,
+                                                    max_connections_per_host, wfs_partitions,
+                                                    get_http_cache(cfg), wms_grid)
+        try:
+            self.density_engine = cfg.get('other', 'density_engine')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.density_engine = 'diff'
+        try:
+            self.density_dtype = cfg.get('other', 'density_dtype')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.density_dtype = 'int32'
+        try:
+            self.tile_size = cfg.getint('other', 'tile_size')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.tile_size = None
+        try:
+            self.refine_levels = cfg.getint('other', 'refine_levels')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.refine_levels = 0
+        try:
+            self.density_workers = cfg.getint('other', 'density_workers')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.density_workers = 1
+        try:
+            # Days to milliseconds, the unit of requestTime
+            self.half_life = cfg.getfloat('other', 'half_life')*24*60*60*1000 or None
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.half_life = None
 
-        with open(response_file_path) as source:
-            self.responses_file = json.load(source)
+        try:
+            self.capabilities_cache_dir = cfg.get('data', 'capabilities_cache_dir')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.capabilities_cache_dir = None
+        try:
+            self.stream_responses = cfg.getboolean('other', 'stream_responses')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.stream_responses = False
+        try:
+            self.cache = StageCache(cfg.get('data', 'stage_cache_dir'))
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.cache = None
+        try:
+            self.state_dir = cfg.get('data', 'state_dir')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.state_dir = None
+
+        if self.threshold_constants and (self.tile_size or self.pyramid_levels):
+            raise Exception("threshold_constants can't be used with tile_size or pyramid_levels")
+        if self.time_period and (self.threshold_constants or self.pyramid_levels
+                                 or self.state_dir):
+            raise Exception("time_period can't be used with threshold_constants, "
+                            "pyramid_levels or state_dir")
+        if self.time_period and (self.tile_size or self.density_workers > 1 or self.half_life
+                                 or self.density_engine != 'diff'):
+            logging.warning("Time periods are counted with the diff engine in one process, "
+                            "tile_size, density_workers, half_life and density_engine not used")
+            self.tile_size = None
+            self.half_life = None
+        if self.refine_levels and (self.threshold_constants or self.pyramid_levels
+                                   or self.time_period or self.state_dir):
+            raise Exception("refine_levels can't be used with threshold_constants, "
+                            "pyramid_levels, time_period or state_dir")
+        if self.refine_levels and (self.density_workers > 1 or self.half_life
+                                   or self.density_engine != 'diff'):
+            logging.warning("Refinement is computed with the diff engine in one process, "
+                            "density_workers, half_life and density_engine not used")
+            self.half_life = None
+        if self.state_dir and self.tile_size:
+            logging.warning("The layer state keeps the whole rasters, tile_size is not used")
+            self.tile_size = None
+        if self.half_life and self.tile_size:
+            logging.warning("Tiled processing doesn't support decay weights, tile_size not used")
+            self.tile_size = None
+
+        # Requests without requestTime can't be weighted, binned by period
+        # or ordered against the layer state, so these modes leave them out.
+        self.require_time = bool(self.half_life or self.time_period or self.state_dir)
+
+        # When streaming, results are read in chunks during the algorithm
+        # and never kept in memory all at once. With the stage cache the
+        # results are only read if the request table is not cached.
+        if self.stream_responses or self.cache:
+            self.responses_header, first_response = read_response_header(response_file_path)
+            self.responses = None
+        else:
+            with open(response_file_path) as source:
+                self.responses_file = json.load(source)
+            self.responses_header = self.responses_file['layerKey']
+            self.responses = self.responses_file['results']
+            first_response = self.responses[0] if self.responses else None
+        if first_response is None:
+            raise Exception("No results in the response file {}".format(response_file_path))
 
         self.max_raster_size = int(cfg.get('other', 'max_raster_size'))
-
-        self.responses_header = self.responses_file['layerKey']
-        self.responses = self.responses_file['results']
+        try:
+            self.max_tiled_raster_size = cfg.getint('other', 'max_tiled_raster_size')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            self.max_tiled_raster_size = self.max_raster_size
 
         self.layer_name = self.responses_header['layerName']
 
-        self.service_type = get_service_type(capabilities_path)
+        self.service_type = get_service_type(capabilities_path, self.capabilities_cache_dir)
         try:
-            self.service_version = self.responses[0]['url'].split("VERSION=")[1].split("&")[0]
+            self.service_version = first_response['url'].split("VERSION=")[1].split("&")[0]
         except:
             self.service_version = None
 
@@ -99,26 +239,316 @@ class Process(object):
         cfg_resolution = int(cfg.get('result', 'resolution'))
         self.resolution = get_resolution(self.crs, cfg_resolution)
 
-        self.url = self.responses[0]['url'].split("?")[0]
+        self.url = first_response['url'].split("?")[0]
 
 
         self.layer_bbox = get_layer_bbox(capabilities_path, self.layer_name,
-                                         self.crs, self.service_type)
-
-        self.features, self.flip_features = get_bboxes_as_geojson(self.layer_bbox,
-                                                                  self.responses, self.crs)
-        self.raster, self.resolution = create_empty_raster(self.output_dir + "/" + "tmp.tif", \
-                                                           self.crs, self.layer_bbox, self.resolution, \
-                                                           max_raster_size=self.max_raster_size)
-
-
+                                         self.crs, self.service_type,
+                                         self.capabilities_cache_dir)
+
+        # Only counting is bounded by the tiles, smoothing, vectorizing and validation
+        # still need the whole raster. A bigger raster has to be allowed on purpose.
+        tiled = self.tile_size and not (self.pyramid_levels or self.refine_levels)
+        self.grid, self.resolution = get_raster_grid(self.crs, self.layer_bbox, self.resolution,
+                                                     self.max_tiled_raster_size if tiled \
+                                                     else self.max_raster_size)
+
+        # With a layer state only requests after its high-water mark are counted.
+        self.layer_state = None
+        newer_than = None
+        if self.state_dir:
+            self.layer_state_path = get_layer_state_path(self.state_dir, self.url,
+                                                         self.layer_name)
+            self.layer_state = load_layer_state(self.layer_state_path, self.grid, self.half_life)
+            if self.layer_state:
+                newer_than = self.layer_state['high_water_mark']
+
+        if self.cache:
+            key_params = (hash_file(response_file_path), self.layer_bbox, self.crs.crs_code,
+                          self.crs.first_axis_dir)
+            if newer_than is not None:
+                key_params += (newer_than,)
+            if self.require_time:
+                key_params += ('require_time',)
+            self.requests_key = self.cache.key('requests', *key_params)
+        self.load_requests(response_file_path, newer_than)
+
+
+
+    def load_requests(self, response_file_path, newer_than=None):
+        """ Read the requests of the layer, from the stage cache if possible
+
+        :param str response_file_path: Path to the response file
+        :param int newer_than: Only read requests with a later requestTime,
+                               see parse_responses; defaults to None
+        """
+
+        # The axis order of a layer with a state is already known.
+        flip_features = self.layer_state['flip_features'] if self.layer_state else None
+
+        if self.stream_responses:
+            # The axis order is decided from the first chunk, which is
+            # parsed only once.
+            self.requests = RequestStream(response_file_path, self.layer_bbox, self.crs,
+                                          flip_features, newer_than=newer_than,
+                                          require_time=self.require_time)
+            self.flip_features = self.requests.flip_features
+            return
+
+        cached = self.cache.load_arrays('requests', self.requests_key) if self.cache else None
+        if cached:
+            self.flip_features = bool(cached.pop('flip_features'))
+            self.requests = RequestTable(**cached)
+            return
+
+        if self.responses is None:
+            with open(response_file_path) as source:
+                self.responses = json.load(source)['results']
+        self.requests, self.flip_features = get_request_table(self.layer_bbox,
+                                                              self.responses, self.crs,
+                                                              flip_features=flip_features,
+                                                              newer_than=newer_than,
+                                                              require_time=self.require_time)
+        if self.cache:
+            self.cache.store_arrays('requests', self.requests_key,
+                                    bboxes=self.requests.bboxes,
+                                    image_analysis_result=self.requests.image_analysis_result,
+                                    test_result=self.requests.test_result,
+                                    request_time=self.requests.request_time,
+                                    flip_features=self.flip_features)
+
+    def get_density_rasters(self):
+        """ Compute the density rasters, or load them from the stage cache
+
+        :return tuple: see compute_density_rasters
+        """
+        key = self.cache.key('density', self.requests_key, self.grid, self.density_dtype,
+                             self.half_life)
+        cached = self.cache.load_arrays('density', key)
+        if cached:
+            return cached['eval_raster'], cached['norm_raster'], int(cached['request_counter'])
+
+        density = compute_density_rasters(self.requests, self.grid, self.density_engine,
+                                          self.density_dtype, self.density_workers,
+                                          self.half_life)
+        self.cache.store_arrays('density', key, eval_raster=density[0],
+                                norm_raster=density[1], request_counter=density[2])
+        return density
+
+    def update_layer_state(self):
+        """ Add the new requests to the layer state and store it
+
+        :return tuple: Density rasters of all requests counted so far,
+                       see compute_density_rasters
+        """
+        requests = [self.requests] if isinstance(self.requests, RequestTable) else self.requests
+        request_times = []
+
+        def track_request_time(tables):
+            for table in tables:
+                if len(table) > 0:
+                    request_times.append(int(table.request_time.max()))
+                yield table
+
+        density = compute_density_rasters(track_request_time(requests), self.grid,
+                                          self.density_engine, self.density_dtype,
+                                          self.density_workers, self.half_life)
+        logging.info("{} new requests added to the layer state".format(density[2]))
+
+        self.layer_state = add_to_layer_state(self.layer_state, density,
+                                              max(request_times, default=0), self.flip_features,
+                                              self.half_life)
+        save_layer_state(self.layer_state_path, self.grid, self.layer_state)
+
+        return (self.layer_state['eval_raster'], self.layer_state['norm_raster'],
+                self.layer_state['request_counter'])
+
+    def load_binary_rasters(self, keys, grids, bin_paths):
+        """ Load binary rasters from the stage cache
+
+        Rasters are written to bin_paths as if they were computed.
+
+        :param list keys: Stage cache key of each raster
+        :param list grids: RasterGrid of each raster
+        :param list bin_paths: Path of each raster, None if not written
+
+        :return list: The rasters, or None if any of them is not cached
+        """
+        rasters = []
+        for key in keys:
+            cached = self.cache.load_arrays('binary', key)
+            if cached is None:
+                return None
+            rasters.append(cached['binary_raster'])
+
+        for raster, grid, bin_path in zip(rasters, grids, bin_paths or [None]*len(rasters)):
+            if bin_path:
+                write_raster(bin_path, raster, grid, nodata=99, nbits=1)
+        return rasters
+
+    def vectorize(self, binary_raster, grid, output_name, resolution, binary_key):
+        """ Convert a binary raster to vector format, or copy the result from the stage cache
+
+        See convert_to_vector_format.
+
+        :param numpy array binary_raster: Binary raster
+        :param RasterGrid grid: Shape, transform and CRS of the binary raster
+        :param str output_name: Name of the output files without extension
+        :param int resolution: Resolution of the raster
+        :param str binary_key: Stage cache key of the binary raster
+
+        :return tuple: spatial extent of the data
+        """
+        paths = [self.output_dir + output_name + ".geojson",
+                 self.output_dir + output_name + ".gpkg"]
+        if self.cache:
+            key = self.cache.key('vectors', binary_key, SMOOTHING_FACTOR, SIMPLIFICATION_FACTOR,
+                                 resolution, self.crs.crs_code, self.output_crs.crs_code,
+                                 self.output_crs.first_axis_dir, self.url, self.layer_name,
+                                 output_name)
+            metadata = self.cache.load_files('vectors', key, paths)
+            if metadata:
+                return tuple(metadata['bounds'])
+
+        bounds = convert_to_vector_format(self.crs, self.output_dir, resolution, binary_raster,
+                                          grid, output_name, self.output_crs, self.url,
+                                          self.layer_name)
+        if self.cache:
+            self.cache.store_files('vectors', key, paths, {'bounds': list(bounds)})
+        return bounds
 
     def run_algorithm(self):
 
-        solve(self.features, self.raster, self.bin_raster_path)
-        self.data_bounds = convert_to_vector_format(self.crs, self.output_dir, self.resolution,
-                                                    self.bin_raster_path, self.output_crs,
-                                                    self.url, self.layer_name)
+        output_name = self.bin_raster_path.split('/')[-1].rsplit('.', 1)[0]
+        level_names = ["{}_level{}".format(output_name, level)
+                       for level in range(1, self.pyramid_levels + 1)]
+        sweep_names = ["{}_threshold{}".format(output_name, threshold_constant)
+                       for threshold_constant in self.threshold_constants]
+        self.sweep_results = []
+        self.period_results = []
+
+        # Every binary raster produced, the main result first.
+        grids = [self.grid]
+        for level in range(self.refine_levels):
+            grids[0] = get_finer_grid(grids[0])
+        names = [output_name]
+        threshold_constants = [THRESHOLD_CONSTANT]
+        if self.pyramid_levels:
+            if self.tile_size:
+                logging.warning("Pyramid levels are computed without tiling")
+            for level in range(self.pyramid_levels):
+                grids.append(get_coarser_grid(grids[-1]))
+            names += level_names
+        elif self.threshold_constants:
+            # The main result is computed together with the sweep.
+            grids *= len(self.threshold_constants) + 1
+            names += sweep_names
+            threshold_constants += self.threshold_constants
+        bin_paths = [self.bin_raster_path] + [self.output_dir + name + ".tif"
+                                              for name in names[1:]]
+        if not self.write_binary_raster:
+            bin_paths = None
+
+        # The layer state is updated on every run, also when the results are cached.
+        density = None
+        if self.state_dir:
+            density = self.update_layer_state()
+
+        if self.cache:
+            # With a layer state the results depend on the counters, not on this file only.
+            if density is not None:
+                base_key = self.cache.key('state', hash_arrays(density[0], density[1]))
+            else:
+                base_key = self.requests_key
+            binary_keys = [self.cache.key('binary', base_key, self.grid, threshold_constant,
+                                          self.half_life, self.refine_levels)
+                           for threshold_constant in threshold_constants]
+            binary_keys += [self.cache.key('pyramid', base_key, self.grid, level,
+                                           THRESHOLD_CONSTANT, self.half_life)
+                            for level in range(1, self.pyramid_levels + 1)]
+            # The periods are only known after counting the requests.
+            rasters = None if self.time_period else \
+                self.load_binary_rasters(binary_keys, grids, bin_paths)
+        else:
+            binary_keys = [None]*len(grids)
+            rasters = None
+
+        if rasters is None:
+            # Tiled solve never keeps the density rasters of the whole layer.
+            if density is None and self.cache and not (self.tile_size and len(grids) == 1) \
+                    and not (self.time_period or self.refine_levels):
+                density = self.get_density_rasters()
+
+            if self.time_period:
+                binary_raster, self.period_results = solve_periods(
+                    self.requests, self.grid, self.time_period,
+                    bin_paths[0] if bin_paths else None,
+                    self.output_dir + output_name + "_periods.tif"
+                    if self.write_binary_raster else None,
+                    self.density_dtype)
+                rasters = [binary_raster]
+            elif self.refine_levels:
+                rasters = [solve_refined(self.requests, self.grid, self.refine_levels,
+                                         bin_paths[0] if bin_paths else None, self.density_dtype,
+                                         self.tile_size or REFINE_TILE_SIZE)[1]]
+            elif self.pyramid_levels:
+                levels = solve_pyramid(self.requests, self.grid, self.pyramid_levels, bin_paths,
+                                       self.density_engine, self.density_dtype,
+                                       self.density_workers, density, self.half_life)
+                rasters = [binary_raster for _, binary_raster in levels]
+            elif self.threshold_constants:
+                rasters = solve_sweep(self.requests, self.grid, threshold_constants, bin_paths,
+                                      self.density_engine, self.density_dtype,
+                                      self.density_workers, density, self.half_life)
+            else:
+                rasters = [solve(self.requests, self.grid, bin_paths[0] if bin_paths else None,
+                                 self.density_engine, self.density_dtype,
+                                 self.tile_size, self.density_workers, density,
+                                 self.half_life)]
+
+            if self.cache:
+                for key, binary_raster in zip(binary_keys, rasters):
+                    self.cache.store_arrays('binary', key, binary_raster=binary_raster)
+
+        self.binary_raster = rasters[0]
+        if self.refine_levels:
+            # The result has the grid of the finest level.
+            self.grid = grids[0]
+            self.resolution = self.resolution / 2**self.refine_levels
+        if self.threshold_constants:
+            self.sweep_results = list(zip(self.threshold_constants, rasters[1:]))
+
+        self.data_bounds = self.vectorize(self.binary_raster, self.grid, output_name,
+                                          self.resolution, binary_keys[0])
+
+        self.output_files = [self.output_dir + output_name + ".geojson",
+                             self.output_dir + output_name + ".gpkg"]
+        if self.write_binary_raster:
+            self.output_files.append(self.bin_raster_path)
+
+        if self.sweep_results and self.write_binary_raster:
+            self.output_files += bin_paths[1:]
+
+        # Coarser levels of the pyramid, the resolution doubles on each level
+        for level in range(1, self.pyramid_levels + 1):
+            name = names[level]
+            self.vectorize(rasters[level], grids[level], name, self.resolution*2**level,
+                           binary_keys[level])
+            self.output_files += [self.output_dir + name + ".geojson",
+                                  self.output_dir + name + ".gpkg"]
+            if self.write_binary_raster:
+                self.output_files.append(bin_paths[level])
+
+        # One result per time period, named by the start of the period
+        for label, binary_raster in self.period_results:
+            name = "{}_{}".format(output_name, label)
+            key = self.cache.key('period', base_key, self.grid, self.time_period, label,
+                                 THRESHOLD_CONSTANT) if self.cache else None
+            self.vectorize(binary_raster, self.grid, name, self.resolution, key)
+            self.output_files += [self.output_dir + name + ".geojson",
+                                  self.output_dir + name + ".gpkg"]
+        if self.period_results and self.write_binary_raster:
+            self.output_files.append(self.output_dir + output_name + "_periods.tif")
 
 
 if __name__ == '__main__':
@@ -138,7 +568,18 @@ if __name__ == '__main__':
 
     # validation of the result.
     validate(process.url, process.layer_name, process.crs.crs_code,
-             process.layer_bbox, process.bin_raster_path,
+             process.layer_bbox, process.binary_raster, process.grid,
              process.val_raster_output_path, process.service_type,
              process.service_version, process.max_features_for_validation,
-             process.flip_features, process.data_bounds, process.service)
+             process.flip_features, process.data_bounds, process.service,
+             process.validation_options)
+
+    if process.sweep_results and process.sweep_validation:
+        validate_sweep(process.url, process.layer_name, process.crs.crs_code,
+                       process.layer_bbox, process.sweep_results, process.grid,
+                       process.val_raster_output_path, process.service_type,
+                       process.service_version, process.max_features_for_validation,
+                       process.flip_features, process.service, process.validation_options)
+
+    if process.validation_options.http_cache is not None:
+        process.validation_options.http_cache.evict()
@@ -1,34 +1,42 @@
 """result_data.py
 
-Includes functions for creating an empty raster with
-given parameters and for converting raster data into
-vector and saving it to disk.
+Includes functions for defining the raster grid with
+given parameters, for writing rasters to disk and for
+converting raster data into vector and saving it to disk.
 
 
 """
 
 import datetime
 import logging
+from collections import namedtuple
 from math import floor, ceil, log10
 import numpy as np
-import scipy.ndimage
 
 from shapely.geometry import shape, mapping, MultiPolygon
 from shapely.ops import transform as shapely_transform
 import rasterio
 from rasterio.features import shapes
+from rasterio.windows import Window
 import fiona
 import fiona.crs
 from pyproj import Transformer
 
 from Projection import is_first_axis_east
-from Algorithm import compute_density_rasters
 
 # logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
 logging.basicConfig(filename="../../output_data/logs/" \
                     + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
                     + '.log', level=logging.INFO)
 
+# See smooth_binary_raster
+SMOOTHING_FACTOR = 0.03
+
+# See convert_to_vector_format
+SIMPLIFICATION_FACTOR = 0.3
+
+# Rows of window counts computed at a time in majority_filter
+MAJORITY_FILTER_ROWS = 256
 
 
 def get_raster_shapes(resolution, bbox, crs):
@@ -69,24 +77,27 @@ def get_raster_shapes(resolution, bbox, crs):
 
     return height, width, transform
 
-def create_empty_raster(output_path, crs, bbox, resolution, max_raster_size, driver='GTiff'):
-    """Create an empty raster file with the provided parametres.
+# Definition of the analysis raster shared by all stages of the process
+RasterGrid = namedtuple('RasterGrid', ['height', 'width', 'transform', 'crs'])
+
+
+def get_raster_grid(crs, bbox, resolution, max_raster_size):
+    """Define the raster grid with the provided parametres.
 
-    :param str output_path: Path where the dataset is to be created
     :param CRS object crs: Contains information related to CRS
     :param list bbox: Spatial extent of the data as specified in the layer metadata
     :param int resolution: Default resolution of the raster
-    :param int max_raster_size: Maximum number of pixels for the raster
-    :param str driver: GDAL raster driver to create datasets
+    :param int max_raster_size: Maximum number of pixels for the raster;
+                                None means no limit
 
     :return:
-        str output_path: Path where the dataset was created
+        RasterGrid grid: Shape, transform and CRS of the raster
         int resolution: Pixel size of the raster
     """
 
     while True:
         height, width, transform = get_raster_shapes(resolution, bbox, crs)
-        if height*width <= max_raster_size:
+        if max_raster_size is None or height*width <= max_raster_size:
             break
         else:
             resolution = resolution*2
@@ -94,35 +105,132 @@ def create_empty_raster(output_path, crs, bbox, resolution, max_raster_size, dri
     logging.info("Resolution with which the analysis will be done set to: '{}' "
                  .format(resolution))
     logging.info("Raster size set to {}, {}".format(height, width))
-    # Init raster with zeros.
-    data = np.zeros(shape=(height, width))
 
-    # Create new dataset file
-    dataset = rasterio.open(
+    return RasterGrid(height, width, transform, crs.crs_code), resolution
+
+
+def open_raster(output_path, grid, dtype, nodata, driver='GTiff', count=1, **options):
+    """Create a raster on disk to be written in parts.
+
+    :param str output_path: Path where the dataset is to be created
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param str dtype: Data type of the values
+    :param nodata: Value for pixels without data
+    :param str driver: GDAL raster driver to create datasets
+    :param int count: Number of bands; defaults to 1
+    :param options: Creation options passed to the driver
+
+    :return rasterio dataset: Dataset opened in write mode
+    """
+
+    return rasterio.open(
         output_path,
         'w', # Write mode
         driver=driver,
-        nodata=-99,
-        height=height,
-        width=width,
-        count=1,
-        dtype=str(data.dtype),
-        crs=crs.crs_code,
-        transform=transform,
-    )
+        nodata=nodata,
+        height=grid.height,
+        width=grid.width,
+        count=count,
+        dtype=str(dtype),
+        crs=grid.crs,
+        transform=grid.transform,
+        **options)
 
-    # Write numpy matrix to the dataset.
-    dataset.write(data, 1)
-    dataset.close()
 
-    return output_path, resolution
+def write_raster(output_path, data, grid, nodata, driver='GTiff', descriptions=None,
+                 **options):
+    """Write a raster to disk.
 
+    :param str output_path: Path where the dataset is to be created
+    :param numpy array data: 2D array with the values of the raster,
+                             or 3D array with one band per layer
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param nodata: Value for pixels without data
+    :param str driver: GDAL raster driver to create datasets
+    :param list descriptions: Description of each band; defaults to None
+    :param options: Creation options passed to the driver
+    """
+
+    count = data.shape[0] if data.ndim == 3 else 1
+    with open_raster(output_path, grid, data.dtype, nodata, driver, count,
+                     **options) as dataset:
+        if data.ndim == 3:
+            dataset.write(data)
+        else:
+            dataset.write(data, 1)
+        for band, description in enumerate(descriptions or [], 1):
+            dataset.set_band_description(band, description)
+
+    logging.info("Raster written to {}".format(output_path))
+
+
+def get_tile_windows(grid, tile_size):
+    """Split the raster grid to square tiles
+
+    Tiles on the right and bottom edges may be smaller.
+
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param int tile_size: Side length of a tile in pixels
+
+    :return list: rasterio Windows of the tiles, row by row
+    """
+    return [Window(col_off, row_off, min(tile_size, grid.width - col_off),
+                   min(tile_size, grid.height - row_off))
+            for row_off in range(0, grid.height, tile_size)
+            for col_off in range(0, grid.width, tile_size)]
+
+
+def majority_filter(image, size):
+    """Smooth a binary raster with a majority filter
+
+    Counts the data pixels within a size x size window around each
+    pixel with a summed-area table, so the cost doesn't depend on
+    the window size. Pixels outside of the raster count as 0. For a
+    binary raster the result is the same as with
+    scipy.ndimage.median_filter(image, (size, size), mode='constant').
+    The table is accumulated in place in int32 (int64 for rasters of
+    2**31 pixels or more) and the counts are taken MAJORITY_FILTER_ROWS
+    rows at a time, so memory use is about 6 times the raster.
+
+    :param numpy array image: 2D binary raster; 1 means data
+    :param int size: Side length of the window in pixels
+
+    :return numpy array: Smoothed raster with the dtype of the input
+    """
+
+    # Same window placement as in scipy.ndimage for even sizes
+    before = size // 2
+    after = size - 1 - before
+
+    # A sum is at most the number of pixels.
+    height, width = image.shape
+    dtype = np.int32 if height*width < 2**31 else np.int64
+
+    # Extra zero row and column in front make the sums below uniform.
+    table = np.zeros((height + size, width + size), dtype=dtype)
+    np.equal(image, 1, out=table[before + 1:before + 1 + height, before + 1:before + 1 + width])
+    np.cumsum(table, axis=0, out=table)
+    np.cumsum(table, axis=1, out=table)
+
+    # Median of the window is the value at index n // 2 of the sorted values,
+    # which is 1 if there are at most n // 2 zeros.
+    window = size * size
+    threshold = window - window // 2
+
+    result = np.empty(image.shape, dtype=image.dtype)
+    for row in range(0, height, MAJORITY_FILTER_ROWS):
+        end = min(row + MAJORITY_FILTER_ROWS, height)
+        counts = table[row + size:end + size, size:] - table[row:end, size:]
+        counts -= table[row + size:end + size, :-size]
+        counts += table[row:end, :-size]
+        result[row:end] = counts >= threshold
+
+    return result
+
+
+def smooth_binary_raster(image):
+    """Smooth a binary raster with a majority (median) filter
 
-def convert_to_vector_format(crs, output_dir, resolution,
-                             input_file, output_crs, url, layer_name):
-    """Convert raster to vector format (GPKG and GeoJSON)
-    File names are based on the raster file name.
-    
     :const float SMOOTHING_FACTOR: constant used for adjusting smoothing
     of the result. Factor affects to the size of the smoothing kernel, which
     is calculated from the smaller side of the result. Final kernel size is
@@ -131,6 +239,22 @@ def convert_to_vector_format(crs, output_dir, resolution,
     pixel or bigger than the smaller side of image, smoothing is skipped.
     Experimentally good value is 0.03. Value must be between 0 and 1.
 
+    :param numpy array image: Binary raster created in algorithm.solve
+
+    :return numpy array: Smoothed raster of the same shape and dtype
+    """
+    smooth_kernel_size = round( min(image.shape) * SMOOTHING_FACTOR )
+    if smooth_kernel_size > 1 and smooth_kernel_size < min(image.shape):
+        return majority_filter(image, smooth_kernel_size)
+    return image
+
+
+def convert_to_vector_format(crs, output_dir, resolution, binary_raster, grid,
+                             output_name, output_crs, url, layer_name):
+    """Convert raster to vector format (GPKG and GeoJSON)
+    
+    The result is smoothed with smooth_binary_raster first.
+
     :const float SIMPLIFICATION_FACTOR: constant used for calculating tolerance
     for Douglas-Peucker simplification to simplify the result data.
     Final tolerance is resolution * SIMPLIFICATION_FACTOR. The bigger
@@ -140,7 +264,9 @@ def convert_to_vector_format(crs, output_dir, resolution,
     :param CRS object crs: Contains information related to CRS
     :param str output_dir: Path leading to directory where outputs are created
     :param int resolution: Default resolution of the raster
-    :param str input_file: Path to the binary raster created in algorithm.solve
+    :param numpy array binary_raster: Binary raster created in algorithm.solve
+    :param RasterGrid grid: Shape, transform and CRS of the binary raster
+    :param str output_name: Name of the output files without extension
     :param str output_crs: Coordinate system to be used for output file
     :param str url: URL that is added as an attribute
     :param str layer_name: layer_name that is added as an attribute
@@ -148,69 +274,57 @@ def convert_to_vector_format(crs, output_dir, resolution,
     :return tuple: spatial extent of the data
     """
 
-    dst_layername = input_file.split('/')[-1].rsplit('.', 1)[0]
+    image = binary_raster
 
-    with rasterio.open(input_file, driver='GTiff', mode='r') as src:
-        image = src.read(1)
+    pixels = smooth_binary_raster(image)
 
-        # Smooth output with median filter
-        SMOOTHING_FACTOR = 0.03
-        smooth_kernel_size = round( min(image.shape) * SMOOTHING_FACTOR )
-        if smooth_kernel_size > 1 and smooth_kernel_size < min(image.shape):
-            pixels = scipy.ndimage.median_filter(image,
-                                                 (smooth_kernel_size, smooth_kernel_size),
-                                                 mode='constant')
-        else:
-            pixels = image
-
-        # Mask value is 1, which means data
-        mask = pixels == 1
+    # Mask value is 1, which means data
+    mask = pixels == 1
 
-        # Tolerance for douglas peucker simplification
-        SIMPLIFICATION_FACTOR = 0.3
-        if SIMPLIFICATION_FACTOR > 0:
-            tol = resolution / SIMPLIFICATION_FACTOR
-        else:
-            tol = 0
+    # Tolerance for douglas peucker simplification
+    if SIMPLIFICATION_FACTOR > 0:
+        tol = resolution / SIMPLIFICATION_FACTOR
+    else:
+        tol = 0
 
-        # Transformation initialization
-        if crs != output_crs:
-            tr = Transformer.from_crs(crs, output_crs,
-                                      always_xy=is_first_axis_east(output_crs)).transform
-        else:
-            tr = None
+    # Transformation initialization
+    if crs != output_crs:
+        tr = Transformer.from_crs(crs, output_crs,
+                                  always_xy=is_first_axis_east(output_crs)).transform
+    else:
+        tr = None
 
-        # Transformation and convertion from shapely shape to geojson-like object for fiona.
-        feats = []
-        feats_original_crs = []
-        for (s, v) in shapes(pixels, mask=mask, transform=src.transform):
-            shp = shape(s).simplify(tol)
-            feats_original_crs.append(shp)
-            if tr:
-                shp = shapely_transform(tr, shp)
-            feats.append(shp)
+    # Transformation and convertion from shapely shape to geojson-like object for fiona.
+    feats = []
+    feats_original_crs = []
+    for (s, v) in shapes(pixels, mask=mask, transform=grid.transform):
+        shp = shape(s).simplify(tol)
+        feats_original_crs.append(shp)
+        if tr:
+            shp = shapely_transform(tr, shp)
+        feats.append(shp)
 
-        # Create multipolygon and add properties to it.
-        feature = MultiPolygon(feats)
-        result = {'geometry': mapping(feature), 'properties':
-                  {'resolution': resolution, 'url': url, 'layer_name': layer_name}}
+    # Create multipolygon and add properties to it.
+    feature = MultiPolygon(feats)
+    result = {'geometry': mapping(feature), 'properties':
+              {'resolution': resolution, 'url': url, 'layer_name': layer_name}}
 
-        results_gpkg = ({'geometry': mapping(f), 'properties': {}} for f in feats)
+    results_gpkg = ({'geometry': mapping(f), 'properties': {}} for f in feats)
 
     # Geojson output
     with fiona.open(
-        output_dir + dst_layername + ".geojson", 'w',
+        output_dir + output_name + ".geojson", 'w',
         driver="GeoJSON",
-        crs=fiona.crs.from_string(output_crs.to_proj4()) if output_crs else src.crs,
+        crs=fiona.crs.from_string(output_crs.to_proj4()) if output_crs else grid.crs,
         schema={'geometry': feature.type, 'properties':
                 {'resolution': 'int', 'url': 'str', 'layer_name': 'str'}},
         VALIDATE_OPEN_OPTIONS=False) as dst:
 
         # GPKG output
         with fiona.open(
-            output_dir + dst_layername + ".gpkg", 'w',
+            output_dir + output_name + ".gpkg", 'w',
             driver="GPKG",
-            crs=fiona.crs.from_string(output_crs.to_proj4()) if output_crs else src.crs,
+            crs=fiona.crs.from_string(output_crs.to_proj4()) if output_crs else grid.crs,
             schema={'geometry': 'Polygon', 'properties': {}}) as gpkg_dst:
 
             # Write datasets
@@ -0,0 +1,168 @@
+"""stagecache.py
+
+Content addressed cache for the outputs of the processing stages:
+request table, density rasters, binary rasters and vectors.
+
+The key of an output is a hash of the input file and of the
+parameters the stage depends on. Keys of later stages are built
+from the keys of earlier stages, so changing a parameter only
+invalidates the stages which come after it.
+
+"""
+
+import os
+import json
+import shutil
+import zipfile
+import hashlib
+import logging
+import datetime
+import numpy as np
+
+# logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
+logging.basicConfig(filename="../../output_data/logs/" \
+                    + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
+                    + '.log', level=logging.INFO)
+
+# Part of every key. Increase when the content of a stage output changes,
+# so that outputs of older versions are not used.
+CACHE_VERSION = 2
+
+# Size of the blocks in which input files are hashed; in bytes
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """Hash the content of a file
+
+    :param str path: Path to the file
+
+    :return str: Hex digest of the content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_arrays(*arrays):
+    """Hash the content of arrays
+
+    :param arrays: numpy arrays
+
+    :return str: Hex digest of the shapes, data types and values
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(repr((array.shape, array.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+class StageCache(object):
+    """Stage outputs stored in a directory, one subdirectory per stage.
+
+    Arrays are stored as .npz files, files (e.g. vectors) as a directory
+    of copies with a metadata document. Entries are written to a temporary
+    path first, so several processes can share the directory.
+    """
+
+    def __init__(self, cache_dir):
+        """ Set up the cache
+
+        :param str cache_dir: Directory of the cache, created when needed
+        """
+        self.cache_dir = cache_dir
+
+    def key(self, stage, *params):
+        """Build the key of a stage output
+
+        :param str stage: Name of the stage
+        :param params: Input hash or key of the previous stage, and the
+                       parameters the stage depends on. Their repr is hashed,
+                       so they must have a stable one.
+
+        :return str: The key
+        """
+        return hashlib.sha1(repr((CACHE_VERSION, stage) + params).encode()).hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def _tmp_path(self, path):
+        return "{}.{}.tmp".format(path, os.getpid())
+
+    def load_arrays(self, stage, key):
+        """Load arrays stored by store_arrays
+
+        :param str stage: Name of the stage
+        :param str key: Key of the output
+
+        :return dict: The arrays by name, or None if not cached
+        """
+        path = self._path(stage, key) + ".npz"
+        try:
+            with np.load(path) as cached:
+                arrays = {name: cached[name] for name in cached.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            logging.info("Stage cache miss: {} {}".format(stage, key))
+            return None
+        logging.info("Stage cache hit: {} {}".format(stage, key))
+        return arrays
+
+    def store_arrays(self, stage, key, **arrays):
+        """Store arrays of a stage output
+
+        :param str stage: Name of the stage
+        :param str key: Key of the output
+        :param arrays: The arrays by name
+        """
+        path = self._path(stage, key) + ".npz"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(tmp_path, path)
+
+    def load_files(self, stage, key, output_paths):
+        """Copy files stored by store_files to their output paths
+
+        :param str stage: Name of the stage
+        :param str key: Key of the output
+        :param list output_paths: Where to copy the files, in the order they were stored
+
+        :return dict: Metadata stored with the files, or None if not cached
+        """
+        path = self._path(stage, key)
+        try:
+            with open(os.path.join(path, "metadata.json")) as source:
+                metadata = json.load(source)
+            for i, output_path in enumerate(output_paths):
+                shutil.copyfile(os.path.join(path, str(i)), output_path)
+        except (OSError, ValueError):
+            logging.info("Stage cache miss: {} {}".format(stage, key))
+            return None
+        logging.info("Stage cache hit: {} {}".format(stage, key))
+        return metadata
+
+    def store_files(self, stage, key, paths, metadata):
+        """Store files of a stage output
+
+        :param str stage: Name of the stage
+        :param str key: Key of the output
+        :param list paths: The files
+        :param dict metadata: JSON serializable data stored with the files
+        """
+        path = self._path(stage, key)
+        tmp_path = self._tmp_path(path)
+        os.makedirs(tmp_path, exist_ok=True)
+        for i, file_path in enumerate(paths):
+            shutil.copyfile(file_path, os.path.join(tmp_path, str(i)))
+        with open(os.path.join(tmp_path, "metadata.json"), 'w') as target:
+            json.dump(metadata, target)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same output first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
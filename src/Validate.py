@@ -8,22 +8,95 @@ import os
 import logging
 import io
 import csv
+import fcntl
 import pdb
 import datetime
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import numpy as np
 from PIL import Image
 from osgeo import ogr, gdal
 import rasterio.features
-import geojson
+from rasterio.windows import Window, bounds as window_bounds
+import shapely.wkb
 import requests
+from requests.adapters import HTTPAdapter
+
+from ResultData import write_raster, smooth_binary_raster
+from LayerState import get_grid_definition
 
 # logging levels = DEBUG, INFO, WARNING, ERROR, CRITICAL
 logging.basicConfig(filename="../../output_data/logs/" \
                     + datetime.datetime.now().strftime("%d.%b_%Y_%H_%M_%S") \
                     + '.log', level=logging.INFO)
 
+# Width and height of the WMS images fetched for validation; in pixels
+WMS_IMAGE_SIZE = 256
+
+# Time to wait for a server to respond; in seconds
+HTTP_TIMEOUT = 60
+
+# Number of WFS features burned into the validation raster at a time
+RASTERIZE_CHUNK_SIZE = 1000
+
+# Settings of validation which don't depend on the layer.
+#   wms_tiles: Number of tiles per side in WMS validation, see validate_wms_tiles;
+#              0 means one image of the whole layer compared on a grid of wms_grid cells
+#   workers: Number of threads fetching data
+#   max_connections_per_host: Maximum number of simultaneous requests to one server
+#   wfs_partitions: Number of parts per side in WFS validation, see validate_wfs;
+#                   0 means the whole layer at once
+#   http_cache: HttpCache of the fetched data; None means no cache
+#   wms_grid: Number of grid cells per side when one WMS image is compared, see test_for_var
+ValidationOptions = namedtuple('ValidationOptions',
+                               ['wms_tiles', 'workers', 'max_connections_per_host',
+                                'wfs_partitions', 'http_cache', 'wms_grid'],
+                               defaults=[0, 8, 4, 0, None, 3])
+
+
+class ValidationSkipped(Exception):
+    """Validation of a layer is skipped on purpose, e.g. because it has
+    more features than max_features_for_validation. Fetching the data
+    again wouldn't help, unlike when the server can't be reached.
+    """
+
+
+
 
+def append_statistics(stats_path, headers, rows):
+    """Append rows to a statistics spreadsheet.
 
+    Several processes may write to the same file, so the file is locked
+    and the header is written only if the file is still empty.
+
+    :param str stats_path: Path to the csv file
+    :param list headers: Column names
+    :param list rows: Rows to be written
+    """
+    with open(stats_path, "a") as stats_file:
+        fcntl.flock(stats_file, fcntl.LOCK_EX)
+        writer = csv.writer(stats_file)
+        if stats_file.seek(0, os.SEEK_END) == 0:
+            writer.writerow(headers)
+        writer.writerows(rows)
+        stats_file.flush()
+        fcntl.flock(stats_file, fcntl.LOCK_UN)
+
+    logging.info("Statistics written to {}".format(stats_path))
+
+
+def get_statistics_path(output_path, prefix="stats_"):
+    """Get the path of the statistics spreadsheet of the day
+
+    :param str output_path: Path to a file in the folder of the statistics
+    :param str prefix: Beginning of the file name; defaults to "stats_"
+
+    :return str: The path
+    """
+    return os.path.split(output_path)[0] + "/" + prefix \
+           + datetime.datetime.now().strftime("%d.%b_%Y") + ".csv"
 
 
 def write_statistics(output_path, service_number, layer_name, pixels_count, correct_pixels,
@@ -45,28 +118,36 @@ def write_statistics(output_path, service_number, layer_name, pixels_count, corr
                                   area with data as determined by the tool;
                                   expressed in % of the original bounding box
     """
-    stats_path = os.path.split(output_path)[0] + "/stats_"\
-                               + datetime.datetime.now().strftime("%d.%b_%Y") + ".csv"
-
-    if not os.path.isfile(stats_path):
-        with open(stats_path, "w") as stats_file:
-            headers = ["Service number", "Layer name", "Pixel count",\
-                       "Correct", "False positives", "False negatives",\
-                       "Area of new bounding box in %% of original"]
-            row = [service_number, layer_name, pixels_count, correct_pixels,\
-                   false_pos_pixels, false_neg_pixels, bbox_area_decrease]
-            writer = csv.writer(stats_file)
-            writer.writerow(headers)
-            writer.writerow(row)
+    stats_path = get_statistics_path(output_path)
 
-    else:
-        with open(stats_path, "a") as stats_file:
-            row = [service_number, layer_name, pixels_count, correct_pixels,\
-                   false_pos_pixels, false_neg_pixels, bbox_area_decrease]
-            writer = csv.writer(stats_file)
-            writer.writerow(row)
+    headers = ["Service number", "Layer name", "Pixel count",\
+               "Correct", "False positives", "False negatives",\
+               "Area of new bounding box in %% of original"]
+    row = [service_number, layer_name, pixels_count, correct_pixels,\
+           false_pos_pixels, false_neg_pixels, bbox_area_decrease]
+    append_statistics(stats_path, headers, [row])
 
-    logging.info("Statistics written to {}".format(stats_path))
+
+def write_sweep_statistics(output_path, service_number, layer_name, rows):
+    """Write statistics of a threshold sweep to a spreadsheet.
+
+    The file has the same columns as the one of write_statistics,
+    and the threshold constant of each result.
+
+    :param str output_path: Path to the folder where statistics file will be written
+    :param str service_number: Number of the service
+    :param str layer_name: Name of the layer
+    :param list rows: For each threshold constant a list of the constant, pixel count,
+                      correct, false positive and false negative pixels and the
+                      area of the new bounding box, see write_statistics
+    """
+    stats_path = get_statistics_path(output_path, "sweep_stats_")
+
+    headers = ["Service number", "Layer name", "Threshold constant", "Pixel count",\
+               "Correct", "False positives", "False negatives",\
+               "Area of new bounding box in %% of original"]
+    append_statistics(stats_path, headers,
+                      [[service_number, layer_name] + list(row) for row in rows])
 
 
 def area_decrease(bbox, data_bounds):
@@ -88,6 +169,20 @@ def area_decrease(bbox, data_bounds):
     return round(x_decr*y_decr*100)
 
 
+def has_variation(low, high):
+    """Decide from the extreme values of arrays if there is variation in them
+
+    An array has no variation if all its values are the same and
+    either 0 or 255, i.e. empty or fully opaque.
+
+    :param low: Minimum value of each array
+    :param high: Maximum value of each array
+
+    :return: True where there is variation
+    """
+    return ~((low == high) & ((low == 0) | (low == 255)))
+
+
 def test_pixel(image):
     """Search for variation in a numpy array
 
@@ -95,52 +190,123 @@ def test_pixel(image):
 
     :return boolean: Return True if there is variation in the array
     """
-    uniques = np.unique(image)
-    if len(uniques) == 1 and uniques[0] in [0, 255]:
-        return False
+    if image.size == 0:
+        return True
 
-    return True
+    return bool(has_variation(image.min(), image.max()))
 
 
-def test_for_var(image):
-    """Search for variation within each part of a 3x3 grid of the input image.
+def get_cell_bounds(size, cells):
+    """Split a length to cells of (nearly) equal size
+
+    :param int size: Length to split
+    :param int cells: Number of cells
+
+    :return numpy array: Cell i covers bounds[i]:bounds[i + 1]
+    """
+    return np.linspace(0, size, cells + 1).round().astype(int)
+
+
+def test_for_var(image, rows=3, cols=3):
+    """Search for variation within each part of a grid of the input image.
 
     If variation is found, corresponding value in the data_grid
-    is set to True. If not, it is set to False.
+    is set to True. If not, it is set to False, see test_pixel. The
+    image is split as evenly as possible, see get_cell_bounds.
 
-    :param numpy array image: Array of numerical values
+    The minimum and maximum of all cells are computed at once with
+    reduceat, so the cost doesn't depend on the number of cells.
+
+    :param numpy array image: Array of numerical values, 2D or with the
+                              bands (e.g. RGBA) on the third axis
+    :param int rows: Number of rows of the grid; defaults to 3
+    :param int cols: Number of columns of the grid; defaults to 3
 
     :return numpy array data_grid: Array of boolean values
     """
-    data_grid = np.empty([3, 3])
-    size_x = round(image.shape[0]/data_grid.shape[0])
-    size_y = round(image.shape[1]/data_grid.shape[1])
+    height, width = image.shape[:2]
+    row_bounds = get_cell_bounds(height, rows)
+    col_bounds = get_cell_bounds(width, cols)
+    empty = (np.diff(row_bounds) == 0)[:, np.newaxis] | (np.diff(col_bounds) == 0)
+    if height == 0 or width == 0:
+        return empty
+
+    # reduceat needs start indices within the array; empty cells are
+    # overwritten below.
+    row_starts = np.minimum(row_bounds[:-1], height - 1)
+    col_starts = np.minimum(col_bounds[:-1], width - 1)
+
+    bands = image.reshape(height, width, -1)
+    low = np.minimum.reduceat(np.minimum.reduceat(bands, row_starts, axis=0),
+                              col_starts, axis=1).min(axis=2)
+    high = np.maximum.reduceat(np.maximum.reduceat(bands, row_starts, axis=0),
+                               col_starts, axis=1).max(axis=2)
+
+    # Empty cells have no values, which counts as variation like in test_pixel.
+    return has_variation(low, high) | empty
+
 
-    for m in range(3):
-        for k in range(3):
-            image_subset = image[m*size_x:(m+1)*size_x, k*size_y:(k+1)*size_y]
-            data_grid[m][k] = test_pixel(image_subset)
+def get_session(max_connections_per_host):
+    """Create an HTTP session which keeps connections open between requests
+
+    :param int max_connections_per_host: Connections kept open to one server
+
+    :return requests.Session: The session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_connections_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HostLimiter(object):
+    """Limit the number of simultaneous requests to each server.
+
+    Used as a context manager around a request:
+
+        with limiter.limit(url):
+            session.get(url)
+    """
 
-    return data_grid
+    def __init__(self, max_connections_per_host):
+        """ Set up the limiter
 
+        :param int max_connections_per_host: Maximum number of simultaneous
+                                             requests to one server
+        """
+        self.max_connections_per_host = max_connections_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
 
+    def limit(self, url):
+        """Get the semaphore of the server of a URL
 
-def validate_wms(url, layer_name, srs, bbox, result_array, service_version):
-    """Fetch image for the corresponding layer and search for variation with
-       the same parameters in both the image and the result produced by the tool.
+        :param str url: URL of the request
+
+        :return threading.BoundedSemaphore: The semaphore
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                    self.max_connections_per_host)
+            return self._semaphores[host]
+
+
+def get_wms_url(url, layer_name, srs, bbox, service_version, width=WMS_IMAGE_SIZE,
+                height=WMS_IMAGE_SIZE):
+    """Build a GetMap URL
 
     :param str url: First part of URL pointing to a particular service
     :param str layer_name: Name of the layer
     :param str srs: EPSG code of a coordinate system
-    :param list bbox: Bounding box as specified in the service metadata
-    :param numpy array result_array: Array of boolean values; result
-                                    of executing the main part of the tool.
-    :param str service_version: Number of correctly determined pixels
-    :return numpy array real_data: Information on variation within grid areas
-                                   in image fetched from the server.
-    :return numpy array our_grid:  Information on variation within grid areas
-                                   in raster produced by the tool.
+    :param str bbox: Bounding box in the axis order of the request
+    :param str service_version: Version of the service
+    :param int width: Width of the image; defaults to WMS_IMAGE_SIZE
+    :param int height: Height of the image; defaults to WMS_IMAGE_SIZE
 
+    :return str: The URL
     """
     if srs == "CRS:84":
         srs = "EPSG:4326"
@@ -149,69 +315,219 @@ def validate_wms(url, layer_name, srs, bbox, result_array, service_version):
     if service_version is None:
         service_version = "1.3.0"
     if service_version == "1.3.0":
-        req_url = "{}?VERSION={}&SERVICE=WMS&REQUEST=GetMap&LAYERS={}&STYLES=&CRS={}\
-                   &BBOX={}&WIDTH=256&HEIGHT=256&FORMAT=image/png&EXCEPTIONS=XML"\
-                   .format(url, service_version, layer_name, srs, bbox)
+        crs_param = "CRS"
     elif service_version == "1.1.1":
-        req_url = "{}?VERSION={}&SERVICE=WMS&REQUEST=GetMap&LAYERS={}&STYLES=&SRS={}\
-                   &BBOX={}&WIDTH=256&HEIGHT=256&FORMAT=image/png&EXCEPTIONS=XML"\
-                   .format(url, service_version, layer_name, srs, bbox)
+        crs_param = "SRS"
     else:
         raise Exception("Unknown service_version {}".format(service_version))
 
+    return "{}?VERSION={}&SERVICE=WMS&REQUEST=GetMap&LAYERS={}&STYLES=&{}={}&BBOX={}" \
+           "&WIDTH={}&HEIGHT={}&FORMAT=image/png&EXCEPTIONS=XML"\
+           .format(url, service_version, layer_name, crs_param, srs, bbox, width, height)
+
+
+def fetch_wms_image(url, layer_name, srs, bbox, service_version, session=None, cache=None):
+    """Fetch image of the layer from the server.
+
+    :param str url: First part of URL pointing to a particular service
+    :param str layer_name: Name of the layer
+    :param str srs: EPSG code of a coordinate system
+    :param str bbox: Bounding box as specified in the service metadata
+    :param str service_version: Version of the service
+    :param requests.Session session: Session used for the request; defaults to None,
+                                     which means a new connection
+    :param HttpCache cache: Cache of the responses; defaults to None
+
+    :return numpy array: The image, or None if it couldn't be read
+    """
+    req_url = get_wms_url(url, layer_name, srs, bbox, service_version)
+
     logging.info("URL used for validation: {}".format(req_url))
 
-    image_response = requests.get(req_url)
+    try:
+        if cache is not None:
+            content = cache.get(session or requests, req_url, HTTP_TIMEOUT)
+        else:
+            content = (session or requests).get(req_url, timeout=HTTP_TIMEOUT).content
+    except:
+        return None
 
     try:
-        image = np.array(Image.open(io.BytesIO(image_response.content)))
+        return np.array(Image.open(io.BytesIO(content)))
     except:
-        return None, None
+        # e.g. an exception report of the server, which must not be used again
+        if cache is not None:
+            cache.remove(req_url)
+        return None
 
-    real_data = test_for_var(image).astype("uint8")
 
-    our_grid = test_for_var(result_array).astype("uint8")
-    logging.info("WMS validation: data fetched from server:\n {}".format(real_data))
-    logging.info("WMS validation: our data:\n {}".format(our_grid))
-    return real_data, our_grid
+def get_validation_windows(grid, tiles):
+    """Split the result raster to tiles x tiles windows
 
-def validate_wfs(url, layer_name, srs, bbox, result_file,\
-                 service_version, max_features_for_validation):
-    """Fetch data for the corresponding layer and generate an array
-       that maps the spatial extent of the data
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+    :param int tiles: Number of tiles per side; at most the size of the raster
+
+    :return:
+        numpy array row_bounds: Row i of tiles covers rows row_bounds[i]:row_bounds[i + 1]
+        numpy array col_bounds: Column k of tiles covers columns col_bounds[k]:col_bounds[k + 1]
+        list windows: rasterio Windows of the tiles, row by row
+    """
+    row_bounds = get_cell_bounds(grid.height, tiles)
+    col_bounds = get_cell_bounds(grid.width, tiles)
+    windows = [Window(col_bounds[k], row_bounds[m], col_bounds[k + 1] - col_bounds[k],
+                      row_bounds[m + 1] - row_bounds[m])
+               for m in range(tiles) for k in range(tiles)]
+    return row_bounds, col_bounds, windows
+
+
+def get_window_bbox(window, grid, flip_features):
+    """Get the bounding box of a window of the result raster for a request
+
+    The axes of the raster are in the order of the layer extent the
+    requests were compared with, so the bounding box is flipped the
+    same way as the requests were, see get_request_table.
+
+    :param Window window: The window
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+    :param boolean flip_features: If set to True, coordinate order must be flipped
+
+    :return str: Bounding box as a string for the URL, see get_validation_bbox
+    """
+    bbox = [float(value) for value in window_bounds(window, grid.transform)]
+    return get_validation_bbox(bbox, flip_features)[1]
+
+
+def fetch_wms_tiles(url, layer_name, srs, bboxes, service_version, options):
+    """Fetch images of several bounding boxes concurrently
+
+    Requests are sent by options.workers threads over one session, which
+    keeps connections to the server open, and at most
+    options.max_connections_per_host requests are sent to a server at a time.
 
     :param str url: First part of URL pointing to a particular service
     :param str layer_name: Name of the layer
     :param str srs: EPSG code of a coordinate system
-    :param list bbox: Bounding box as specified in the service metadata
-    :param numpy array result_array: Array of boolean values; result
-                                    of executing the main part of the tool.
-    :param str service_version: Number of correctly determined pixels
-    :param string max_features_for_validation: If exceeded, validation is skipped
+    :param list bboxes: Bounding boxes as strings for the URL
+    :param str service_version: Version of the service
+    :param ValidationOptions options: Settings of validation
 
-    :return numpy array real_data: Information on the location of data in layer
-                                   fetched from the server.
+    :return list: The image of each bounding box, None if it couldn't be read
     """
+    limiter = HostLimiter(options.max_connections_per_host)
 
-    wfs_drv = ogr.GetDriverByName('WFS')
+    with get_session(options.max_connections_per_host) as session:
+        def fetch(bbox):
+            with limiter.limit(url):
+                return fetch_wms_image(url, layer_name, srs, bbox, service_version, session,
+                                       options.http_cache)
 
-    # get just the layer name (as opposed to a URL)
-    layer_name = layer_name.split(":")[-1]
+        with ThreadPoolExecutor(max_workers=options.workers) as executor:
+            return list(executor.map(fetch, bboxes))
 
-    # Speeds up querying WFS capabilities for services with alot of layers
-    gdal.SetConfigOption('OGR_WFS_LOAD_MULTIPLE_LAYER_DEFN', 'NO')
 
-    # Set config for paging. Works on WFS 2.0 services and WFS 1.0 and 1.1 with some other services.
-    gdal.SetConfigOption('OGR_WFS_PAGING_ALLOWED', 'YES')
-    gdal.SetConfigOption('OGR_WFS_PAGE_SIZE', '10000')
+def validate_wms_tiles(url, layer_name, srs, grid, service_version, flip_features, options):
+    """Fetch images of the layer in tiles and search for variation in each tile
 
-    # Fix for SSL connection errors
-    gdal.SetConfigOption('GDAL_HTTP_UNSAFESSL', 'YES')
+    The result raster is split to options.wms_tiles x options.wms_tiles
+    windows and an image of each window is fetched from the server, so
+    the data of the server and the result are compared on the same areas.
 
-    # Open the webservice
+    :param str url: First part of URL pointing to a particular service
+    :param str layer_name: Name of the layer
+    :param str srs: EPSG code of a coordinate system
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+    :param str service_version: Version of the service
+    :param boolean flip_features: If set to True, coordinate order must be flipped
+    :param ValidationOptions options: Settings of validation
+
+    :return numpy array real_data: 1 for tiles with variation in the image,
+                                   None if any of the images couldn't be read
+    """
+    tiles = min(options.wms_tiles, grid.height, grid.width)
+    _, _, windows = get_validation_windows(grid, tiles)
+    bboxes = [get_window_bbox(window, grid, flip_features) for window in windows]
+    logging.info("WMS validation with {} tiles".format(len(bboxes)))
+
+    images = fetch_wms_tiles(url, layer_name, srs, bboxes, service_version, options)
+    failed = sum(image is None for image in images)
+    if failed:
+        logging.error("{} of {} WMS tiles couldn't be read".format(failed, len(images)))
+        return None
+
+    real_data = np.array([test_pixel(image) for image in images], dtype='uint8')
+    return real_data.reshape(tiles, tiles)
+
+
+def get_feature_id(feature):
+    """Identify a feature fetched from a WFS service
+
+    OGR numbers the features of each connection from the start, so the
+    FID can't identify a feature fetched in different requests.
+
+    :param ogr Feature feature: The feature
+
+    :return str: gml_id of the feature, or None if the layer doesn't have it
+    """
+    index = feature.GetFieldIndex('gml_id')
+    if index >= 0 and feature.IsFieldSet(index):
+        return feature.GetFieldAsString(index)
+    return None
+
+
+def get_wfs_url(url, srs, bbox):
+    """Build the URL the features are fetched with by OGR
+
+    :param str url: First part of URL pointing to a particular service
+    :param str srs: EPSG code of a coordinate system
+    :param str bbox: Bounding box as a string for the URL
 
+    :return str: The URL, without the 'WFS:' prefix of OGR
+    """
     #TODO: use version -> if service_version is not None: ...
-    req_url = "{}?service=wfs&version=2.0.0&srsName={}&BBOX={}".format(url, srs, bbox)
+    return "{}?service=wfs&version=2.0.0&srsName={}&BBOX={}".format(url, srs, bbox)
+
+
+def burn_geometries(real_data, geometries, grid, lock):
+    """Burn geometries into a raster
+
+    :param numpy array real_data: 2D uint8 array, set to 1 where a geometry lies
+    :param list geometries: shapely geometries
+    :param RasterGrid grid: Shape, transform and CRS of the raster
+    :param threading.Lock lock: Held while writing to real_data
+    """
+    with lock:
+        rasterio.features.rasterize(geometries, out=real_data, transform=grid.transform)
+
+
+def burn_wfs_features(url, layer_name, srs, bbox, max_features_for_validation, real_data,
+                      grid, lock, seen=None):
+    """Fetch the features of a layer within a bounding box and burn them into a raster
+
+    Features are burned in chunks of RASTERIZE_CHUNK_SIZE while they are
+    read, so only one chunk of geometries is kept in memory. Every call
+    opens its own connection, so several bounding boxes can be fetched
+    at the same time in separate threads.
+
+    :param str url: First part of URL pointing to a particular service
+    :param str layer_name: Name of the layer without the namespace prefix
+    :param str srs: EPSG code of a coordinate system
+    :param str bbox: Bounding box as a string for the URL
+    :param string max_features_for_validation: If exceeded, validation is skipped
+    :param numpy array real_data: Raster where the features are burned, see burn_geometries
+    :param RasterGrid grid: Shape, transform and CRS of real_data
+    :param threading.Lock lock: Held while reading or writing seen and real_data
+    :param set seen: Ids of features already burned, see get_feature_id; features
+                     in it are skipped and new ones added. Features without
+                     an id are always burned. Defaults to None, which means
+                     all features are burned.
+
+    :return int: Number of features burned, or None if they couldn't be fetched
+
+    :raises ValidationSkipped: if there are more features than max_features_for_validation
+    """
+    wfs_drv = ogr.GetDriverByName('WFS')
+
+    req_url = get_wfs_url(url, srs, bbox)
     logging.info("URL used for validation: {}".format('WFS:' + req_url))
 
     wfs_ds = wfs_drv.Open('WFS:' + req_url)
@@ -220,8 +536,6 @@ def validate_wfs(url, layer_name, srs, bbox, result_file,\
         #raise Exception("Couldn't open connection to the server.")
         return None
 
-    shapes = []
-
     # Get a specific layer
     layer = wfs_ds.GetLayerByName(layer_name)
     if not layer:
@@ -233,7 +547,7 @@ def validate_wfs(url, layer_name, srs, bbox, result_file,\
         if feature_count > int(max_features_for_validation):
             logging.warning("Validation for layer {} skipped. there was too many features: {}"\
                             .format(layer.GetName(), layer.GetFeatureCount()))
-            return None
+            raise ValidationSkipped("too many features: {}".format(feature_count))
 
     logging.info("Layer: {}, Features: {}".format(layer.GetName(), feature_count))
 
@@ -243,6 +557,8 @@ def validate_wfs(url, layer_name, srs, bbox, result_file,\
 
     feat = layer.GetNextFeature()
     count = 0
+    burned = 0
+    geometries = []
 
     while feat is not None:
         count += 1
@@ -252,107 +568,219 @@ def validate_wfs(url, layer_name, srs, bbox, result_file,\
             log_every = 100
         if count % log_every == 0:
             logging.info("Feature: {}".format(count))
-        geom = feat.GetGeometryRef().GetLinearGeometry()
-        json_feat = geojson.loads(geom.ExportToJson())
-        shapes.append(json_feat)
+
+        is_new = True
+        feature_id = get_feature_id(feat) if seen is not None else None
+        if feature_id is not None:
+            with lock:
+                is_new = feature_id not in seen
+                seen.add(feature_id)
+        if is_new:
+            geom = feat.GetGeometryRef().GetLinearGeometry()
+            geometries.append(shapely.wkb.loads(bytes(geom.ExportToWkb())))
+        if len(geometries) == RASTERIZE_CHUNK_SIZE:
+            burn_geometries(real_data, geometries, grid, lock)
+            burned += len(geometries)
+            geometries = []
 
         feat = layer.GetNextFeature()
 
     feat = None
+    if geometries:
+        burn_geometries(real_data, geometries, grid, lock)
+        burned += len(geometries)
 
     # Close the connection
     wfs_ds = None
-    logging.info("Iteration done. Creating validation.")
-    if count == 0:
-        logging.info("No features in the layer.")
-        real_data = np.zeros_like(result_file.read(1))
-    else:
-        real_data = rasterio.features.rasterize(
-            shapes,
-            out_shape=result_file.shape,
-            transform=result_file.transform,
-            dtype='uint8'
-        )
-
-    return real_data
 
+    return burned
 
 
-def validate(url, layer_name, srs, bbox, result_path, output_path, service_type, service_version,\
-             max_features_for_validation, flip_features, data_bounds, service_number):
-
+def validate_wfs(url, layer_name, srs, bbox, grid,\
+                 service_version, max_features_for_validation, options=None,
+                 flip_features=False):
     """Fetch data for the corresponding layer and generate an array
        that maps the spatial extent of the data
 
+    With options.wfs_partitions the result raster is split to N x N
+    windows, and the features within each window are fetched at the
+    same time by options.workers threads, see burn_wfs_features.
+    Features crossing windows are fetched more than once, and burned
+    only once by their id; features without an id are burned again,
+    which doesn't change the raster. max_features_for_validation then applies to
+    each window, and bigger layers can be validated.
+
+    OGR sends the requests itself, so with options.http_cache the
+    resulting raster is cached instead of the responses, together with
+    the feature limit and partitions it was fetched with. It is used
+    for the time-to-live of the cache, and can't be revalidated.
+
     :param str url: First part of URL pointing to a particular service
     :param str layer_name: Name of the layer
     :param str srs: EPSG code of a coordinate system
-    :param list bbox: Bounding box as specified in the service metadata
-    :param str result_path: Path to raster file produced by the tool
-    :param str output_path: Path to location where the validation raster will be written.
-    :param str service_type: Type of service (WMS/WFS)
+    :param str bbox: Bounding box of the result raster, see get_window_bbox
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
     :param str service_version: Number of correctly determined pixels
     :param string max_features_for_validation: If exceeded, validation is skipped
+    :param ValidationOptions options: Settings of validation; defaults to None,
+                                      which means the defaults of ValidationOptions
     :param boolean flip_features: If set to True, coordinate order must be flipped
-                                  in the URL
-    :param list data_bounds: Bounding box that encapsulates
-                             area with data as determined by the tool
-    :param str service_number: Type of service (WMS/WFS)
 
+    :return numpy array real_data: Information on the location of data in layer
+                                   fetched from the server.
 
-    :return int: 0 if validation run OK; -1 if it failed.
+    :raises ValidationSkipped: see burn_wfs_features
+    """
+    options = options or ValidationOptions()
 
+    # get just the layer name (as opposed to a URL)
+    layer_name = layer_name.split(":")[-1]
 
-    """
+    # The limit applies to each part, so the parts decide if validation is skipped.
+    cache_params = (layer_name, get_grid_definition(grid), max_features_for_validation,
+                    options.wfs_partitions)
+    if options.http_cache is not None:
+        cached = options.http_cache.load(get_wfs_url(url, srs, bbox), *cache_params)
+        if cached is not None:
+            return np.load(io.BytesIO(cached))
 
-    logging.info("validation starts at {}".format(datetime.datetime.now()))
-    # Open the file to be validated
-    file = rasterio.open(result_path)
+    # Speeds up querying WFS capabilities for services with alot of layers
+    gdal.SetConfigOption('OGR_WFS_LOAD_MULTIPLE_LAYER_DEFN', 'NO')
 
+    # Set config for paging. Works on WFS 2.0 services and WFS 1.0 and 1.1 with some other services.
+    gdal.SetConfigOption('OGR_WFS_PAGING_ALLOWED', 'YES')
+    gdal.SetConfigOption('OGR_WFS_PAGE_SIZE', '10000')
+
+    # Fix for SSL connection errors
+    gdal.SetConfigOption('GDAL_HTTP_UNSAFESSL', 'YES')
+
+    bboxes = [bbox]
+    seen = None
+    if options.wfs_partitions > 1:
+        partitions = min(options.wfs_partitions, grid.height, grid.width)
+        _, _, windows = get_validation_windows(grid, partitions)
+        bboxes = [get_window_bbox(window, grid, flip_features) for window in windows]
+        seen = set()
+        logging.info("WFS validation in {} parts".format(len(bboxes)))
+
+    real_data = np.zeros((grid.height, grid.width), dtype='uint8')
+    lock = threading.Lock()
+    limiter = HostLimiter(options.max_connections_per_host)
+
+    def fetch(part_bbox):
+        with limiter.limit(url):
+            return burn_wfs_features(url, layer_name, srs, part_bbox,
+                                     max_features_for_validation, real_data, grid, lock, seen)
+
+    with ThreadPoolExecutor(max_workers=options.workers) as executor:
+        counts = list(executor.map(fetch, bboxes))
+    if any(count is None for count in counts):
+        return None
 
+    logging.info("Iteration done. {} features in the validation.".format(sum(counts)))
+    if sum(counts) == 0:
+        logging.info("No features in the layer.")
+
+    if options.http_cache is not None:
+        stored = io.BytesIO()
+        np.save(stored, real_data)
+        options.http_cache.store(get_wfs_url(url, srs, bbox), stored.getvalue(), *cache_params)
+
+    return real_data
+
+
+
+def get_validation_bbox(bbox, flip_features):
+    """Get the bounding box in the order used in requests to the server
+
+    :param list bbox: Bounding box as specified in the service metadata
+    :param boolean flip_features: If set to True, coordinate order must be flipped
+
+    :return:
+        list bbox: Bounding box
+        str bbox_str: Bounding box as a string for the URL
+    """
     if flip_features:
         bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
 
     # change bbox from a list into a string, remove spaces and brackets
     bbox_str = ''.join(char for char in str(bbox) if char not in '[]() ')
+    return bbox, bbox_str
 
 
-    if service_type == 'WMS':
+def fetch_real_data(url, layer_name, srs, grid, service_type, service_version,\
+                    max_features_for_validation, options=None, flip_features=False):
+    """Fetch data of the layer from the server to be compared with results.
 
-        real_data, result = validate_wms(url, layer_name, srs, bbox_str,\
-                                         file.read(1), service_version)
+    Data is fetched for the extent of the result raster.
+
+    :param str url: First part of URL pointing to a particular service
+    :param str layer_name: Name of the layer
+    :param str srs: EPSG code of a coordinate system
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+    :param str service_type: Type of service (WMS/WFS)
+    :param str service_version: Version of the service
+    :param string max_features_for_validation: If exceeded, validation is skipped
+    :param ValidationOptions options: Settings of validation; defaults to None,
+                                      which means the defaults of ValidationOptions
+    :param boolean flip_features: If set to True, coordinate order must be flipped
+
+    :return numpy array real_data: For WMS variation within grid areas of the image,
+                                   for WFS the location of the features in the grid;
+                                   None if the data couldn't be fetched
+
+    :raises ValidationSkipped: see burn_wfs_features
+    """
+    real_data = None
+    options = options or ValidationOptions()
+    bbox_str = get_window_bbox(Window(0, 0, grid.width, grid.height), grid, flip_features)
+
+    if service_type == 'WMS' and options.wms_tiles:
+
+        real_data = validate_wms_tiles(url, layer_name, srs, grid, service_version,
+                                       flip_features, options)
+        logging.info("WMS validation: data fetched from server:\n {}".format(real_data))
+
+    elif service_type == 'WMS':
+
+        # The image is compared with the result on a grid of options.wms_grid cells.
+        cells = min(options.wms_grid, grid.height, grid.width, WMS_IMAGE_SIZE)
+        image = fetch_wms_image(url, layer_name, srs, bbox_str, service_version,
+                                cache=options.http_cache)
+        if image is not None:
+            real_data = test_for_var(image, cells, cells).astype("uint8")
+            logging.info("WMS validation: data fetched from server:\n {}".format(real_data))
 
     elif service_type == 'WFS':
 
-        real_data, result = validate_wfs(url, layer_name, srs, bbox_str, file,\
-                                         service_version, max_features_for_validation), file.read(1)
+        real_data = validate_wfs(url, layer_name, srs, bbox_str, grid,\
+                                 service_version, max_features_for_validation, options,
+                                 flip_features)
 
-    if real_data is None:
-        logging.warning("Validation not successful. *feeling embarassed*")
-        return -1
-    
+    return real_data
+
+
+def compare_results(result, real_data, service_type):
+    """Compare a result of the tool with the data fetched from the server.
 
+    :param numpy array result: Binary raster produced by the tool
+    :param numpy array real_data: See fetch_real_data
+    :param str service_type: Type of service (WMS/WFS)
+
+    :return:
+        numpy array comparison: 0 if a value was the same, 1 for false positives and
+                                255 (-1 in uint8) for false negatives. For WMS one
+                                value for each grid area of real_data.
+        list statistics: Pixel count and the numbers of correct, false positive and
+                         false negative pixels
+    """
+    if service_type == 'WMS':
+        result = test_for_var(result, *real_data.shape).astype("uint8")
+        logging.info("WMS validation: our data:\n {}".format(result))
 
     # Since result is binary, the comparison is 0 if a value was the same.
     # 1 if we got false positive and -1 (i.e. 255 in uint8) if we got false negative.
     comparison = result - real_data
-    output = rasterio.open(
-        output_path,
-        'w',
-        driver='GTiff',
-        nodata=99,
-        height=file.height,
-        width=file.width,
-        count=1,
-        dtype='uint8',
-        crs=file.crs,
-        transform=file.transform
-    )
-
-
-
-    output.write(comparison, 1)
-    output.close()
     logging.info("Statistics:")
     logging.info("This is the np.unique count: {}"\
                  .format(np.unique(comparison, return_counts=True)))
@@ -376,10 +804,136 @@ def validate(url, layer_name, srs, bbox, result_path, output_path, service_type,
             raise Exception("Unexpected values in the validation raster: {}"\
                             .format(unique_vals[0]))
 
+    return comparison, [pixels_count, correct_pixels, false_pos_pixels, false_neg_pixels]
+
+
+def expand_cells(cells, grid):
+    """Give each pixel of the result raster the value of its grid area
+
+    :param numpy array cells: Value of each grid area, see test_for_var
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+
+    :return numpy array: Array of the shape of the grid
+    """
+    row_sizes = np.diff(get_cell_bounds(grid.height, cells.shape[0]))
+    col_sizes = np.diff(get_cell_bounds(grid.width, cells.shape[1]))
+    return np.repeat(np.repeat(cells, row_sizes, axis=0), col_sizes, axis=1)
+
+
+def get_data_area_share(binary_raster):
+    """Size of the bounding box of data pixels in % of the raster
+
+    The raster is smoothed like in convert_to_vector_format first, so that
+    the value is comparable with the one computed from the vector result.
+
+    :param numpy array binary_raster: Binary raster produced by the tool
+
+    :return float: Size of the bounding box of pixels with data as
+                   a percentage of the raster; see area_decrease
+    """
+    binary_raster = smooth_binary_raster(binary_raster)
+    rows = np.flatnonzero(binary_raster.any(axis=1))
+    cols = np.flatnonzero(binary_raster.any(axis=0))
+    if len(rows) == 0:
+        return 100
+    return round(100*(rows[-1] - rows[0] + 1)*(cols[-1] - cols[0] + 1)/binary_raster.size)
+
+
+def validate(url, layer_name, srs, bbox, result, grid, output_path, service_type,\
+             service_version, max_features_for_validation, flip_features, data_bounds,\
+             service_number, options=None):
+
+    """Fetch data for the corresponding layer and generate an array
+       that maps the spatial extent of the data
+
+    :param str url: First part of URL pointing to a particular service
+    :param str layer_name: Name of the layer
+    :param str srs: EPSG code of a coordinate system
+    :param list bbox: Bounding box as specified in the service metadata
+    :param numpy array result: Binary raster produced by the tool
+    :param RasterGrid grid: Shape, transform and CRS of the result raster
+    :param str output_path: Path to location where the validation raster will be written.
+    :param str service_type: Type of service (WMS/WFS)
+    :param str service_version: Number of correctly determined pixels
+    :param string max_features_for_validation: If exceeded, validation is skipped
+    :param boolean flip_features: If set to True, coordinate order must be flipped
+                                  in the URL
+    :param list data_bounds: Bounding box that encapsulates
+                             area with data as determined by the tool
+    :param str service_number: Type of service (WMS/WFS)
+    :param ValidationOptions options: Settings of validation; defaults to None,
+                                      which means the defaults of ValidationOptions
+
+    :return int: 0 if validation run OK; 1 if it was skipped on purpose,
+                 see ValidationSkipped; -1 if it failed.
+
+
+    """
+
+    logging.info("validation starts at {}".format(datetime.datetime.now()))
+
+    bbox, _ = get_validation_bbox(bbox, flip_features)
+
+    try:
+        real_data = fetch_real_data(url, layer_name, srs, grid, service_type, service_version,\
+                                    max_features_for_validation, options, flip_features)
+    except ValidationSkipped as e:
+        logging.warning("Validation skipped: {}".format(e))
+        return 1
+
+    if real_data is None:
+        logging.warning("Validation not successful. *feeling embarassed*")
+        return -1
+
+    comparison, statistics = compare_results(result, real_data, service_type)
+    if service_type == 'WMS':
+        comparison = expand_cells(comparison, grid)
+    write_raster(output_path, comparison, grid, nodata=99)
+
     bbox_area_decrease = area_decrease(bbox, data_bounds)
 
-    write_statistics(output_path, service_number, layer_name, pixels_count, correct_pixels,\
-                     false_pos_pixels, false_neg_pixels, bbox_area_decrease)
+    write_statistics(output_path, service_number, layer_name, *statistics, bbox_area_decrease)
+
+
+    return 0
+
+
+def validate_sweep(url, layer_name, srs, bbox, sweep_results, grid, output_path, service_type,\
+                   service_version, max_features_for_validation, flip_features, service_number,
+                   options=None):
+    """Validate the results of a threshold sweep
+
+    Data is fetched from the server once and compared with the result
+    of each threshold constant. Statistics are written to a separate
+    spreadsheet, see write_sweep_statistics. No validation rasters are
+    written.
+
+    :param list sweep_results: (threshold constant, binary raster) for each result
+    :param str output_path: Path to a file in the folder where statistics will be written
+
+    See validate for the other parameters.
+
+    :return int: 0 if validation run OK; 1 if it was skipped on purpose; -1 if it failed.
+    """
+    logging.info("sweep validation starts at {}".format(datetime.datetime.now()))
+
+    try:
+        real_data = fetch_real_data(url, layer_name, srs, grid, service_type, service_version,\
+                                    max_features_for_validation, options, flip_features)
+    except ValidationSkipped as e:
+        logging.warning("Sweep validation skipped: {}".format(e))
+        return 1
+
+    if real_data is None:
+        logging.warning("Sweep validation not successful.")
+        return -1
+
+    rows = []
+    for threshold_constant, result in sweep_results:
+        logging.info("Threshold constant {}".format(threshold_constant))
+        _, statistics = compare_results(result, real_data, service_type)
+        rows.append([threshold_constant] + statistics + [get_data_area_share(result)])
 
+    write_sweep_statistics(output_path, service_number, layer_name, rows)
 
     return 0